@@ -1,3 +1,11 @@
-from wavestream.app import main
+from os import getenv
+
+# "gunicorn" for production, "flask" for the development server
+if getenv("SERVER", "flask").lower() == "gunicorn":
+    # doesn't import the app, the workers do after gevent patched the standard library
+    from wavestream.server import main
+else:
+    from wavestream.app import main
+
 if __name__ == '__main__':
     main()
@@ -1,6 +1,6 @@
 from flask import Response, request, stream_with_context, current_app
-from subprocess import Popen, PIPE, DEVNULL
 from . import audio_bp
+from wavestream.transcoder import Transcoder, transcoders
 from wavestream.utils import get_stream, decode_urlsafe_base64
 
 # TODO: support stereo and 5.1 (if possible)
@@ -8,7 +8,8 @@ from wavestream.utils import get_stream, decode_urlsafe_base64
 
 # TODO: Find optimal buffer/chunk size
 CHUNK_SIZE=8*16
-bufsize = CHUNK_SIZE*2 # Hope this makes sense
+# 48 kHz, 1 bit per sample
+BYTES_PER_SECOND = 48000 // 8
 
 @audio_bp.route('/dfpwm')
 def stream_dfpwm():
@@ -18,42 +19,45 @@ def stream_dfpwm():
     if url_is_base64:
         url = decode_urlsafe_base64(url)
 
-    process = Popen(
-    [
-            "ffmpeg",
-            "-i",
-            get_stream(url),
-            "-f",
-            "dfpwm",
-            "-ac",
-            "1",
-            "-ar",
-            "48000",
-            # TODO: https://stackoverflow.com/questions/16658873/how-to-minimize-the-delay-in-a-live-streaming-with-ffmpeg
-            # TODO: https://superuser.com/questions/490683/cheat-sheets-and-preset-settings-that-actually-work-with-ffmpeg-1-0
-            # TODO: https://ffmpeg-api.com/learn/ffmpeg/recipe/live-streaming
-            # TODO: https://superuser.com/questions/155305/how-many-threads-does-ffmpeg-use-by-default
-            #"-preset", "ultrafast",
-            #"-tune", "zerolatency",
-            #"-threads", "4",
-            "-"
-        ],
-        stdout=PIPE,
-        stderr=None if current_app.debug else DEVNULL,
-        bufsize=bufsize
-    )
+    live = request.args.get("live", "false").lower() == "true"
+    stream = get_stream(url)
+
+    def create():
+        return Transcoder(
+            url,
+            [
+                "ffmpeg",
+                "-i",
+                stream,
+                "-f",
+                "dfpwm",
+                "-ac",
+                "1",
+                "-ar",
+                "48000",
+                # TODO: https://stackoverflow.com/questions/16658873/how-to-minimize-the-delay-in-a-live-streaming-with-ffmpeg
+                # TODO: https://superuser.com/questions/490683/cheat-sheets-and-preset-settings-that-actually-work-with-ffmpeg-1-0
+                # TODO: https://ffmpeg-api.com/learn/ffmpeg/recipe/live-streaming
+                # TODO: https://superuser.com/questions/155305/how-many-threads-does-ffmpeg-use-by-default
+                #"-preset", "ultrafast",
+                #"-tune", "zerolatency",
+                #"-threads", "4",
+                "-"
+            ],
+            BYTES_PER_SECOND,
+            CHUNK_SIZE,
+            current_app.debug
+        )
 
-    @stream_with_context
-    def generate():
-        while True:
-            data = process.stdout.read(CHUNK_SIZE)
-            # TODO: Fix Noise at EOF
-            if not data:
-                break
-            yield data
+    # listeners of the same URL share one ffmpeg, TooManyTranscoders is a 503
+    transcoder = transcoders.attach(url, create, live)
 
-    return Response(
-        generate(),
+    # TODO: Fix Noise at EOF
+    response = Response(
+        stream_with_context(transcoders.listen(transcoder, live)),
         mimetype="audio/dfpwm;rate=48000;channels=1",
         headers={"Content-Disposition": 'attachment;filename="audio.dfpwm"'}
     )
+    # runs when the stream ended or the client disconnected, the last listener stops ffmpeg
+    response.call_on_close(lambda: transcoders.detach(transcoder))
+    return response
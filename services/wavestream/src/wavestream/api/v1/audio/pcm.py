@@ -1,6 +1,6 @@
 from flask import Response, request, stream_with_context, current_app
-from subprocess import Popen, PIPE, DEVNULL
 from . import audio_bp
+from wavestream.transcoder import Ffmpeg
 from wavestream.utils import get_stream, decode_urlsafe_base64
 
 # TODO: support stereo and 5.1 (if possible)
@@ -123,7 +123,6 @@ from wavestream.utils import get_stream, decode_urlsafe_base64
 
 # TODO: Find optimal buffer/chunk size
 CHUNK_SIZE=8*16
-bufsize = CHUNK_SIZE*2 # Hope this makes sense
 
 @audio_bp.route('/pcm')
 def stream_pcm():
@@ -133,7 +132,8 @@ def stream_pcm():
     if url_is_base64:
         url = decode_urlsafe_base64(url)
 
-    process = Popen(
+    # TooManyTranscoders is a 503
+    process = Ffmpeg(
     [
             "ffmpeg",
             "-i",
@@ -155,23 +155,25 @@ def stream_pcm():
             #"-threads", "4",
             "-"
         ],
-        stdout=PIPE,
-        stderr=None if current_app.debug else DEVNULL,
-        bufsize=bufsize
+        CHUNK_SIZE,
+        current_app.debug
     )
 
     @stream_with_context
     def generate():
         while True:
-            data = process.stdout.read(CHUNK_SIZE)
+            data = process.read(CHUNK_SIZE)
             # TODO: Fix Noise at EOF
             if not data:
                 break
             yield data
 
-    return Response(
+    response = Response(
         generate(),
         mimetype="audio/pcm;rate=48000;channels=1",
         headers={"Content-Disposition": 'attachment;filename="audio.pcm"'}
     )
+    # runs when the stream ended or the client disconnected, kills and reaps ffmpeg
+    response.call_on_close(process.stop)
+    return response
 # application/octet-stream
\ No newline at end of file
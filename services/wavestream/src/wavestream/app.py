@@ -1,7 +1,8 @@
 from os import getenv
 
-from flask import Flask, Response
+from flask import Flask, Response, jsonify
 from .api.v1 import v1
+from .transcoder import TRANSCODER_WAIT_SECONDS, TooManyTranscoders, transcoder_stats
 
 app = Flask(__name__, static_url_path='')
 
@@ -13,6 +14,19 @@ app.register_blueprint(v1, url_prefix="/api/v1")
 def index():
     return app.send_static_file('index.html')
 
+@app.route('/stats')
+def stats():
+    # counters of the worker that answers
+    return jsonify(transcoder_stats())
+
+@app.errorhandler(TooManyTranscoders)
+def too_many_transcoders(e):
+    return Response(
+        "Too many streams, retry later",
+        503,
+        {"Retry-After": str(max(1, int(TRANSCODER_WAIT_SECONDS)))}
+    )
+
 @app.errorhandler(404)
 def page_not_found(e):
     return app.send_static_file('404.html'), 404
@@ -22,11 +36,13 @@ def page_not_found(e):
     return app.send_static_file('500.html'), 500
 
 def main():
+    # development server, SERVER=gunicorn runs the production server (wavestream.server)
     app.run(
         host=getenv("HOST"),
         port=getenv("PORT"),
-        debug=getenv("DEBUG")
-    ) # TODO: run threaded and use real wsgi server
+        debug=getenv("DEBUG"),
+        threaded=True
+    )
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,169 @@
+"""
+Load benchmark of /api/v1/audio/dfpwm.
+Opens more and more concurrent streams, reads each one at playback speed like a
+CC speaker and reports how many streams the server sustains and how many CPU cores
+the server and its ffmpeg processes used for them (Linux, with --pid).
+
+python -m wavestream.bench --serve song.mp3 --pid <server pid> --streams 50,100,200
+Streams of the same URL share one ffmpeg, --unique gives every stream its own URL (and ffmpeg).
+"""
+
+from argparse import ArgumentParser
+from asyncio import TimeoutError as AsyncTimeoutError
+from asyncio import gather, open_connection, run, sleep, wait_for
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from os import listdir, path, sysconf
+from statistics import median
+from threading import Thread
+from time import monotonic
+from urllib.parse import quote, urlsplit
+
+# dfpwm, 48 kHz and 1 bit per sample
+BYTES_PER_SECOND = 6000
+# a speaker buffers this many seconds ahead
+LEAD_SECONDS = 2
+# a stream keeps up if it got this share of the playback bytes since its first byte
+KEEP_UP = 0.95
+
+
+async def stream(host: str, port: int, target: str, delay: float, seconds: float) -> dict:
+    await sleep(delay)
+    started = monotonic()
+    result = {"ok": False, "ttfb": None, "bytes": 0, "sustained": False}
+    try:
+        reader, writer = await wait_for(open_connection(host, port), seconds)
+    except (OSError, AsyncTimeoutError):
+        return result
+    try:
+        # HTTP/1.0, so the body isn't chunked
+        writer.write(f"GET {target} HTTP/1.0\r\nHost: {host}\r\n\r\n".encode())
+        await writer.drain()
+        end = started + seconds
+        header = await wait_for(reader.readuntil(b"\r\n\r\n"), seconds)
+        if header.split(b" ", 2)[1] != b"200":
+            return result
+        result["ok"] = True
+        first = None
+        while monotonic() < end:
+            try:
+                data = await wait_for(reader.read(4096), end - monotonic())
+            except AsyncTimeoutError:
+                break
+            if not data:
+                break
+            if first is None:
+                first = monotonic()
+                result["ttfb"] = first - started
+            result["bytes"] += len(data)
+            # read like a speaker plays
+            ahead = result["bytes"] / BYTES_PER_SECOND - (monotonic() - first) - LEAD_SECONDS
+            if ahead > 0:
+                await sleep(min(ahead, end - monotonic()))
+        if first is not None:
+            played = monotonic() - first
+            result["sustained"] = result["bytes"] >= played * BYTES_PER_SECOND * KEEP_UP
+    except (OSError, AsyncTimeoutError, IndexError):
+        pass
+    finally:
+        writer.close()
+    return result
+
+
+def cpu_seconds(pid: int) -> float:
+    """CPU time of a process and all its descendants (ffmpeg), including exited ones"""
+    stats = {}
+    for name in listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # ppid, utime, stime, cutime, cstime
+        stats[int(name)] = (int(fields[1]), sum(int(value) for value in fields[11:15]))
+    tree = {pid}
+    grew = True
+    while grew:
+        grew = False
+        for child, (parent, _ticks) in stats.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                grew = True
+    return sum(stats[member][1] for member in tree if member in stats) / sysconf("SC_CLK_TCK")
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # ffmpeg is killed mid-download when a stream ends
+        pass
+
+
+def serve_file(file: str) -> str:
+    """Serves a local media file, so the benchmark doesn't depend on YouTube"""
+    handler = partial(QuietHandler, directory=path.dirname(path.abspath(file)))
+    server = QuietServer(("127.0.0.1", 0), handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/{quote(path.basename(file))}"
+
+
+async def run_step(host: str, port: int, target, streams: int, seconds: float, ramp: float) -> list:
+    return await gather(*(
+        stream(host, port, target(index), ramp * index / streams, seconds)
+        for index in range(streams)
+    ))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--server", default="http://127.0.0.1:8000", help="WaveStream server")
+    parser.add_argument("--url", help="media URL the streams play")
+    parser.add_argument("--serve", metavar="FILE", help="serve a local media file and play it")
+    parser.add_argument("--streams", default="25,50,100,200", help="concurrent streams per step")
+    parser.add_argument("--seconds", type=float, default=30, help="length of a step")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which a step opens its streams")
+    parser.add_argument("--pid", type=int, help="server pid, to measure its CPU use and the one of its children")
+    parser.add_argument("--unique", action="store_true", help="a URL per stream, so streams don't share ffmpeg")
+    args = parser.parse_args()
+    if not args.url and not args.serve:
+        parser.error("--url or --serve is required")
+
+    url = serve_file(args.serve) if args.serve else args.url
+    server = urlsplit(args.server)
+    step = 0
+
+    def target(index: int) -> str:
+        stream_url = url
+        if args.unique:
+            # new URLs every step, a finished step doesn't leave shared transcoders behind
+            stream_url += f"{'&' if '?' in url else '?'}stream={step}-{index}"
+        return f"/api/v1/audio/dfpwm?url={quote(stream_url, safe='')}"
+
+    print("streams  ok  sustained  ttfb(median)  cores  streams/core")
+    for streams in (int(value) for value in args.streams.split(",")):
+        step += 1
+        cpu_before = cpu_seconds(args.pid) if args.pid else None
+        started = monotonic()
+        results = run(run_step(server.hostname, server.port or 80, target, streams, args.seconds, args.ramp))
+        wall = monotonic() - started
+        ok = sum(result["ok"] for result in results)
+        sustained = sum(result["sustained"] for result in results)
+        ttfbs = [result["ttfb"] for result in results if result["ttfb"] is not None]
+        ttfb = f"{median(ttfbs):.2f}s" if ttfbs else "-"
+        if cpu_before is not None:
+            cores = (cpu_seconds(args.pid) - cpu_before) / wall
+            per_core = f"{sustained / cores:.0f}" if cores > 0 else "-"
+            cores = f"{cores:.2f}"
+        else:
+            cores = per_core = "-"
+        print(f"{streams:7}  {ok:3}  {sustained:9}  {ttfb:>12}  {cores:>5}  {per_core:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+from os import cpu_count, getenv
+
+from gunicorn.app.base import BaseApplication
+
+# Production server: gunicorn with gevent workers.
+# Every stream is a greenlet instead of a thread, so one worker holds
+# hundreds of long-lived /audio/dfpwm responses while ffmpeg does the work.
+
+WORKERS = int(getenv("WORKERS", str(cpu_count() or 1)))
+# open connections (streams) per worker
+WORKER_CONNECTIONS = int(getenv("WORKER_CONNECTIONS", "1000"))
+# seconds a worker may not report to the arbiter before it is restarted
+WORKER_TIMEOUT = int(getenv("WORKER_TIMEOUT", "30"))
+
+
+class WaveStreamServer(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # imported in the worker, after gevent patched subprocess and socket,
+        # so reading ffmpeg's pipe and yt-dlp's requests don't block other streams
+        from wavestream.app import app
+        return app
+
+
+def main():
+    WaveStreamServer({
+        "bind": f"{getenv('HOST') or '127.0.0.1'}:{getenv('PORT') or '8000'}",
+        "workers": WORKERS,
+        "worker_class": "gevent",
+        "worker_connections": WORKER_CONNECTIONS,
+        # gevent workers report to the arbiter while streams run, a song doesn't time out
+        "timeout": WORKER_TIMEOUT,
+        "graceful_timeout": 10,
+        "accesslog": "-" if getenv("DEBUG") else None,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
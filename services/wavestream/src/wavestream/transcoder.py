@@ -0,0 +1,222 @@
+from os import getenv
+from subprocess import DEVNULL, PIPE, Popen
+from threading import BoundedSemaphore, Condition, Lock, Thread
+from time import monotonic, sleep
+
+# Shared live transcoders: all listeners of a URL read the output of one ffmpeg.
+# The output is paced to playback speed (plus a head start) and kept in a ring buffer,
+# late joiners start at its beginning or at the live edge.
+
+# seconds of played output kept for late joiners, also the head start of the listeners
+TRANSCODER_BUFFER_SECONDS = float(getenv("TRANSCODER_BUFFER_SECONDS", "10"))
+# ffmpeg processes per worker, 0 is unlimited
+MAX_TRANSCODERS = int(getenv("MAX_TRANSCODERS", "0"))
+# seconds a new stream waits for a free slot before it gets a 503
+TRANSCODER_WAIT_SECONDS = float(getenv("TRANSCODER_WAIT_SECONDS", "0"))
+
+slots = BoundedSemaphore(MAX_TRANSCODERS) if MAX_TRANSCODERS > 0 else None
+stats = {"active": 0, "started": 0, "finished": 0, "killed": 0, "rejected": 0}
+stats_lock = Lock()
+
+
+class TooManyTranscoders(Exception):
+    pass
+
+
+def count(name: str, change: int = 1):
+    with stats_lock:
+        stats[name] += change
+
+
+def transcoder_stats() -> dict:
+    """Counters of this worker, active ffmpeg processes and shared streams"""
+    with stats_lock:
+        report = dict(stats)
+    report["max"] = MAX_TRANSCODERS
+    with transcoders.lock:
+        shared = list(transcoders.transcoders.values())
+    report["shared_streams"] = len(shared)
+    report["listeners"] = sum(transcoder.listeners for transcoder in shared)
+    return report
+
+
+class Ffmpeg:
+    """An ffmpeg process that holds a slot until stop() killed and reaped it"""
+
+    def __init__(self, command: list, chunk_size: int, debug: bool = False):
+        if slots is not None and not slots.acquire(timeout=TRANSCODER_WAIT_SECONDS):
+            count("rejected")
+            raise TooManyTranscoders()
+        try:
+            self.process = Popen(
+                command,
+                stdout=PIPE,
+                stderr=None if debug else DEVNULL,
+                bufsize=chunk_size * 2
+            )
+        except BaseException:
+            if slots is not None:
+                slots.release()
+            raise
+        self.stopped = False
+        self.lock = Lock()
+        count("started")
+        count("active")
+
+    def read(self, size: int) -> bytes:
+        return self.process.stdout.read(size)
+
+    def stop(self):
+        """Kills ffmpeg if it still runs (the client left), reaps it and frees its slot"""
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+        if self.process.poll() is None:
+            self.process.kill()
+            count("killed")
+        else:
+            count("finished")
+        self.process.wait()
+        self.process.stdout.close()
+        count("active", -1)
+        if slots is not None:
+            slots.release()
+
+
+class Transcoder:
+    def __init__(self, key, command: list, bytes_per_second: int, chunk_size: int, debug: bool = False):
+        self.key = key
+        self.bytes_per_second = bytes_per_second
+        self.chunk_size = chunk_size
+        self.head_start = int(TRANSCODER_BUFFER_SECONDS * bytes_per_second)
+        # the head start and what already played
+        self.max_buffer = self.head_start * 2
+        self.buffer = bytearray()
+        # stream offset of buffer[0] and of the byte after the buffer
+        self.base = 0
+        self.end = 0
+        self.ended = False
+        self.listeners = 0
+        self.condition = Condition()
+        self.process = Ffmpeg(command, chunk_size, debug)
+        Thread(target=self.pump, daemon=True).start()
+
+    def pump(self):
+        """Moves ffmpeg's output into the buffer, not faster than playback (plus the head start)"""
+        started = None
+        try:
+            while True:
+                if started is not None:
+                    ahead = (self.end - self.head_start) / self.bytes_per_second - (monotonic() - started)
+                    if ahead > 0:
+                        # ffmpeg waits on the full pipe meanwhile
+                        sleep(ahead)
+                data = self.process.read(self.chunk_size)
+                if not data:
+                    break
+                if started is None:
+                    # playback starts with the first output, not with ffmpeg
+                    started = monotonic()
+                with self.condition:
+                    self.buffer += data
+                    self.end += len(data)
+                    overflow = len(self.buffer) - self.max_buffer
+                    if overflow > 0:
+                        del self.buffer[:overflow]
+                        self.base += overflow
+                    self.condition.notify_all()
+        except (OSError, ValueError):
+            # the pipe was closed by stop()
+            pass
+        finally:
+            with self.condition:
+                self.ended = True
+                self.condition.notify_all()
+
+    def start_position(self, live: bool) -> int:
+        with self.condition:
+            return self.end if live else self.base
+
+    def read(self, position: int) -> tuple:
+        """
+        Waits for output after position, returns it and the next position.
+        A listener that fell out of the buffer continues at its beginning.
+        Returns no data once the stream ended.
+        """
+        with self.condition:
+            while position >= self.end and not self.ended:
+                self.condition.wait()
+            position = max(position, self.base)
+            start = position - self.base
+            data = bytes(self.buffer[start:start + self.chunk_size * 8])
+        return data, position + len(data)
+
+    def stop(self):
+        self.process.stop()
+
+
+class TranscoderRegistry:
+    def __init__(self):
+        self.transcoders = {}
+        self.lock = Lock()
+
+    def running(self, key, live: bool):
+        transcoder = self.transcoders.get(key)
+        # a finished stream starts over for new listeners
+        if transcoder is None or transcoder.ended:
+            return None
+        # on demand listeners want the whole track, only the live edge can be joined late
+        if not live and transcoder.start_position(False) > 0:
+            return None
+        return transcoder
+
+    def attach(self, key, create, live: bool = False) -> Transcoder:
+        """
+        Returns the running transcoder of key, starts one with create() if there is none
+        or if it already dropped the start of the track and the listener isn't live.
+        Raises TooManyTranscoders if no slot got free.
+        """
+        with self.lock:
+            transcoder = self.running(key, live)
+            if transcoder is not None:
+                transcoder.listeners += 1
+                return transcoder
+        # may wait for a slot, without blocking the listeners of other URLs
+        created = create()
+        with self.lock:
+            transcoder = self.running(key, live)
+            if transcoder is None:
+                # later listeners join the newest one, an older one plays on for its listeners
+                transcoder = created
+                self.transcoders[key] = transcoder
+            transcoder.listeners += 1
+        if transcoder is not created:
+            # another listener of the URL was faster
+            created.stop()
+        return transcoder
+
+    def detach(self, transcoder: Transcoder):
+        """The last listener stops ffmpeg"""
+        with self.lock:
+            transcoder.listeners -= 1
+            if transcoder.listeners > 0:
+                return
+            if self.transcoders.get(transcoder.key) is transcoder:
+                del self.transcoders[transcoder.key]
+        transcoder.stop()
+
+    def listen(self, transcoder: Transcoder, live: bool = False):
+        """
+        Yields the output of an attached transcoder until it ends,
+        the response detaches when it is closed (also if the client left before the first byte)
+        """
+        position = transcoder.start_position(live)
+        while True:
+            data, position = transcoder.read(position)
+            if not data:
+                break
+            yield data
+
+
+transcoders = TranscoderRegistry()
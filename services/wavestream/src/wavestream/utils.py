@@ -1,4 +1,12 @@
 from base64 import urlsafe_b64decode
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from threading import Lock
+from time import time
+from urllib.parse import parse_qs, urlsplit
+from gevent import get_hub
+from gevent.monkey import is_module_patched
 from yt_dlp import YoutubeDL
 from os import getenv
 import shutil
@@ -18,17 +26,94 @@ if getenv("TOR"):
     print("Using Tor!")
     ydl_opts["proxy"] = "socks5://127.0.0.1:9050"
 
+# YoutubeDL instances are reused, but one only serves one request at a time
+YDL_POOL_SIZE = int(getenv("YDL_POOL_SIZE", "4"))
+# seconds a resolved URL is reused if it doesn't say when it expires
+STREAM_CACHE_TTL = int(getenv("STREAM_CACHE_TTL", "300"))
+# resolved URLs are dropped this many seconds before they expire, ffmpeg needs time to open them
+STREAM_CACHE_MARGIN = int(getenv("STREAM_CACHE_MARGIN", "600"))
+STREAM_CACHE_SIZE = int(getenv("STREAM_CACHE_SIZE", "1024"))
+
+ydl_pool = LifoQueue()
+ydl_pool_lock = Lock()
+ydl_created = 0
+
+# input URL -> (expires at, resolved URL), least recently used first
+stream_cache = OrderedDict()
+stream_cache_lock = Lock()
+
+
+@contextmanager
+def borrow_ydl():
+    """Lends a YoutubeDL of the pool, waits while YDL_POOL_SIZE are in use"""
+    global ydl_created
+    try:
+        ydl = ydl_pool.get_nowait()
+    except Empty:
+        with ydl_pool_lock:
+            create = ydl_created < YDL_POOL_SIZE
+            if create:
+                ydl_created += 1
+        ydl = YoutubeDL(ydl_opts) if create else ydl_pool.get()
+    try:
+        yield ydl
+    finally:
+        ydl_pool.put(ydl)
+
+
+def expires_at(url: str) -> float:
+    """Unix time a signed URL expires (expire=, Expires=), else now + STREAM_CACHE_TTL"""
+    query = parse_qs(urlsplit(url).query)
+    for key in ("expire", "expires", "Expires"):
+        try:
+            return float(query[key][0]) - STREAM_CACHE_MARGIN
+        except (KeyError, ValueError):
+            continue
+    return time() + STREAM_CACHE_TTL
+
+
+def off_hub(func, *args):
+    """
+    Runs CPU-bound work in a thread of the gevent hub's pool, so it doesn't stall the other streams.
+    Called directly when gevent didn't patch the standard library (Flask development server).
+    """
+    if not is_module_patched("threading"):
+        return func(*args)
+    threadpool = get_hub().threadpool
+    if threadpool.maxsize < YDL_POOL_SIZE:
+        threadpool.maxsize = YDL_POOL_SIZE
+    return threadpool.apply(func, args)
+
+
+def resolve(url: str) -> str:
+    with borrow_ydl() as ydl:
+        # yt-dlp's extractors and format sorting are plain Python and hold the hub for a while
+        data = off_hub(ydl.extract_info, url, False)
+    if data.get("_type") == "playlist":
+        # the first entry, it is cached on its own
+        return get_stream(data.get("entries")[0].get("url"))
+    return data.get("url")
+
+
 # TODO: do some validation on the url
 # TODO: disallow connection to localhost
 # TODO: fix hls
 # TODO; auth, spotify, stremlink
 def get_stream(url: str) -> str:
-    with YoutubeDL(ydl_opts) as ydl:
-        data = ydl.extract_info(url, download=False)
-        # TODO: very good code ;)
-        if data.get("_type") == "playlist":
-            return ydl.extract_info(data.get("entries")[0].get("url"), download=False).get("url")
-        return data.get("url")
+    """Returns the direct media URL, from the cache while it is valid"""
+    with stream_cache_lock:
+        cached = stream_cache.get(url)
+        if cached and cached[0] > time():
+            stream_cache.move_to_end(url)
+            return cached[1]
+    stream = resolve(url)
+    if stream:
+        with stream_cache_lock:
+            stream_cache[url] = (expires_at(stream), stream)
+            stream_cache.move_to_end(url)
+            while len(stream_cache) > STREAM_CACHE_SIZE:
+                stream_cache.popitem(last=False)
+    return stream
 
 def decode_urlsafe_base64(url: str) -> str:
     """
@@ -3,15 +3,25 @@
 
 """
 Compiles YC to pyc files
+With --benchmark it measures the startup instead (import time and worker RSS)
 """
 
-from os import rename
+from argparse import ArgumentParser
+from os import environ, listdir, rename
 from os.path import isdir, join
 from pathlib import Path
 from py_compile import compile as py_compile
+from re import match
+from socket import socket
+from statistics import median
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired, run
+from sys import executable
+from time import perf_counter, sleep
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
 
 
-def main() -> None:
+def compile_all() -> None:
     """Starts the compilation"""
     blacklist = ["__main__.py"]
 
@@ -25,5 +35,142 @@ def main() -> None:
             print(path, "->", new_name)
 
 
+def measure_import(runs: int, top: int) -> None:
+    """Prints the import time of the server module (python -X importtime)"""
+    totals = []
+    slowest: dict[str, int] = {}
+    for _unused in range(runs):
+        result = run(
+            [executable, "-X", "importtime", "-c", "import youcube"],
+            cwd="youcube",
+            stdout=DEVNULL,
+            stderr=PIPE,
+            text=True,
+            check=True,
+        )
+        # children are printed before their parent
+        children = []
+        for line in result.stderr.splitlines():
+            found = match(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)", line)
+            if not found:
+                continue
+            cumulative, indent, name = found.groups()
+            if not indent:
+                if name == "youcube":
+                    totals.append(int(cumulative))
+                    for child, child_cumulative in children:
+                        slowest[child] = max(slowest.get(child, 0), child_cumulative)
+                children = []
+            elif len(indent) == 2:
+                children.append((name, int(cumulative)))
+
+    print(f"import youcube: {median(totals) / 1000:.0f} ms (median of {runs} runs)")
+    for name, cumulative in sorted(slowest.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {name:<32} {cumulative / 1000:>8.1f} ms")
+
+
+def free_port() -> int:
+    """Returns a free TCP port"""
+    with socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def child_pids(pid: int) -> list[int]:
+    """Returns all descendants of a process (Linux only)"""
+    children = []
+    task_folder = f"/proc/{pid}/task"
+    if not isdir(task_folder):
+        return children
+    for task in listdir(task_folder):
+        try:
+            with open(join(task_folder, task, "children"), "r", encoding="utf-8") as file:
+                for child in file.read().split():
+                    children.append(int(child))
+                    children.extend(child_pids(int(child)))
+        except OSError:
+            continue
+    return children
+
+
+def read_process(pid: int) -> tuple[int, str]:
+    """Returns the RSS in KiB and the command line of a process"""
+    rss = 0
+    with open(f"/proc/{pid}/status", "r", encoding="utf-8") as file:
+        for line in file:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    with open(f"/proc/{pid}/cmdline", "rb") as file:
+        cmdline = file.read().replace(b"\0", b" ").decode(errors="replace").strip()
+    return rss, cmdline
+
+
+def measure_server(timeout: float) -> None:
+    """Starts the server and prints the time until it answers and the RSS of every process"""
+    port = free_port()
+    env = {**environ, "HOST": "127.0.0.1", "PORT": str(port)}
+    start = perf_counter()
+    # pylint: disable-next=consider-using-with
+    server = Popen(
+        [executable, "youcube.py"], cwd="youcube", env=env, stdout=DEVNULL, stderr=DEVNULL
+    )
+    try:
+        ready = None
+        while perf_counter() - start < timeout and server.poll() is None:
+            try:
+                with urlopen(f"http://127.0.0.1:{port}/", timeout=1):
+                    pass
+                ready = perf_counter() - start
+            except HTTPError:
+                # any http answer means a worker is serving
+                ready = perf_counter() - start
+            except (URLError, ConnectionError):
+                sleep(0.05)
+                continue
+            break
+        if ready is None:
+            print(f"Server did not answer within {timeout}s")
+            return
+        print(f"Server answers after {ready * 1000:.0f} ms")
+
+        total = 0
+        for pid in [server.pid] + child_pids(server.pid):
+            try:
+                rss, cmdline = read_process(pid)
+            except OSError:
+                continue
+            total += rss
+            print(f"  {pid:>7} {rss / 1024:>8.1f} MiB  {cmdline[:70]}")
+        print(f"  total   {total / 1024:>8.1f} MiB")
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except TimeoutExpired:
+            server.kill()
+
+
+def main() -> None:
+    """Parses the arguments"""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="measure import time and worker RSS instead of compiling",
+    )
+    parser.add_argument("--runs", type=int, default=5, help="import time runs")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to show")
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="seconds to wait for the server"
+    )
+    args = parser.parse_args()
+
+    if args.benchmark:
+        measure_import(args.runs, args.top)
+        measure_server(args.timeout)
+    else:
+        compile_all()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Admin-only diagnostics of the sanic workers
+"""
+
+# Built-in modules
+import tracemalloc
+from asyncio import sleep
+from collections import Counter
+from cProfile import Profile
+from glob import glob
+from hmac import compare_digest
+from marshal import dumps as marshal_dumps
+from multiprocessing import active_children
+from os import getenv, getpid, listdir
+from os.path import basename, exists
+from re import sub
+from sys import _current_frames
+from threading import Event, Lock, Thread, enumerate as enumerate_threads, get_ident
+from time import strftime
+from types import CodeType, FrameType
+from typing import Any, Callable
+
+# Local modules
+from yc_logging import logger
+from yc_rooms import rooms
+from yc_storage import storage_report
+
+# pip modules
+from sanic import Blueprint, Request
+from sanic.exceptions import BadRequest, NotFound, SanicException, Unauthorized
+from sanic.response import json, raw
+
+ADMIN_TOKEN = getenv("ADMIN_TOKEN")
+PROFILE_MAX_SECONDS = int(getenv("PROFILE_MAX_SECONDS", "300"))
+MEMORY_LOG_INTERVAL = int(getenv("MEMORY_LOG_INTERVAL", "0"))
+# start tracemalloc with this many frames per allocation on startup, 0 = only on demand
+TRACEMALLOC_FRAMES = int(getenv("TRACEMALLOC_FRAMES", "0"))
+
+admin = Blueprint("admin", url_prefix="/admin")
+
+# code objects whose frames label the samples below them, mapped to the local that holds the label
+labelled_codes: dict[CodeType, str] = {}
+# only one profile per worker at once
+profile_lock = Lock()
+# functions that return the number of entries of an in-process cache
+cache_sizes: dict[str, Callable[[], int]] = {}
+# snapshot the tracemalloc diff is computed against
+memory_baseline: tracemalloc.Snapshot | None = None
+
+
+def label_frames(local_name: str) -> Callable:
+    """
+    Decorator, samples taken while the function runs get the value
+    of its local variable local_name as extra stack frame (e.g. the web-socket action)
+    """
+
+    def decorator(func: Callable) -> Callable:
+        labelled_codes[func.__code__] = local_name
+        return func
+
+    return decorator
+
+
+def frame_name(frame: FrameType) -> str:
+    """Returns the name of a stack frame in collapsed stack notation"""
+    code = frame.f_code
+    return f"{code.co_name} ({basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame: FrameType | None) -> list[str]:
+    """Returns the stack from the root to the given frame"""
+    stack = []
+    while frame is not None:
+        stack.append(frame_name(frame))
+        local_name = labelled_codes.get(frame.f_code)
+        if local_name is not None:
+            stack.append(f"{local_name}:{frame.f_locals.get(local_name)}")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class StackSampler:
+    """Samples the stacks of all threads of this process in an interval"""
+
+    def __init__(self, interval: float) -> None:
+        self.interval = interval
+        self.samples: Counter[str] = Counter()
+        self.stopped = Event()
+        self.thread = Thread(target=self.run, name="stack-sampler", daemon=True)
+
+    def run(self) -> None:
+        """Takes samples until stopped"""
+        own_ident = get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in enumerate_threads()}
+            for ident, frame in _current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = [names.get(ident, str(ident))] + collapse_stack(frame)
+                self.samples[";".join(stack)] += 1
+
+    def start(self) -> None:
+        """Starts sampling"""
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stops sampling"""
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self) -> str:
+        """Returns the samples in collapsed stack format (flamegraph.pl, speedscope)"""
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.samples.most_common()
+        )
+
+
+@admin.on_request
+async def check_token(request: Request):
+    """Only allows requests with the ADMIN_TOKEN"""
+    if not ADMIN_TOKEN:
+        raise NotFound("Admin routes are disabled, set ADMIN_TOKEN to enable them")
+    # only the header, query strings end up in the access log
+    token = request.token or ""
+    if not compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise Unauthorized("Invalid admin token")
+
+
+@admin.route("/profile")
+async def profile(request: Request):
+    """
+    Profiles this worker for "seconds" seconds.
+    format=collapsed samples the stacks of all threads every "interval" ms,
+    format=pstats runs cProfile, open the result with pstats or snakeviz.
+    """
+    try:
+        seconds = float(request.args.get("seconds", "10"))
+        interval = float(request.args.get("interval", "5")) / 1000
+    except ValueError as exc:
+        raise BadRequest("seconds and interval must be numbers") from exc
+    output_format = request.args.get("format", "collapsed")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval <= 0:
+        raise BadRequest(f"seconds must be between 0 and {PROFILE_MAX_SECONDS}")
+    if output_format not in ("collapsed", "pstats"):
+        raise BadRequest('format must be "collapsed" or "pstats"')
+    if not profile_lock.acquire(blocking=False):
+        raise SanicException("A profile is already running", status_code=409)
+
+    logger.info("Profiling worker %s for %ss (%s)", getpid(), seconds, output_format)
+    try:
+        if output_format == "collapsed":
+            sampler = StackSampler(interval)
+            sampler.start()
+            try:
+                await sleep(seconds)
+            finally:
+                sampler.stop()
+            body = sampler.collapsed().encode("utf-8")
+            content_type = "text/plain; charset=utf-8"
+            extension = "collapsed.txt"
+        else:
+            profiler = Profile()
+            profiler.enable()
+            try:
+                await sleep(seconds)
+            finally:
+                profiler.disable()
+            profiler.create_stats()
+            # same content as Profile.dump_stats
+            body = marshal_dumps(profiler.stats)
+            content_type = "application/octet-stream"
+            extension = "pstats"
+    finally:
+        profile_lock.release()
+
+    file_name = f"youcube-{getpid()}-{strftime('%Y%m%d-%H%M%S')}.{extension}"
+    return raw(
+        body,
+        content_type=content_type,
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'},
+    )
+
+
+def register_cache(name: str, size: Callable[[], int]) -> None:
+    """Adds a cache to the memory report, size returns its number of entries"""
+    cache_sizes[name] = size
+
+
+def read_rss() -> int | None:
+    """Returns the resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def count_child_processes() -> int:
+    """Returns the number of direct child processes (ffmpeg, sanjuuni, multiprocessing)"""
+    children = set()
+    for path in glob("/proc/self/task/*/children"):
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                children.update(file.read().split())
+        except OSError:
+            continue
+    if not children and not exists("/proc/self/task"):
+        return len(active_children())
+    return len(children)
+
+
+def count_open_fds() -> int | None:
+    """Returns the number of open file descriptors"""
+    try:
+        return len(listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def count_threads() -> dict[str, int]:
+    """Returns the live threads grouped by class and name (without numbers)"""
+    return dict(
+        Counter(
+            f"{type(thread).__name__}:{sub(r'[0-9]+', 'N', thread.name)}"
+            for thread in enumerate_threads()
+        ).most_common()
+    )
+
+
+def tracemalloc_diff(limit: int, key_type: str = "lineno") -> list[dict[str, Any]]:
+    """Returns the biggest allocation changes since the baseline snapshot"""
+    global memory_baseline  # pylint: disable=global-statement
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+    if memory_baseline is None:
+        memory_baseline = snapshot
+    stats = snapshot.compare_to(memory_baseline, key_type)
+    return [
+        {
+            "where": [str(frame) for frame in stat.traceback],
+            "size": stat.size,
+            "size_diff": stat.size_diff,
+            "count": stat.count,
+            "count_diff": stat.count_diff,
+        }
+        for stat in stats[:limit]
+    ]
+
+
+def memory_report() -> dict[str, Any]:
+    """Returns the memory related numbers of this worker"""
+    caches = {}
+    for name, size in cache_sizes.items():
+        try:
+            caches[name] = size()
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            caches[name] = f"error: {exc}"
+    threads = count_threads()
+    report = {
+        "pid": getpid(),
+        "rss": read_rss(),
+        "threads": sum(threads.values()),
+        "thread_kinds": threads,
+        "child_processes": count_child_processes(),
+        "open_fds": count_open_fds(),
+        "caches": caches,
+        "tracemalloc": tracemalloc.is_tracing(),
+    }
+    if tracemalloc.is_tracing():
+        report["traced"], report["traced_peak"] = tracemalloc.get_traced_memory()
+    return report
+
+
+def start_tracemalloc(frames: int) -> None:
+    """Starts tracemalloc, the first snapshot becomes the baseline"""
+    global memory_baseline  # pylint: disable=global-statement
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(max(1, frames))
+        memory_baseline = None
+
+
+@admin.route("/memory")
+async def memory(request: Request):
+    """
+    Memory report of this worker.
+    tracemalloc=start|stop toggles allocation tracing (frames=N frames per allocation),
+    while tracing the biggest changes since the baseline are listed
+    (limit=N, key=lineno|filename|traceback),
+    reset=1 makes the current snapshot the new baseline.
+    """
+    global memory_baseline  # pylint: disable=global-statement
+    action = request.args.get("tracemalloc")
+    try:
+        limit = int(request.args.get("limit", "25"))
+        frames = int(request.args.get("frames", "10"))
+    except ValueError as exc:
+        raise BadRequest("limit and frames must be integers") from exc
+    key_type = request.args.get("key", "lineno")
+    if key_type not in ("lineno", "filename", "traceback"):
+        raise BadRequest('key must be "lineno", "filename" or "traceback"')
+
+    if action == "start":
+        start_tracemalloc(frames)
+    elif action == "stop":
+        tracemalloc.stop()
+        memory_baseline = None
+    elif action is not None:
+        raise BadRequest('tracemalloc must be "start" or "stop"')
+
+    report = memory_report()
+    if tracemalloc.is_tracing():
+        if request.args.get("reset"):
+            memory_baseline = None
+        report["top_diff"] = tracemalloc_diff(limit, key_type)
+    return json(report)
+
+
+@admin.route("/storage")
+async def storage(_request: Request):
+    """
+    32vid storage of this worker: CPU per served frame batch and per decompressed block,
+    block cache hits and the compression ratio of the files it served
+    """
+    return json(storage_report())
+
+
+@admin.route("/rooms")
+async def room_list(_request: Request):
+    """Broadcast rooms of this worker and the chunks their slow listeners missed"""
+    return json(rooms.report())
+
+
+def format_bytes(size: int | None) -> str:
+    """Formats a byte count for the log"""
+    if size is None:
+        return "?"
+    return f"{size / 1024 / 1024:.1f} MiB"
+
+
+async def memory_logger(interval: int) -> None:
+    """Logs a memory summary of this worker every interval seconds"""
+    while True:
+        await sleep(interval)
+        report = memory_report()
+        logger.info(
+            "Memory of worker %s: rss=%s threads=%s children=%s fds=%s caches=%s",
+            report["pid"],
+            format_bytes(report["rss"]),
+            report["threads"],
+            report["child_processes"],
+            report["open_fds"],
+            report["caches"],
+        )
+        if tracemalloc.is_tracing():
+            for stat in tracemalloc_diff(3):
+                if not stat["size_diff"]:
+                    continue
+                logger.info(
+                    "  %+d B (%+d allocations) at %s",
+                    stat["size_diff"],
+                    stat["count_diff"],
+                    stat["where"][0] if stat["where"] else "?",
+                )
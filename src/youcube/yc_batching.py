@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Per-client batch sizes of get_vid and get_chunk.
+Clients declare limits in their handshake, the server adapts the batch size
+within them from the round trip time and the time between a response
+and the next request (AIMD).
+"""
+
+# Built-in modules
+from asyncio import Task, ensure_future, sleep, wait_for
+from os import getenv
+from time import monotonic
+from typing import Any
+
+# Local modules
+from yc_logging import logger
+
+# pip modules
+from sanic import Websocket
+
+# upper bounds for all clients
+MAX_FRAMES_AT_ONCE = int(getenv("MAX_FRAMES_AT_ONCE", "60"))
+MAX_CHUNK_BYTES = int(getenv("MAX_CHUNK_BYTES", "65536"))
+# frames of one get_vid response may not be bigger than this, at least one frame is sent
+VID_BATCH_BYTES = int(getenv("VID_BATCH_BYTES", "262144"))
+# seconds between two pings that measure the round trip time of adaptive clients
+RTT_INTERVAL = float(getenv("RTT_INTERVAL", "10"))
+
+# the client needs this many times longer per unit than at its best: it chokes
+CHOKE_FACTOR = 2.0
+# the batch grows while the client spends less than this many round trips per batch
+GROW_BELOW_RTTS = 2.0
+# how fast the best time per unit is forgotten
+BEST_DRIFT = 1.01
+
+
+class AdaptiveBatch:
+    """
+    Batch size of one kind of request of one client.
+    The gap between a response and the next request is a round trip plus the time
+    the client needed for the batch (decoding, playback).
+    Short compared to the round trip: the client mostly waits for us,
+    the batch grows (additive).
+    The time per unit got much worse than the best seen: the client chokes on big
+    batches, the batch is halved (multiplicative).
+    """
+
+    def __init__(self, minimum: int, maximum: int, size: int) -> None:
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.size = min(self.maximum, max(self.minimum, size))
+        self.step = max(1, self.size // 4)
+        self.sent_at: float | None = None
+        self.sent_units = 0
+        self.best_cost: float | None = None
+
+    def next(self, rtt: float | None) -> int:
+        """Returns the size of the next batch, call it when a request arrives"""
+        if self.sent_at is not None and self.sent_units > 0:
+            self.adapt(monotonic() - self.sent_at, rtt)
+        self.sent_at = None
+        return self.size
+
+    def sent(self, units: int) -> None:
+        """Call it when the response leaves, with the units it contains"""
+        self.sent_at = monotonic()
+        self.sent_units = units
+
+    def adapt(self, gap: float, rtt: float | None) -> None:
+        """Adapts the size to the gap between the last response and this request"""
+        client_time = max(0.0, gap - (rtt or 0.0))
+        cost = client_time / self.sent_units
+        if self.best_cost is None or cost < self.best_cost:
+            self.best_cost = cost
+        else:
+            self.best_cost *= BEST_DRIFT
+
+        size = self.size
+        if cost > self.best_cost * CHOKE_FACTOR and client_time > (rtt or 0.0):
+            size = max(self.minimum, size // 2)
+        elif rtt is not None and client_time < rtt * GROW_BELOW_RTTS:
+            size = min(self.maximum, size + self.step)
+        if size != self.size:
+            logger.debug("Batch size %s -> %s (gap %.3fs)", self.size, size, gap)
+            self.size = size
+
+    def report(self) -> dict[str, Any]:
+        """Current state, for the handshake"""
+        return {"min": self.minimum, "max": self.maximum, "size": self.size}
+
+
+def read_limit(limits: dict, key: str, default: int, maximum: int) -> int:
+    """Returns a limit of the handshake, clamped to 1 .. maximum"""
+    value = limits.get(key)
+    if not isinstance(value, int) or isinstance(value, bool):
+        value = default
+    return min(maximum, max(1, value))
+
+
+class ClientBatching:
+    """
+    Batch sizes of one connection.
+    Without limits in the handshake the sizes are fixed,
+    so older clients get the responses they know.
+    """
+
+    def __init__(
+        self, frames: int, chunk_bytes: int, chunk_unit: int, vid_bytes: int
+    ) -> None:
+        self.chunk_unit = chunk_unit
+        self.vid_bytes = vid_bytes
+        self.frames: AdaptiveBatch | None = None
+        self.chunks: AdaptiveBatch | None = None
+        self.default_frames = frames
+        self.default_chunk_bytes = chunk_bytes
+        # round trip time of the web-socket, measured with pings
+        self.rtt: float | None = None
+        self.pinger: Task | None = None
+
+    def configure(self, limits: dict) -> dict[str, Any]:
+        """Applies the limits of a handshake, returns what the server uses"""
+        min_frames = read_limit(limits, "min_frames", 1, MAX_FRAMES_AT_ONCE)
+        max_frames = read_limit(
+            limits, "max_frames", MAX_FRAMES_AT_ONCE, MAX_FRAMES_AT_ONCE
+        )
+        self.frames = AdaptiveBatch(min_frames, max_frames, self.default_frames)
+
+        min_bytes = read_limit(limits, "min_chunk_bytes", 1, MAX_CHUNK_BYTES)
+        max_bytes = read_limit(
+            limits, "max_chunk_bytes", MAX_CHUNK_BYTES, MAX_CHUNK_BYTES
+        )
+        self.chunks = AdaptiveBatch(
+            -(-min_bytes // self.chunk_unit),
+            max_bytes // self.chunk_unit,
+            self.default_chunk_bytes // self.chunk_unit,
+        )
+
+        self.vid_bytes = read_limit(
+            limits, "max_vid_bytes", VID_BATCH_BYTES, VID_BATCH_BYTES
+        )
+        return {
+            "frames": self.frames.report(),
+            # chunk sizes are multiples of chunk_unit bytes,
+            # chunkindex counts units and "chunks" in a response says how many it holds
+            "chunk_unit": self.chunk_unit,
+            "chunks": self.chunks.report(),
+            "max_vid_bytes": self.vid_bytes,
+        }
+
+    def next_frames(self) -> int:
+        """Frames of the next get_vid response"""
+        return self.frames.next(self.rtt) if self.frames else self.default_frames
+
+    def next_chunks(self) -> int:
+        """Chunk units of the next get_chunk response"""
+        return self.chunks.next(self.rtt)
+
+    def start(self, websocket: Websocket) -> None:
+        """Starts measuring the round trip time"""
+        if self.pinger is None:
+            self.pinger = ensure_future(self.measure_rtt(websocket))
+
+    async def measure_rtt(self, websocket: Websocket) -> None:
+        """Pings the client every RTT_INTERVAL seconds"""
+        while True:
+            started = monotonic()
+            try:
+                pong = await websocket.ping()
+                await wait_for(pong, RTT_INTERVAL)
+            # pylint: disable-next=broad-exception-caught
+            except Exception as exc:
+                logger.debug("Ping failed: %r", exc)
+                return
+            self.rtt = monotonic() - started
+            await sleep(RTT_INTERVAL)
+
+    def close(self) -> None:
+        """Stops measuring, the client is gone"""
+        if self.pinger is not None:
+            self.pinger.cancel()
+
+
+def limit_runs(
+    runs: list[tuple[str, int]], max_bytes: int, compact: bool
+) -> list[tuple[str, int]]:
+    """
+    Cuts runs of 32vid lines to the byte budget of a response, keeps at least one line.
+    Repeated lines only cost once if the client gets them compacted.
+    """
+    limited = []
+    size = 0
+    for line, repeats in runs:
+        cost = len(line) + 1
+        if compact:
+            fits = repeats if size + cost <= max_bytes else 0
+        else:
+            fits = min(repeats, max(0, max_bytes - size) // cost)
+        if not limited and fits == 0:
+            fits = repeats if compact else 1
+        if fits == 0:
+            break
+        limited.append((line, fits))
+        size += cost if compact else cost * fits
+        if fits < repeats:
+            break
+    return limited
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Ordered, coalescing outbound message channel of a web-socket
+"""
+
+# Built-in modules
+from asyncio import AbstractEventLoop, Event, get_running_loop
+from collections import deque
+from os import getenv
+from threading import Condition, get_ident
+from time import monotonic
+from typing import Any
+
+# Local modules
+from yc_logging import logger
+
+# optional pip module
+try:
+    from orjson import dumps
+except ModuleNotFoundError:
+    from json import dumps
+
+# pip modules
+from sanic import Websocket
+
+# seconds between two status messages, newer ones replace the waiting one
+STATUS_INTERVAL = float(getenv("STATUS_INTERVAL", "0.25"))
+# messages that may wait for a slow client before producers have to wait
+CHANNEL_QUEUE_SIZE = int(getenv("CHANNEL_QUEUE_SIZE", "32"))
+
+
+class ChannelClosed(Exception):
+    """Raised when sending to a channel of a disconnected client"""
+
+
+class OutboundChannel:
+    """
+    Every message to a web-socket goes through its channel and is sent by one writer task,
+    so messages leave in the order they were posted.
+    Status messages are coalesced: while one waits, a newer one replaces it,
+    and the client gets at most one status every STATUS_INTERVAL seconds.
+    All other messages (responses, errors) are never dropped or reordered,
+    if CHANNEL_QUEUE_SIZE of them wait, the producer has to wait (backpressure).
+    """
+
+    def __init__(
+        self,
+        websocket: Websocket,
+        max_queue: int = CHANNEL_QUEUE_SIZE,
+        status_interval: float = STATUS_INTERVAL,
+    ) -> None:
+        self.websocket = websocket
+        self.loop: AbstractEventLoop = get_running_loop()
+        self.loop_thread = get_ident()
+        self.max_queue = max(1, max_queue)
+        self.status_interval = status_interval
+        # entries are [message, coalesce], so a waiting status can be replaced
+        self.queue: deque[list] = deque()
+        # messages in the queue that are not coalesced
+        self.queued = 0
+        self.lock = Condition()
+        self.wakeup = Event()
+        self.drained = Event()
+        self.last_status = 0.0
+        self.closed = False
+
+    def wake(self) -> None:
+        """Wakes the writer up, from any thread"""
+        if get_ident() == self.loop_thread:
+            self.wakeup.set()
+        else:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def append(self, message: Any, coalesce: bool) -> None:
+        """Adds a message, the lock must be held"""
+        if coalesce and self.queue and self.queue[-1][1]:
+            # the last status was not sent yet, so the client only needs the newer one
+            self.queue[-1][0] = message
+            return
+        self.queue.append([message, coalesce])
+        if not coalesce:
+            self.queued += 1
+
+    def post(self, message: Any, coalesce: bool | None = None) -> None:
+        """
+        Thread-safe, queues a message for the client.
+        Status messages are coalesced by default.
+        Called from another thread, it blocks while the queue is full.
+        """
+        if coalesce is None:
+            coalesce = isinstance(message, dict) and message.get("action") == "status"
+        on_loop = get_ident() == self.loop_thread
+        with self.lock:
+            if self.closed:
+                return
+            if not coalesce and not on_loop:
+                while self.queued >= self.max_queue and not self.closed:
+                    self.lock.wait()
+                if self.closed:
+                    return
+            self.append(message, coalesce)
+        self.wake()
+
+    def offer(self, message: Any, max_queued: int) -> bool:
+        """
+        Queues a message unless max_queued messages already wait, never waits.
+        For broadcasts: a slow client misses messages instead of stalling the sender.
+        """
+        with self.lock:
+            if self.closed or self.queued >= max_queued:
+                return False
+            self.append(message, False)
+        self.wake()
+        return True
+
+    async def send(self, message: Any) -> None:
+        """Queues a message, waits while the queue is full (like Websocket.send)"""
+        while True:
+            with self.lock:
+                if self.closed:
+                    raise ChannelClosed()
+                if self.queued < self.max_queue:
+                    self.append(message, False)
+                    break
+            self.drained.clear()
+            await self.drained.wait()
+        self.wakeup.set()
+
+    def next_message(self) -> tuple[Any, bool, float]:
+        """
+        Returns the next message to send, if it is a status
+        and the seconds to wait if nothing can be sent yet
+        """
+        with self.lock:
+            if not self.queue:
+                return None, False, 0
+            message, coalesce = self.queue[0]
+            if coalesce:
+                wait = self.last_status + self.status_interval - monotonic()
+                # a newer status may still replace it, unless something waits behind it
+                if wait > 0 and len(self.queue) == 1:
+                    return None, True, wait
+            self.queue.popleft()
+            if not coalesce:
+                self.queued -= 1
+                self.lock.notify_all()
+        if not coalesce:
+            self.drained.set()
+        return message, coalesce, 0
+
+    async def run(self) -> None:
+        """Writer task, sends until the channel gets closed"""
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while True:
+                    message, coalesce, wait = self.next_message()
+                    if message is None:
+                        if wait:
+                            self.loop.call_later(wait, self.wakeup.set)
+                        break
+                    if coalesce:
+                        self.last_status = monotonic()
+                    if not isinstance(message, (str, bytes)):
+                        message = dumps(message)
+                    await self.websocket.send(message)
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            logger.debug("Channel writer stopped: %s", exc)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """
+        Drops everything not sent yet and releases waiting producers,
+        must be called from the event loop
+        """
+        with self.lock:
+            self.closed = True
+            self.queue.clear()
+            self.queued = 0
+            self.lock.notify_all()
+        self.drained.set()
+        self.wake()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Checkpoints of running video conversions, so they can be resumed after a restart
+"""
+
+# Built-in modules
+from json import dump, load
+from os import listdir, makedirs, replace
+from os.path import exists, getmtime, isdir, join
+from shutil import rmtree
+from time import time
+from typing import Any, Iterator
+
+# Local modules
+from yc_logging import logger
+from yc_utils import DATA_FOLDER, get_video_name
+
+# optional built-in module (not available on Windows)
+try:
+    from fcntl import LOCK_EX, LOCK_NB, LOCK_UN, flock
+except ModuleNotFoundError:
+    flock = None
+
+JOBS_FOLDER = join(DATA_FOLDER, "jobs")
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = "lock"
+
+
+def get_job_name(media_id: str, width: int, height: int, fps: int | None) -> str:
+    """Returns the folder name of a video conversion job"""
+    name = get_video_name(media_id, width, height)
+    if fps:
+        name += f"@{fps}"
+    return name
+
+
+class JobManifest:
+    """
+    Work folder and manifest of one video conversion job.
+    Everything needed to resume lives in the work folder:
+    the downloaded source, the prepared segments and the converted chunks.
+    """
+
+    def __init__(self, work_dir: str) -> None:
+        self.work_dir = work_dir
+        self.path = join(work_dir, MANIFEST_NAME)
+        self.data: dict[str, Any] = {}
+        self.lock_file = None
+        if exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as file:
+                    self.data = load(file)
+            except (OSError, ValueError) as exc:
+                logger.warning("Ignoring broken job manifest %s: %s", self.path, exc)
+                self.data = {}
+
+    @classmethod
+    def open(
+        cls,
+        media_id: str,
+        width: int,
+        height: int,
+        fps: int | None,
+        url: str,
+    ) -> "JobManifest":
+        """Opens (or creates) the job of the given video"""
+        work_dir = join(JOBS_FOLDER, get_job_name(media_id, width, height, fps))
+        makedirs(work_dir, exist_ok=True)
+        manifest = cls(work_dir)
+        manifest.data.update(
+            {
+                "media_id": media_id,
+                "url": url,
+                "width": width,
+                "height": height,
+                "fps": fps,
+            }
+        )
+        return manifest
+
+    def lock(self) -> bool:
+        """
+        Locks the job against other processes, blocks until the lock is free.
+        Returns False if the job was locked by someone else before.
+        """
+        waited = False
+        if flock is not None:
+            # pylint: disable-next=consider-using-with
+            self.lock_file = open(join(self.work_dir, LOCK_NAME), "w", encoding="utf-8")
+            try:
+                flock(self.lock_file, LOCK_EX | LOCK_NB)
+            except BlockingIOError:
+                flock(self.lock_file, LOCK_EX)
+                waited = True
+        if waited:
+            # the other process may have finished or changed the job in the meantime
+            makedirs(self.work_dir, exist_ok=True)
+            if exists(self.path):
+                with open(self.path, "r", encoding="utf-8") as file:
+                    self.data = {**self.data, **load(file)}
+        self.save()
+        return not waited
+
+    def unlock(self) -> None:
+        """Releases the lock of the job"""
+        if self.lock_file is not None:
+            flock(self.lock_file, LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+    def save(self) -> None:
+        """Writes the manifest atomically"""
+        self.data["updated"] = time()
+        with open(self.path + ".tmp", "w", encoding="utf-8") as file:
+            dump(self.data, file)
+        replace(self.path + ".tmp", self.path)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Returns a value of the manifest"""
+        return self.data.get(key, default)
+
+    def set(self, **values: Any) -> None:
+        """Updates values and saves the manifest"""
+        self.data.update(values)
+        self.save()
+
+    def source(self) -> str | None:
+        """Returns the downloaded source, if it is still there"""
+        source = self.data.get("source")
+        if source and exists(join(self.work_dir, source)):
+            return join(self.work_dir, source)
+        return None
+
+    def sources(self) -> tuple[list[str], list[int | None] | None, int] | None:
+        """
+        Returns the prepared sources, their frame counts and the chunk seconds
+        if all of them are still there
+        """
+        sources = self.data.get("sources")
+        if not sources:
+            return None
+        paths = [join(self.work_dir, source) for source in sources]
+        if not all(exists(path) for path in paths):
+            return None
+        return paths, self.data.get("source_frames"), self.data.get("chunk_seconds", 0)
+
+    def chunk_done(self, idx: int) -> None:
+        """Marks a chunk as converted"""
+        done = set(self.data.get("chunks_done", []))
+        done.add(idx)
+        self.set(chunks_done=sorted(done))
+
+    def remove(self) -> None:
+        """Removes the work folder after the job is finished"""
+        self.unlock()
+        rmtree(self.work_dir, ignore_errors=True)
+
+
+def iter_manifests() -> Iterator[JobManifest]:
+    """Yields the manifests of all unfinished jobs"""
+    if not isdir(JOBS_FOLDER):
+        return
+    for name in listdir(JOBS_FOLDER):
+        work_dir = join(JOBS_FOLDER, name)
+        if exists(join(work_dir, MANIFEST_NAME)):
+            yield JobManifest(work_dir)
+
+
+def remove_stale_jobs(max_age: float) -> None:
+    """Removes work folders that did not change for max_age seconds"""
+    if not isdir(JOBS_FOLDER):
+        return
+    for name in listdir(JOBS_FOLDER):
+        work_dir = join(JOBS_FOLDER, name)
+        manifest = join(work_dir, MANIFEST_NAME)
+        last_change = getmtime(manifest) if exists(manifest) else getmtime(work_dir)
+        if time() - last_change <= max_age or is_locked(work_dir):
+            continue
+        rmtree(work_dir, ignore_errors=True)
+        logger.debug('Deleted stale job "%s"', name)
+
+
+def is_locked(work_dir: str) -> bool:
+    """Returns True if a process is working on the job right now"""
+    lock_path = join(work_dir, LOCK_NAME)
+    if flock is None or not exists(lock_path):
+        return False
+    with open(lock_path, "r", encoding="utf-8") as lock_file:
+        try:
+            flock(lock_file, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            return True
+        flock(lock_file, LOCK_UN)
+    return False
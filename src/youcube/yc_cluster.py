@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cluster mode: every media id has an owner node (consistent hashing),
+nodes fetch finished media from the owner instead of converting it again
+and push what they had to convert themselves to the owner.
+Remote queue workers push their finished media to the front-end the same way.
+"""
+
+# Built-in modules
+from bisect import bisect
+from datetime import datetime
+from hashlib import md5
+from hmac import compare_digest
+from os import getenv, remove, replace, stat, utime
+from os.path import basename, exists, isfile, join
+from shutil import copyfileobj
+from threading import Thread
+from uuid import uuid4
+from urllib.error import HTTPError, URLError
+from urllib.parse import quote, unquote
+from urllib.request import Request as URLRequest
+from urllib.request import urlopen
+
+# Local modules
+from yc_jobs import Job
+from yc_logging import logger
+from yc_preview import NFP_SUFFIX
+from yc_storage import FRAME_INDEX_SUFFIX, frame_index_path
+from yc_tracing import trace_span
+from yc_utils import (
+    AUDIO_FORMAT,
+    DATA_FOLDER,
+    VIDEO_FORMAT,
+    create_data_folder_if_not_present,
+    get_audio_name,
+    get_video_name,
+)
+
+# pip modules
+from sanic import Blueprint, Request
+from sanic.compat import open_async
+from sanic.exceptions import NotFound, PayloadTooLarge, Unauthorized
+from sanic.response import empty, file_stream
+
+# base URLs of all nodes, e.g. "http://10.0.0.1:5000,http://10.0.0.2:5000"
+CLUSTER_NODES = [
+    node.strip().rstrip("/")
+    for node in getenv("CLUSTER_NODES", "").split(",")
+    if node.strip()
+]
+# base URL of this node, as it is written in CLUSTER_NODES
+CLUSTER_SELF = getenv("CLUSTER_SELF", "").strip().rstrip("/")
+# shared secret of the nodes and remote queue workers, without it the peer routes are disabled
+CLUSTER_TOKEN = getenv("CLUSTER_TOKEN")
+CLUSTER_FETCH_TIMEOUT = float(getenv("CLUSTER_FETCH_TIMEOUT", "10"))
+# points per node on the ring, more points spread the media more evenly
+CLUSTER_VNODES = int(getenv("CLUSTER_VNODES", "100"))
+# biggest file a peer may push
+CLUSTER_MAX_UPLOAD_MB = int(getenv("CLUSTER_MAX_UPLOAD_MB", "2048"))
+
+# the frame index of a 32vid is only valid for the mtime of the video, so it is sent along
+MTIME_HEADER = "X-Mtime-Ns"
+
+cluster = Blueprint("cluster")
+
+
+def ring_hash(key: str) -> int:
+    """Position of a key on the ring"""
+    return int.from_bytes(md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring, adding or removing a node
+    only moves the media of that node
+    """
+
+    def __init__(self, nodes: list[str], vnodes: int = CLUSTER_VNODES) -> None:
+        self.points = sorted(
+            (ring_hash(f"{node}#{number}"), node)
+            for node in nodes
+            for number in range(max(1, vnodes))
+        )
+        self.hashes = [point[0] for point in self.points]
+
+    def owner(self, key: str) -> str | None:
+        """Returns the node that owns the key"""
+        if not self.points:
+            return None
+        index = bisect(self.hashes, ring_hash(key)) % len(self.points)
+        return self.points[index][1]
+
+
+ring = HashRing(CLUSTER_NODES)
+
+
+def cluster_enabled() -> bool:
+    """Returns True if this node is part of a cluster"""
+    return bool(CLUSTER_SELF and len(CLUSTER_NODES) > 1)
+
+
+def owner_of(media_id: str) -> str | None:
+    """Returns the owner of a media id, None if it's this node or there is no cluster"""
+    if not cluster_enabled():
+        return None
+    owner = ring.owner(media_id)
+    return None if owner == CLUSTER_SELF else owner
+
+
+def peer_request(node: str, file_name: str, **kwargs) -> URLRequest:
+    """Request for the cache route of a node"""
+    request = URLRequest(f"{node}/cache/{quote(file_name)}", **kwargs)
+    if CLUSTER_TOKEN:
+        request.add_header("Authorization", f"Bearer {CLUSTER_TOKEN}")
+    return request
+
+
+def set_mtime(path: str, mtime: str | None) -> None:
+    """Gives a received file the mtime it has on the peer"""
+    if mtime and mtime.isdigit():
+        utime(path, ns=(int(mtime), int(mtime)))
+
+
+def fetch_file(node: str, file_name: str) -> bool:
+    """Downloads a finished media file from a node, returns True on success"""
+    request = peer_request(node, file_name)
+    path = join(DATA_FOLDER, file_name)
+    part = path + ".peer"
+    try:
+        with urlopen(request, timeout=CLUSTER_FETCH_TIMEOUT) as response:
+            with open(part, "wb") as file:
+                copyfileobj(response, file)
+            set_mtime(part, response.headers.get(MTIME_HEADER))
+        replace(part, path)
+    except HTTPError as exc:
+        if exc.code != 404:
+            logger.warning("Fetching %s from %s failed: %s", file_name, node, exc)
+        return False
+    except (URLError, OSError) as exc:
+        logger.warning("Fetching %s from %s failed: %s", file_name, node, exc)
+        return False
+    finally:
+        if exists(part):
+            remove(part)
+    return True
+
+
+def fetch_from_owner(
+    media_id: str, width: int | None, height: int | None, resp: Job
+) -> None:
+    """
+    Fetches the audio (and video) of a media from its owner,
+    if they are missing here and the owner has them
+    """
+    owner = owner_of(media_id)
+    if owner is None:
+        return
+    wanted = [get_audio_name(media_id)]
+    if width and height:
+        wanted.append(get_video_name(media_id, width, height))
+    missing = [name for name in wanted if not exists(join(DATA_FOLDER, name))]
+    if not missing:
+        return
+
+    resp.post({"action": "status", "message": "Fetching from cluster ..."})
+    create_data_folder_if_not_present()
+    with trace_span("cluster.fetch", owner=owner):
+        for file_name in missing:
+            if fetch_file(owner, file_name):
+                logger.info("Fetched %s from %s", file_name, owner)
+                if file_name.endswith(f".{VIDEO_FORMAT}"):
+                    # saves a scan of the video, it is rebuilt if the owner has none
+                    fetch_file(owner, frame_index_path(file_name))
+
+
+def push_file(node: str, file_name: str) -> bool:
+    """Uploads a finished media file to a node, returns True on success"""
+    path = join(DATA_FOLDER, file_name)
+    try:
+        with open(path, "rb") as file:
+            request = peer_request(node, file_name, data=file, method="PUT")
+            request.add_header("Content-Length", str(stat(path).st_size))
+            request.add_header(MTIME_HEADER, str(stat(path).st_mtime_ns))
+            with urlopen(request, timeout=CLUSTER_FETCH_TIMEOUT):
+                pass
+    except (URLError, OSError) as exc:
+        logger.warning("Pushing %s to %s failed: %s", file_name, node, exc)
+        return False
+    return True
+
+
+def push_files(node: str, file_names: list[str]) -> bool:
+    """Pushes files to a node, a video with its frame index. True if all arrived"""
+    pushed = True
+    with trace_span("cluster.push", owner=node):
+        for file_name in file_names:
+            if not push_file(node, file_name):
+                pushed = False
+                continue
+            logger.info("Pushed %s to %s", file_name, node)
+            index_name = frame_index_path(file_name)
+            if file_name.endswith(f".{VIDEO_FORMAT}") and exists(
+                join(DATA_FOLDER, index_name)
+            ):
+                pushed = push_file(node, index_name) and pushed
+    return pushed
+
+
+def push_to_owner(media_id: str, file_names: list[str]) -> None:
+    """
+    Gives the owner of a media the files this node converted,
+    so the other nodes fetch them instead of converting them again.
+    Runs in the background, the client doesn't wait for it.
+    """
+    owner = owner_of(media_id)
+    if owner is None or not file_names:
+        return
+    Thread(target=push_files, args=(owner, file_names), daemon=True).start()
+
+
+def is_cache_file(file_name: str) -> bool:
+    """Only finished media, frame indexes and previews are exchanged with peers"""
+    return basename(file_name) == file_name and file_name.endswith(
+        (
+            f".{AUDIO_FORMAT}",
+            f".{VIDEO_FORMAT}",
+            frame_index_path(f".{VIDEO_FORMAT}"),
+            NFP_SUFFIX,
+        )
+    )
+
+
+def check_token(request: Request) -> None:
+    """Peers and remote queue workers must send the cluster token"""
+    if not CLUSTER_TOKEN:
+        raise NotFound("Peer routes need a CLUSTER_TOKEN")
+    if not compare_digest((request.token or "").encode(), CLUSTER_TOKEN.encode()):
+        raise Unauthorized("Invalid cluster token")
+
+
+def check_peer(request: Request) -> str:
+    """Returns the file name of a cache request of a peer"""
+    # without a cluster, remote queue workers push files
+    check_token(request)
+    # video names contain brackets, sanic keeps them escaped
+    file_name = unquote(request.match_info["file_name"])
+    if not is_cache_file(file_name):
+        raise NotFound("Not cached")
+    return file_name
+
+
+def use_file(request: Request, file_name: str) -> None:
+    """The file is still in use, so the data cache cleaner keeps it"""
+    if not file_name.endswith(FRAME_INDEX_SUFFIX):
+        # the cleaner removes a frame index with its video
+        request.app.shared_ctx.data[file_name] = datetime.now()
+
+
+@cluster.route("/cache/<file_name:str>")
+async def serve_cache(request: Request, file_name: str):
+    """Serves a finished media file to the other nodes"""
+    file_name = check_peer(request)
+    path = join(DATA_FOLDER, file_name)
+    if not isfile(path):
+        raise NotFound("Not cached")
+    use_file(request, file_name)
+    return await file_stream(path, headers={MTIME_HEADER: str(stat(path).st_mtime_ns)})
+
+
+@cluster.route("/cache/<file_name:str>", methods=["PUT"], stream=True)
+async def receive_cache(request: Request, file_name: str):
+    """Stores a media file that another node converted for this owner"""
+    file_name = check_peer(request)
+    path = join(DATA_FOLDER, file_name)
+    if exists(path):
+        # converted here or pushed by another node meanwhile,
+        # its frame index belongs to the file that is here
+        return empty(status=200)
+    max_size = CLUSTER_MAX_UPLOAD_MB * 1024 * 1024
+    length = request.headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > max_size:
+        raise PayloadTooLarge(
+            f"Files of peers are limited to {CLUSTER_MAX_UPLOAD_MB} MB"
+        )
+    create_data_folder_if_not_present()
+    part = f"{path}.{uuid4().hex}.peer"
+    size = 0
+    try:
+        async with await open_async(part, "wb") as file:
+            while (body := await request.stream.read()) is not None:
+                size += len(body)
+                if size > max_size:
+                    raise PayloadTooLarge(
+                        f"Files of peers are limited to {CLUSTER_MAX_UPLOAD_MB} MB"
+                    )
+                await file.write(body)
+        set_mtime(part, request.headers.get(MTIME_HEADER))
+        replace(part, path)
+    finally:
+        if exists(part):
+            remove(part)
+    use_file(request, file_name)
+    return empty(status=201)
@@ -6,25 +6,44 @@ Download Functionality of YC
 """
 
 # Built-in modules
-from asyncio import run_coroutine_threadsafe
 import sys
-from os import getenv, listdir
-from os.path import abspath, dirname, join
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import getenv, listdir, remove, replace
+from os.path import basename, dirname, exists, join
+from concurrent.futures import as_completed, wait
 from math import ceil
 from os import cpu_count
 from threading import Thread
 from subprocess import PIPE, run
+from contextlib import ExitStack
+from contextvars import copy_context
 import re
 from tempfile import TemporaryDirectory
+from typing import Callable
+from uuid import uuid4
 import json as json_std
 
 # Local modules
+from yc_checkpoint import LOCK_NAME, MANIFEST_NAME, JobManifest, iter_manifests
+from yc_cluster import fetch_from_owner, push_to_owner
 from yc_colours import RESET, Foreground
+from yc_jobs import Job, JobCancelled
 from yc_logging import NO_COLOR, YTDLPLogger, logger
 from yc_magic import run_with_live_output
+from yc_pool import conversion_pool
+from yc_preview import (
+    PREVIEWS,
+    get_frame_name,
+    get_nfp_name,
+    load_preview,
+    nfp_size,
+    preview_files,
+    rgb_to_nfp,
+)
 from yc_spotify import SpotifyURLProcessor
+from yc_storage import store_video
+from yc_tracing import set_span_attributes, trace_span
 from yc_utils import (
+    DATA_FOLDER,
     cap_width_and_height,
     create_data_folder_if_not_present,
     get_audio_name,
@@ -35,17 +54,6 @@ from yc_utils import (
     remove_whitespace,
 )
 
-# optional pip modules
-try:
-    from orjson import dumps
-except ModuleNotFoundError:
-    from json import dumps
-
-# pip modules
-from sanic import Websocket
-from yt_dlp import YoutubeDL
-from yt_dlp.utils import DownloadError
-
 # pylint settings
 # pylint: disable=pointless-string-statement
 # pylint: disable=fixme
@@ -53,7 +61,6 @@ from yt_dlp.utils import DownloadError
 # pylint: disable=too-many-arguments
 # pylint: disable=too-many-branches
 
-DATA_FOLDER = join(dirname(abspath(__file__)), "data")
 FFMPEG_PATH = getenv("FFMPEG_PATH", "ffmpeg")
 FFPROBE_PATH = getenv("FFPROBE_PATH", "ffprobe")
 SANJUUNI_PATH = getenv("SANJUUNI_PATH", "sanjuuni")
@@ -88,6 +95,12 @@ SANJUUNI_VALIDATE_FRAMES = getenv("SANJUUNI_VALIDATE_FRAMES", "false").lower() i
 )
 
 
+def remove_if_exists(path: str) -> None:
+    """Removes a file, if it exists"""
+    if exists(path):
+        remove(path)
+
+
 def get_format_selectors(is_video: bool) -> tuple[str, str]:
     """
     Return (primary, fallback) format selectors.
@@ -119,12 +132,23 @@ def is_hls_error(exc: Exception) -> bool:
     return any(token in str(exc).lower() for token in HLS_RETRY_ERRORS)
 
 
+def is_work_artifact(file_name: str) -> bool:
+    """Returns True for files of the work folder that are not downloads"""
+    return file_name in (MANIFEST_NAME, LOCK_NAME, MANIFEST_NAME + ".tmp") or any(
+        marker in file_name for marker in (".seg", ".copyseg", ".chunk", ".prepared")
+    )
+
+
 def select_source_file(temp_dir: str, media_id: str, prefer_video: bool) -> str | None:
     """
     Pick a deterministic source file from a yt-dlp download directory.
     Prefer merged files (id.ext) over fragment-specific files (id.f123.ext).
     """
-    files = [f for f in listdir(temp_dir) if not f.endswith(".part")]
+    files = [
+        f
+        for f in listdir(temp_dir)
+        if not f.endswith(".part") and not is_work_artifact(f)
+    ]
     if not files:
         return None
 
@@ -145,27 +169,23 @@ def select_source_file(temp_dir: str, media_id: str, prefer_video: bool) -> str
     return join(temp_dir, files[0])
 
 
+@trace_span("convert.video")
 def download_video(
     source_file: str,
     media_id: str,
-    resp: Websocket,
-    loop,
+    resp: Job,
     width: int,
     height: int,
 ):
     """
     Converts the downloaded video to 32vid
     """
-    run_coroutine_threadsafe(
-        resp.send(
-            dumps({"action": "status", "message": "Converting video to 32vid ..."})
-        ),
-        loop,
-    )
+    resp.post({"action": "status", "message": "Converting video to 32vid ..."})
 
     def handler(_line):
         pass
 
+    out_file = join(DATA_FOLDER, get_video_name(media_id, width, height))
     returncode = run_with_live_output(
         [
             SANJUUNI_PATH,
@@ -175,40 +195,37 @@ def download_video(
             source_file,
             "--raw",
             "-o",
-            join(DATA_FOLDER, get_video_name(media_id, width, height)),
+            out_file + ".part",
             "--disable-opencl" if DISABLE_OPENCL else "",
         ],
         handler,
+        resp,
     )
 
     if returncode != 0:
+        remove_if_exists(out_file + ".part")
+        if resp.is_cancelled():
+            return
         logger.warning("Sanjuuni exited with %s", returncode)
-        run_coroutine_threadsafe(
-            resp.send(dumps({"action": "error", "message": "Faild to convert video!"})),
-            loop,
-        )
+        resp.post({"action": "error", "message": "Faild to convert video!"})
     else:
-        run_coroutine_threadsafe(
-            resp.send(dumps({"action": "status", "message": "Video conversion done."})),
-            loop,
-        )
+        store_video(out_file + ".part", out_file)
+        resp.post({"action": "status", "message": "Video conversion done."})
 
 
+@trace_span("convert.chunk")
 def convert_video_chunk(
     source_file: str,
     out_file: str,
-    resp: Websocket,
-    loop,
+    resp: Job,
     width: int,
     height: int,
     chunk_index: int,
     chunk_total: int,
 ):
+    set_span_attributes(chunk=chunk_index, chunks=chunk_total, width=width, height=height)
     message = f"Converting chunk {chunk_index}/{chunk_total} ..."
-    run_coroutine_threadsafe(
-        resp.send(dumps({"action": "status", "message": message})),
-        loop,
-    )
+    resp.post({"action": "status", "message": message})
 
     def handler(_line):
         pass
@@ -222,39 +239,121 @@ def convert_video_chunk(
             source_file,
             "--raw",
             "-o",
-            out_file,
+            out_file + ".part",
             "--disable-opencl" if DISABLE_OPENCL else "",
         ],
         handler,
+        resp,
     )
 
     if returncode != 0:
+        remove_if_exists(out_file + ".part")
+        resp.raise_if_cancelled()
         logger.warning("Sanjuuni exited with %s", returncode)
         raise RuntimeError("Sanjuuni failed")
+    # only complete chunks exist under their real name, so they can be resumed
+    replace(out_file + ".part", out_file)
     logger.info("Chunk %s/%s done", chunk_index, chunk_total)
-    run_coroutine_threadsafe(
-        resp.send(
-            dumps(
-                {
-                    "action": "status",
-                    "message": f"Chunk {chunk_index}/{chunk_total} done",
-                }
-            )
-        ),
-        loop,
+    resp.post(
+        {
+            "action": "status",
+            "message": f"Chunk {chunk_index}/{chunk_total} done",
+        }
     )
 
 
-def download_audio(source_file: str, media_id: str, resp: Websocket, loop):
+@trace_span("convert.preview")
+def render_preview(
+    source: str, media_id: str, width: int | None, height: int | None, resp: Job
+) -> None:
+    """
+    Renders the preview of a media from a thumbnail or a video file and posts it,
+    a failure only costs the preview
+    """
+    nfp_width, nfp_height = nfp_size(width, height)
+
+    def handler(line):
+        logger.debug("[Preview] %s", line)
+
+    with TemporaryDirectory(prefix="youcube-preview-") as temp_dir:
+        image = join(temp_dir, "preview.png")
+        pixels = join(temp_dir, "preview.rgb")
+        # the first frame, thumbnails are often webp and sanjuuni reads png everywhere
+        returncode = run_with_live_output(
+            [FFMPEG_PATH, "-y", "-i", source, "-frames:v", "1", image], handler, resp
+        )
+        if returncode == 0:
+            returncode = run_with_live_output(
+                [
+                    FFMPEG_PATH,
+                    "-y",
+                    "-i",
+                    image,
+                    "-vf",
+                    f"scale={nfp_width}:{nfp_height}",
+                    "-f",
+                    "rawvideo",
+                    "-pix_fmt",
+                    "rgb24",
+                    pixels,
+                ],
+                handler,
+                resp,
+            )
+        if returncode != 0:
+            if not resp.is_cancelled():
+                logger.warning(
+                    "Preview of %s failed, FFmpeg exited with %s", media_id, returncode
+                )
+            return
+
+        nfp_file = join(DATA_FOLDER, get_nfp_name(media_id, nfp_width, nfp_height))
+        with open(pixels, "rb") as file:
+            data = file.read()
+        if len(data) != nfp_width * nfp_height * 3:
+            logger.warning("Preview of %s failed, FFmpeg returned no image", media_id)
+            return
+        nfp = rgb_to_nfp(data, nfp_width, nfp_height)
+        with open(nfp_file + ".part", "w", encoding="utf-8") as file:
+            file.write(nfp)
+        replace(nfp_file + ".part", nfp_file)
+
+        if width is not None and height is not None:
+            frame_file = join(DATA_FOLDER, get_frame_name(media_id, width, height))
+            returncode = run_with_live_output(
+                [
+                    SANJUUNI_PATH,
+                    "--width=" + str(width),
+                    "--height=" + str(height),
+                    "-i",
+                    image,
+                    "--raw",
+                    "-o",
+                    frame_file + ".part",
+                    "--disable-opencl" if DISABLE_OPENCL else "",
+                ],
+                handler,
+                resp,
+            )
+            if returncode == 0:
+                replace(frame_file + ".part", frame_file)
+            else:
+                remove_if_exists(frame_file + ".part")
+                logger.warning(
+                    "Preview frame of %s failed, Sanjuuni exited with %s",
+                    media_id,
+                    returncode,
+                )
+
+    resp.post(load_preview(media_id, width, height))
+
+
+@trace_span("convert.audio")
+def download_audio(source_file: str, media_id: str, resp: Job):
     """
     Converts the downloaded audio to dfpwm
     """
-    run_coroutine_threadsafe(
-        resp.send(
-            dumps({"action": "status", "message": "Converting audio to dfpwm ..."})
-        ),
-        loop,
-    )
+    resp.post({"action": "status", "message": "Converting audio to dfpwm ..."})
 
     if NO_COLOR:
         prefix = "[FFmpeg]"
@@ -265,9 +364,11 @@ def download_audio(source_file: str, media_id: str, resp: Websocket, loop):
         logger.debug("%s%s", prefix, line)
         # TODO: send message to resp
 
+    out_file = join(DATA_FOLDER, get_audio_name(media_id))
     returncode = run_with_live_output(
         [
             FFMPEG_PATH,
+            "-y",
             "-i",
             source_file,
             "-f",
@@ -276,34 +377,193 @@ def download_audio(source_file: str, media_id: str, resp: Websocket, loop):
             "48000",
             "-ac",
             "1",
-            join(DATA_FOLDER, get_audio_name(media_id)),
+            out_file + ".part",
         ],
         handler,
+        resp,
     )
 
     if returncode != 0:
+        remove_if_exists(out_file + ".part")
+        if resp.is_cancelled():
+            return
         logger.warning("FFmpeg exited with %s", returncode)
-        run_coroutine_threadsafe(
-            resp.send(dumps({"action": "error", "message": "Faild to convert audio!"})),
-            loop,
+        resp.post({"action": "error", "message": "Faild to convert audio!"})
+    else:
+        replace(out_file + ".part", out_file)
+
+
+def ffprobe_keyframes(path: str) -> list[float] | None:
+    """
+    Returns the timestamps of all video keyframes.
+    Only reads packet headers, so no frame has to be decoded.
+    """
+    cmd = [
+        FFPROBE_PATH,
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+        path,
+    ]
+    try:
+        result = run(cmd, stdout=PIPE, stderr=PIPE, text=True, check=False)
+    except Exception as exc:
+        logger.warning("ffprobe failed to start: %s", exc)
+        return None
+
+    if result.returncode != 0:
+        logger.warning("ffprobe keyframes failed (%s): %s", result.returncode, result.stderr)
+        return None
+
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" not in flags:
+            continue
+        try:
+            keyframes.append(float(pts_time))
+        except ValueError:
+            continue
+    keyframes.sort()
+    return keyframes
+
+
+def choose_segment_times(keyframes: list[float], chunk_seconds: int) -> list[float]:
+    """
+    Picks cut points from the keyframe list,
+    every cut is the first keyframe at least chunk_seconds after the previous cut
+    """
+    if not keyframes:
+        return []
+    times = []
+    last_cut = keyframes[0]
+    for keyframe in keyframes:
+        if keyframe - last_cut >= chunk_seconds:
+            times.append(keyframe)
+            last_cut = keyframe
+    return times
+
+
+def segment_frame_counts(
+    segment_times: list[float],
+    frame_rate: float,
+    duration: float | None,
+    start: float = 0.0,
+) -> list[int | None]:
+    """
+    Returns the exact frame count of every segment.
+    start is the time of the first keyframe, streams don't have to start at 0.
+    The count of the last segment is only known if the duration is known.
+    """
+    bounds = [start, *segment_times]
+    counts = [
+        round(end * frame_rate) - round(start * frame_rate)
+        for start, end in zip(bounds, bounds[1:])
+    ]
+    if duration:
+        counts.append(
+            max(round((start + duration) * frame_rate) - round(bounds[-1] * frame_rate), 0)
+        )
+    else:
+        counts.append(None)
+    return counts
+
+
+def split_on_keyframes(
+    source_file: str,
+    media_id: str,
+    chunk_seconds: int,
+    frame_rate: float,
+    duration: float | None,
+    handler: Callable[[str], None],
+    job: Job | None = None,
+) -> tuple[list[str], list[int | None]] | None:
+    """
+    Cuts the video into segments on existing keyframes using stream copy.
+    Returns (segments, frame counts per segment) or None if that is not possible.
+    """
+    keyframes = ffprobe_keyframes(source_file)
+    if not keyframes:
+        return None
+
+    segment_times = choose_segment_times(keyframes, chunk_seconds)
+    if not segment_times:
+        return [source_file], segment_frame_counts(
+            segment_times, frame_rate, duration, keyframes[0]
+        )
+
+    out_dir = dirname(source_file)
+    cmd = [
+        FFMPEG_PATH,
+        "-y",
+        "-i",
+        source_file,
+        "-map",
+        "0:v:0",
+        "-an",
+        "-sn",
+        "-dn",
+        "-c:v",
+        "copy",
+        "-f",
+        "segment",
+        "-reset_timestamps",
+        "1",
+        # cut slightly before each keyframe, so rounding can't push the cut to the next one
+        "-segment_times",
+        ",".join(f"{max(time - 0.001, 0):.6f}" for time in segment_times),
+    ]
+    cmd.append(join(out_dir, f"{media_id}.copyseg%03d.mkv"))
+
+    returncode = run_with_live_output(cmd, handler, job)
+    segments = sorted(
+        join(out_dir, f)
+        for f in listdir(out_dir)
+        if f.startswith(f"{media_id}.copyseg") and f.endswith(".mkv")
+    )
+    if returncode != 0 or len(segments) != len(segment_times) + 1:
+        logger.warning(
+            "Keyframe split failed (exit=%s, segments=%s, expected=%s)",
+            returncode,
+            len(segments),
+            len(segment_times) + 1,
         )
+        for segment in segments:
+            remove(segment)
+        return None
+
+    return segments, segment_frame_counts(
+        segment_times, frame_rate, duration, keyframes[0]
+    )
 
 
+@trace_span("prepare")
 def prepare_video_sources(
     source_file: str,
     media_id: str,
-    resp: Websocket,
-    loop,
+    resp: Job,
     fps: int | None,
     chunk_seconds: int,
     source_fps: float | None,
-) -> list[str]:
+    duration: float | None = None,
+) -> tuple[list[str], list[int | None] | None]:
     """
     Optionally downsample and/or split the video into chunks.
-    Returns list of source files (one or many) for sanjuuni.
+    Returns list of source files (one or many) for sanjuuni
+    and, if known, the exact frame count of every source.
     """
     if (fps is None or fps <= 0) and chunk_seconds <= 0:
-        return [source_file]
+        return [source_file], None
+
+    # Only re-encode if the frame rate actually changes
+    needs_fps_conversion = bool(fps and fps > 0) and not (
+        source_fps and abs(fps - source_fps) < 0.01
+    )
 
     status_parts = []
     if fps and fps > 0:
@@ -311,16 +571,11 @@ def prepare_video_sources(
     if chunk_seconds > 0:
         status_parts.append(f"{chunk_seconds}s chunks")
 
-    run_coroutine_threadsafe(
-        resp.send(
-            dumps(
-                {
-                    "action": "status",
-                    "message": "Preparing video (" + ", ".join(status_parts) + ") ...",
-                }
-            )
-        ),
-        loop,
+    resp.post(
+        {
+            "action": "status",
+            "message": "Preparing video (" + ", ".join(status_parts) + ") ...",
+        }
     )
 
     if NO_COLOR:
@@ -331,6 +586,20 @@ def prepare_video_sources(
     def handler(line):
         logger.debug("%s%s", prefix, line)
 
+    if not needs_fps_conversion:
+        if chunk_seconds <= 0:
+            return [source_file], None
+        if source_fps and source_fps > 0:
+            split = split_on_keyframes(
+                source_file, media_id, chunk_seconds, source_fps, duration, handler, resp
+            )
+            if split:
+                logger.info("Split video on keyframes into %s segments", len(split[0]))
+                set_span_attributes(method="copy", segments=len(split[0]))
+                return split
+        resp.raise_if_cancelled()
+        logger.info("Falling back to re-encoding for segmentation")
+
     out_dir = dirname(source_file)
 
     if chunk_seconds > 0:
@@ -353,6 +622,7 @@ def prepare_video_sources(
         "-i",
         source_file,
     ]
+    set_span_attributes(method="libx264", fps=effective_fps, chunk_seconds=chunk_seconds)
     if effective_fps:
         cmd += ["-vf", f"fps={effective_fps}"]
     cmd += [
@@ -381,13 +651,14 @@ def prepare_video_sources(
         ]
     cmd.append(out_pattern)
 
-    returncode = run_with_live_output(cmd, handler)
+    returncode = run_with_live_output(cmd, handler, resp)
     if returncode != 0:
+        resp.raise_if_cancelled()
         logger.warning("FFmpeg prepare exited with %s", returncode)
-        return [source_file]
+        return [source_file], None
 
     if chunk_seconds <= 0:
-        return [out_pattern]
+        return [out_pattern], None
 
     segments = [
         join(out_dir, f)
@@ -395,7 +666,7 @@ def prepare_video_sources(
         if f.startswith(f"{media_id}.seg") and f.endswith(".mp4")
     ]
     segments.sort()
-    return segments
+    return segments, None
 
 
 def parse_fps_line(line: str) -> float | None:
@@ -517,133 +788,166 @@ def log_frame_validation(
             )
 
 
-def merge_32vid_chunks(
-    chunk_files: list[str],
-    out_file: str,
-    resp: Websocket,
-    loop,
-    chunk_seconds: int,
-    expected_duration: float | None,
-    expected_fps: float | None,
-) -> tuple[int, float | None]:
-    run_coroutine_threadsafe(
-        resp.send(
-            dumps(
-                {
-                    "action": "status",
-                    "message": "Merging video chunks ...",
-                }
-            )
-        ),
-        loop,
-    )
-
-    if not chunk_files:
-        raise RuntimeError("No 32vid chunks to merge")
+class ChunkMerger:
+    """
+    Merges 32vid chunks into the final output in order.
+    Chunks can be handed over as soon as they are converted,
+    every chunk is appended once it and all earlier chunks are done.
+    """
 
-    logger.info("Merging %s chunks into %s", len(chunk_files), out_file)
-    print(f"[YouCube] Merging {len(chunk_files)} chunks into {out_file}", flush=True)
-    run_coroutine_threadsafe(
-        resp.send(
-            dumps(
-                {
-                    "action": "status",
-                    "message": f"Merging {len(chunk_files)} chunks ...",
-                }
-            )
-        ),
-        loop,
-    )
-    with open(out_file, "w", encoding="utf-8") as out_f:
-        first = True
-        total_written = 0
-        fps_value = expected_fps
-        total_expected = None
+    def __init__(
+        self,
+        chunk_files: list[str],
+        out_file: str,
+        resp: Job,
+        chunk_seconds: int,
+        expected_duration: float | None,
+        expected_fps: float | None,
+        chunk_frames: list[int | None] | None = None,
+    ) -> None:
+        if not chunk_files:
+            raise RuntimeError("No 32vid chunks to merge")
+
+        self.chunk_files = chunk_files
+        self.out_file = out_file
+        self.part_file = out_file + ".part"
+        self.resp = resp
+        self.chunk_seconds = chunk_seconds
+        # exact frame counts are known for segments cut on keyframes,
+        # those don't start with a duplicated frame either
+        self.chunk_frames = chunk_frames
+        self.skip_first_frame = SANJUUNI_MERGE_SKIP_FIRST_FRAME and not chunk_frames
+        self.expected_duration = expected_duration
+        self.fps_value = expected_fps
+        self.total_expected = None
         if expected_duration and expected_fps and expected_fps > 0:
-            total_expected = round(expected_duration * expected_fps)
-        for idx, chunk in enumerate(chunk_files, start=1):
-            with open(chunk, "r", encoding="utf-8") as in_f:
-                if first:
-                    header = in_f.readline()
-                    fps_line = in_f.readline()
-                    out_f.write(header)
-                    out_f.write(fps_line)
-                    file_fps = parse_fps_line(fps_line)
-                    if not fps_value:
-                        fps_value = file_fps
-                    elif file_fps and abs(file_fps - fps_value) > 0.01:
-                        logger.warning(
-                            "Chunk fps %.3f differs from expected %.3f",
-                            file_fps,
-                            fps_value,
-                        )
-                    if expected_duration and fps_value and fps_value > 0:
-                        total_expected = round(expected_duration * fps_value)
-                    first = False
-                else:
-                    # skip header and fps line
-                    in_f.readline()
-                    in_f.readline()
-
-                expected_frames = None
-                if fps_value and fps_value > 0:
-                    if total_expected is not None and idx == len(chunk_files):
-                        expected_frames = max(total_expected - total_written, 0)
-                    elif chunk_seconds > 0:
-                        expected_frames = round(chunk_seconds * fps_value)
-
-                skipped_first = False
-                last_frame = None
-                chunk_written = 0
-                for line in in_f:
-                    if not line or line == "\n":
-                        continue
-                    if SANJUUNI_MERGE_SKIP_FIRST_FRAME and idx > 1 and not skipped_first:
-                        skipped_first = True
-                        continue
-                    if expected_frames is not None and chunk_written >= expected_frames:
-                        continue
-                    out_f.write(line)
-                    total_written += 1
-                    chunk_written += 1
-                    last_frame = line
-
-                if expected_frames is not None and last_frame:
-                    while chunk_written < expected_frames:
-                        out_f.write(last_frame)
-                        total_written += 1
-                        chunk_written += 1
-            logger.info("Merged chunk %s/%s", idx, len(chunk_files))
-            print(f"[YouCube] Merged chunk {idx}/{len(chunk_files)}", flush=True)
-            run_coroutine_threadsafe(
-                resp.send(
-                    dumps(
-                        {
-                            "action": "status",
-                            "message": f"Merged chunk {idx}/{len(chunk_files)}",
-                        }
+            self.total_expected = round(expected_duration * expected_fps)
+        self.total_written = 0
+        self.next_index = 1
+        self.done = set()
+        self.out_f = None
+
+        logger.info("Merging %s chunks into %s", len(chunk_files), out_file)
+        print(f"[YouCube] Merging {len(chunk_files)} chunks into {out_file}", flush=True)
+        self.send_status(f"Merging {len(chunk_files)} chunks ...")
+
+    def send_status(self, message: str) -> None:
+        """Sends a status message to the client"""
+        self.resp.post({"action": "status", "message": message})
+
+    def chunk_done(self, idx: int) -> None:
+        """
+        Marks the chunk with the given (1-based) index as converted
+        and appends every chunk that is now ready
+        """
+        self.done.add(idx)
+        while self.next_index in self.done:
+            self.append_chunk(self.next_index)
+            self.done.discard(self.next_index)
+            self.next_index += 1
+
+    @trace_span("merge.chunk")
+    def append_chunk(self, idx: int) -> None:
+        """Appends one chunk to the output, padding or cutting it to the expected frames"""
+        set_span_attributes(chunk=idx)
+        if self.out_f is None:
+            # pylint: disable-next=consider-using-with
+            self.out_f = open(self.part_file, "w", encoding="utf-8")
+
+        with open(self.chunk_files[idx - 1], "r", encoding="utf-8") as in_f:
+            if idx == 1:
+                header = in_f.readline()
+                fps_line = in_f.readline()
+                self.out_f.write(header)
+                self.out_f.write(fps_line)
+                file_fps = parse_fps_line(fps_line)
+                if not self.fps_value:
+                    self.fps_value = file_fps
+                elif file_fps and abs(file_fps - self.fps_value) > 0.01:
+                    logger.warning(
+                        "Chunk fps %.3f differs from expected %.3f",
+                        file_fps,
+                        self.fps_value,
                     )
-                ),
-                loop,
+                if self.expected_duration and self.fps_value and self.fps_value > 0:
+                    self.total_expected = round(self.expected_duration * self.fps_value)
+            else:
+                # skip header and fps line
+                in_f.readline()
+                in_f.readline()
+
+            expected_frames = None
+            if self.chunk_frames and self.chunk_frames[idx - 1] is not None:
+                expected_frames = self.chunk_frames[idx - 1]
+            elif self.fps_value and self.fps_value > 0:
+                if self.total_expected is not None and idx == len(self.chunk_files):
+                    expected_frames = max(self.total_expected - self.total_written, 0)
+                elif self.chunk_seconds > 0 and not self.chunk_frames:
+                    expected_frames = round(self.chunk_seconds * self.fps_value)
+
+            skipped_first = False
+            last_frame = None
+            chunk_written = 0
+            for line in in_f:
+                if not line or line == "\n":
+                    continue
+                if self.skip_first_frame and idx > 1 and not skipped_first:
+                    skipped_first = True
+                    continue
+                if expected_frames is not None and chunk_written >= expected_frames:
+                    continue
+                self.out_f.write(line)
+                self.total_written += 1
+                chunk_written += 1
+                last_frame = line
+
+            if expected_frames is not None and last_frame:
+                while chunk_written < expected_frames:
+                    self.out_f.write(last_frame)
+                    self.total_written += 1
+                    chunk_written += 1
+
+        logger.info("Merged chunk %s/%s", idx, len(self.chunk_files))
+        print(f"[YouCube] Merged chunk {idx}/{len(self.chunk_files)}", flush=True)
+        self.send_status(f"Merged chunk {idx}/{len(self.chunk_files)}")
+
+    @trace_span("merge.finish")
+    def finish(self) -> tuple[int, float | None]:
+        """
+        Finishes the merge after all chunks are done
+        and moves the merged file to its final location
+        """
+        if self.next_index <= len(self.chunk_files):
+            raise RuntimeError(
+                f"Merge incomplete: chunk {self.next_index}/{len(self.chunk_files)} missing"
             )
-    logger.info(
-        "Merge complete: %s (frames=%s, fps=%s, expected=%s)",
-        out_file,
-        total_written,
-        fps_value,
-        total_expected,
-    )
-    print(f"[YouCube] Merge complete: {out_file}", flush=True)
-    run_coroutine_threadsafe(
-        resp.send(dumps({"action": "status", "message": "Merge complete"})), loop
-    )
-    return total_written, fps_value
+        self.out_f.close()
+        self.out_f = None
+        store_video(self.part_file, self.out_file)
+
+        logger.info(
+            "Merge complete: %s (frames=%s, fps=%s, expected=%s)",
+            self.out_file,
+            self.total_written,
+            self.fps_value,
+            self.total_expected,
+        )
+        print(f"[YouCube] Merge complete: {self.out_file}", flush=True)
+        self.send_status("Merge complete")
+        return self.total_written, self.fps_value
 
+    def abort(self) -> None:
+        """Discards the partially merged file"""
+        if self.out_f is not None:
+            self.out_f.close()
+            self.out_f = None
+        remove_if_exists(self.part_file)
 
+
+@trace_span("download")
 def download(
     url: str,
-    resp: Websocket,
-    loop,
+    resp: Job,
     width: int,
     height: int,
     fps: int | None,
@@ -651,8 +955,16 @@ def download(
 ) -> (dict[str, any], list):
     """
     Downloads and converts the media from the give URL
+    Raises JobCancelled if the job got cancelled while running
     """
 
+    # yt-dlp is the slowest import of the server, only load it once it is needed
+    # pylint: disable-next=import-outside-toplevel
+    from yt_dlp import YoutubeDL
+
+    # pylint: disable-next=import-outside-toplevel
+    from yt_dlp.utils import DownloadCancelled, DownloadError
+
     is_video = width is not None and height is not None
     target_fps = None
     if fps is not None:
@@ -664,27 +976,24 @@ def download(
     # cap height and width
     if width and height:
         width, height = cap_width_and_height(width, height)
+    set_span_attributes(url=url, width=width, height=height, fps=target_fps)
 
     def my_hook(info):
         """https://github.com/yt-dlp/yt-dlp#adding-logger-and-progress-hook"""
+        if resp.is_cancelled():
+            raise DownloadCancelled("Job cancelled")
         if info.get("status") == "downloading":
-            run_coroutine_threadsafe(
-                resp.send(
-                    dumps(
-                        {
-                            "action": "status",
-                            "message": remove_ansi_escape_codes(
-                                f"download {remove_whitespace(info.get('_percent_str'))} "
-                                f"ETA {info.get('_eta_str')}"
-                            ),
-                        }
-                    )
-                ),
-                loop,
+            resp.post(
+                {
+                    "action": "status",
+                    "message": remove_ansi_escape_codes(
+                        f"download {remove_whitespace(info.get('_percent_str'))} "
+                        f"ETA {info.get('_eta_str')}"
+                    ),
+                }
             )
 
-    # FIXME: Cleanup on Exception
-    with TemporaryDirectory(prefix="youcube-") as temp_dir:
+    with TemporaryDirectory(prefix="youcube-") as temp_dir, ExitStack() as cleanup:
         primary_format, fallback_format = get_format_selectors(is_video)
         yt_dl_options = {
             "format": primary_format,
@@ -708,14 +1017,7 @@ def download(
 
         yt_dl = YoutubeDL(yt_dl_options)
 
-        run_coroutine_threadsafe(
-            resp.send(
-                dumps(
-                    {"action": "status", "message": "Getting resource information ..."}
-                )
-            ),
-            loop,
-        )
+        resp.post({"action": "status", "message": "Getting resource information ..."})
 
         playlist_videos = []
 
@@ -730,7 +1032,8 @@ def download(
                 else:
                     url = processed_url
 
-        data = yt_dl.extract_info(url, download=False)
+        with trace_span("extract_info"):
+            data = yt_dl.extract_info(url, download=False)
 
         if data.get("extractor") == "generic":
             data["id"] = "g" + data.get("webpage_url_domain") + data.get("id")
@@ -755,35 +1058,95 @@ def download(
         if data.get("extractor") == "youtube" and (
             data.get("view_count") is None or data.get("like_count") is None
         ):
-            data = yt_dl.extract_info(data.get("id"), download=False)
+            with trace_span("extract_info", flat=True):
+                data = yt_dl.extract_info(data.get("id"), download=False)
+
+        resp.raise_if_cancelled()
 
         media_id = data.get("id")
         duration = data.get("duration")
+        set_span_attributes(media_id=media_id, duration=duration)
 
         if data.get("is_live"):
-            return {"action": "error", "message": "Livestreams are not supported"}
+            return {"action": "error", "message": "Livestreams are not supported"}, []
 
         create_data_folder_if_not_present()
 
+        # the owner node of a cluster may have converted it already
+        fetch_from_owner(media_id, width if is_video else None, height, resp)
         audio_downloaded = is_audio_already_downloaded(media_id)
         video_downloaded = is_video_already_downloaded(media_id, width, height)
 
-        if not audio_downloaded or (not video_downloaded and is_video):
-            run_coroutine_threadsafe(
-                resp.send(
-                    dumps({"action": "status", "message": "Downloading resource ..."})
+        # something to show on the monitor while a conversion runs
+        preview_width, preview_height = (width, height) if is_video else (None, None)
+
+        def start_preview(source: str) -> None:
+            thread = Thread(
+                target=copy_context().run,
+                args=(
+                    render_preview,
+                    source,
+                    media_id,
+                    preview_width,
+                    preview_height,
+                    resp,
                 ),
-                loop,
             )
+            thread.start()
+            cleanup.callback(thread.join)
+
+        preview_from_download = False
+        if PREVIEWS and (not audio_downloaded or (is_video and not video_downloaded)):
+            preview = load_preview(media_id, preview_width, preview_height)
+            if preview:
+                resp.post(preview)
+            elif data.get("thumbnail"):
+                start_preview(data["thumbnail"])
+            else:
+                # without a thumbnail, the first frame of the download is used
+                preview_from_download = True
+
+        # video conversions work in a persistent folder, so they can be resumed
+        work_dir = temp_dir
+        manifest = None
+        resumed_source = None
+        if is_video and not video_downloaded:
+            manifest = JobManifest.open(
+                media_id, width, height, target_fps, data.get("webpage_url") or url
+            )
+            cleanup.callback(manifest.unlock)
+            if not manifest.lock():
+                resp.post(
+                    {
+                        "action": "status",
+                        "message": "Waiting for running conversion ...",
+                    }
+                )
+                audio_downloaded = is_audio_already_downloaded(media_id)
+                video_downloaded = is_video_already_downloaded(media_id, width, height)
+            work_dir = manifest.work_dir
+            resumed_source = manifest.source()
+            if resumed_source:
+                logger.info("Resuming job %s", work_dir)
+            elif work_dir != temp_dir:
+                yt_dl_options["outtmpl"] = join(work_dir, "%(id)s.%(ext)s")
+                yt_dl = YoutubeDL(yt_dl_options)
+
+        if not resumed_source and (
+            not audio_downloaded or (not video_downloaded and is_video)
+        ):
+            resp.post({"action": "status", "message": "Downloading resource ..."})
 
             def send_download_error(message: str):
-                run_coroutine_threadsafe(
-                    resp.send(dumps({"action": "error", "message": message})), loop
-                )
+                resp.post({"action": "error", "message": message})
 
             try:
-                yt_dl.process_ie_result(data, download=True)
+                with trace_span("download.attempt", attempt="primary", format=primary_format):
+                    yt_dl.process_ie_result(data, download=True)
+            except DownloadCancelled as exc:
+                raise JobCancelled(media_id) from exc
             except DownloadError as exc:
+                resp.raise_if_cancelled()
                 logger.warning(
                     "Primary download failed (%s). Retrying with fallback format.",
                     exc,
@@ -792,8 +1155,14 @@ def download(
                     yt_dl_fallback = YoutubeDL(
                         {**yt_dl_options, "format": fallback_format}
                     )
-                    yt_dl_fallback.process_ie_result(data, download=True)
+                    with trace_span(
+                        "download.attempt", attempt="fallback", format=fallback_format
+                    ):
+                        yt_dl_fallback.process_ie_result(data, download=True)
+                except DownloadCancelled as exc2:
+                    raise JobCancelled(media_id) from exc2
                 except DownloadError as exc2:
+                    resp.raise_if_cancelled()
                     if is_hls_error(exc2):
                         logger.warning(
                             "Fallback download failed with HLS errors (%s). "
@@ -810,8 +1179,14 @@ def download(
                                     "external_downloader_args": ["-loglevel", "error"],
                                 }
                             )
-                            yt_dl_hls.process_ie_result(data, download=True)
+                            with trace_span(
+                                "download.attempt", attempt="ffmpeg", format=fallback_format
+                            ):
+                                yt_dl_hls.process_ie_result(data, download=True)
+                        except DownloadCancelled as exc3:
+                            raise JobCancelled(media_id) from exc3
                         except DownloadError as exc3:
+                            resp.raise_if_cancelled()
                             logger.warning(
                                 "Final download attempt failed (%s).", exc3
                             )
@@ -825,39 +1200,46 @@ def download(
                         )
                         raise
 
+            if manifest:
+                source = select_source_file(work_dir, media_id, prefer_video=True)
+                if source:
+                    manifest.set(source=basename(source))
+
+        if preview_from_download:
+            source = resumed_source or select_source_file(
+                work_dir, media_id, prefer_video=True
+            )
+            if source:
+                start_preview(source)
+
         # TODO: Thread audio & video download
 
         audio_thread = None
         video_thread = None
 
         if not audio_downloaded:
-            audio_source = select_source_file(temp_dir, media_id, prefer_video=False)
+            audio_source = resumed_source or select_source_file(
+                work_dir, media_id, prefer_video=False
+            )
             if audio_source is None:
                 logger.warning("Audio source file not found")
-                run_coroutine_threadsafe(
-                    resp.send(
-                        dumps({"action": "error", "message": "Audio download failed."})
-                    ),
-                    loop,
-                )
+                resp.post({"action": "error", "message": "Audio download failed."})
             else:
                 from threading import Thread
 
                 audio_thread = Thread(
-                    target=download_audio, args=(audio_source, media_id, resp, loop)
+                    target=copy_context().run,
+                    args=(download_audio, audio_source, media_id, resp),
                 )
                 audio_thread.start()
 
         if not video_downloaded and is_video:
-            video_source = select_source_file(temp_dir, media_id, prefer_video=True)
+            video_source = resumed_source or select_source_file(
+                work_dir, media_id, prefer_video=True
+            )
             if video_source is None:
                 logger.warning("Video source file not found")
-                run_coroutine_threadsafe(
-                    resp.send(
-                        dumps({"action": "error", "message": "Video download failed."})
-                    ),
-                    loop,
-                )
+                resp.post({"action": "error", "message": "Video download failed."})
             else:
                 chunk_seconds = SANJUUNI_CHUNK_SECONDS
                 workers = SANJUUNI_WORKERS
@@ -879,68 +1261,141 @@ def download(
                             SANJUUNI_MIN_WORKERS,
                             min(SANJUUNI_MAX_WORKERS, ceil(chunks / 2)),
                         )
+                        # don't claim more than our share of the shared pool
+                        workers = min(workers, conversion_pool.fair_share())
+                    set_span_attributes(workers=workers, chunk_seconds=chunk_seconds)
                     logger.info(
-                        "Auto-scale video: duration=%ss chunk_seconds=%s workers=%s",
+                        "Auto-scale video: duration=%ss chunk_seconds=%s workers=%s "
+                        "pool_load=%.2f",
                         duration,
                         chunk_seconds,
                         workers,
+                        conversion_pool.load(),
                     )
 
-                sources = prepare_video_sources(
-                    video_source,
-                    media_id,
-                    resp,
-                    loop,
-                    target_fps,
-                    chunk_seconds,
-                    data.get("fps"),
-                )
+                prepared = manifest.sources() if manifest else None
+                if prepared:
+                    sources, source_frames, chunk_seconds = prepared
+                else:
+                    sources, source_frames = prepare_video_sources(
+                        video_source,
+                        media_id,
+                        resp,
+                        target_fps,
+                        chunk_seconds,
+                        data.get("fps"),
+                        duration,
+                    )
+                    if manifest:
+                        manifest.set(
+                            sources=[basename(source) for source in sources],
+                            source_frames=source_frames,
+                            chunk_seconds=chunk_seconds,
+                        )
+
+                job_id = f"{media_id}({width}x{height})-{uuid4().hex[:8]}"
+                conversion_pool.register_job(job_id, workers)
+                resp.track_pool_job(job_id)
+                if conversion_pool.load() >= 1:
+                    resp.post(
+                        {
+                            "action": "status",
+                            "message": "Waiting for a free converter ...",
+                        }
+                    )
 
                 def run_single():
-                    download_video(sources[0], media_id, resp, loop, width, height)
+                    try:
+                        conversion_pool.submit(
+                            job_id,
+                            1,
+                            download_video,
+                            sources[0],
+                            media_id,
+                            resp,
+                            width,
+                            height,
+                        ).result()
+                    finally:
+                        conversion_pool.unregister_job(job_id)
 
                 if len(sources) <= 1 and chunk_seconds <= 0:
-                    video_thread = Thread(target=run_single)
+                    video_thread = Thread(target=copy_context().run, args=(run_single,))
                     video_thread.start()
                 else:
+                    @trace_span(
+                        "convert.parallel",
+                        media_id=media_id,
+                        width=width,
+                        height=height,
+                        fps=target_fps,
+                        workers=workers,
+                        chunks=len(sources),
+                    )
                     def run_parallel():
+                        chunk_outputs = [
+                            join(work_dir, f"{media_id}.chunk{idx:03d}.32vid")
+                            for idx in range(1, len(sources) + 1)
+                        ]
+                        merger = None
+                        futures = {}
                         try:
-                            chunk_outputs = []
-                            with ThreadPoolExecutor(max_workers=workers) as executor:
-                                futures = []
-                                for idx, source in enumerate(sources, start=1):
-                                    out_file = join(
-                                        temp_dir,
-                                        f"{media_id}.chunk{idx:03d}.32vid",
-                                    )
-                                    chunk_outputs.append(out_file)
-                                    futures.append(
-                                        executor.submit(
-                                            convert_video_chunk,
-                                            source,
-                                            out_file,
-                                            resp,
-                                            loop,
-                                            width,
-                                            height,
-                                            idx,
-                                            len(sources),
-                                        )
-                                    )
-                                for future in as_completed(futures):
-                                    future.result()
-
-                            merged_frames, merged_fps = merge_32vid_chunks(
+                            merger = ChunkMerger(
                                 chunk_outputs,
                                 join(
                                     DATA_FOLDER, get_video_name(media_id, width, height)
                                 ),
                                 resp,
-                                loop,
                                 chunk_seconds,
                                 duration,
                                 target_fps,
+                                source_frames,
                             )
+                            # chunks of an earlier run are only merged
+                            done = [
+                                idx
+                                for idx, out_file in enumerate(chunk_outputs, start=1)
+                                if exists(out_file)
+                            ]
+                            if done:
+                                resp.post(
+                                    {
+                                        "action": "status",
+                                        "message": "Resuming conversion "
+                                        f"({len(done)}/{len(sources)} chunks done) ...",
+                                    }
+                                )
+                            for idx in done:
+                                merger.chunk_done(idx)
+                            conversion_pool.set_head(job_id, merger.next_index)
+
+                            for idx, (source, out_file) in enumerate(
+                                zip(sources, chunk_outputs), start=1
+                            ):
+                                if idx in done:
+                                    continue
+                                future = conversion_pool.submit(
+                                    job_id,
+                                    idx,
+                                    convert_video_chunk,
+                                    source,
+                                    out_file,
+                                    resp,
+                                    width,
+                                    height,
+                                    idx,
+                                    len(sources),
+                                )
+                                futures[future] = idx
+                            # merge every chunk as soon as all earlier chunks are done,
+                            # while later chunks are still converting
+                            for future in as_completed(futures):
+                                future.result()
+                                manifest.chunk_done(futures[future])
+                                merger.chunk_done(futures[future])
+                                conversion_pool.set_head(job_id, merger.next_index)
+
+                            merged_frames, merged_fps = merger.finish()
                             if SANJUUNI_VALIDATE_FRAMES:
                                 log_frame_validation(
                                     video_source,
@@ -950,20 +1405,23 @@ def download(
                                     target_fps,
                                 )
                         except Exception as exc:
+                            conversion_pool.unregister_job(job_id)
+                            wait(futures)
+                            if merger:
+                                merger.abort()
+                            if resp.is_cancelled():
+                                return
                             logger.warning("Parallel video conversion failed: %s", exc)
-                            run_coroutine_threadsafe(
-                                resp.send(
-                                    dumps(
-                                        {
-                                            "action": "error",
-                                            "message": "Video conversion failed.",
-                                        }
-                                    )
-                                ),
-                                loop,
+                            resp.post(
+                                {
+                                    "action": "error",
+                                    "message": "Video conversion failed.",
+                                }
                             )
+                        finally:
+                            conversion_pool.unregister_job(job_id)
 
-                    video_thread = Thread(target=run_parallel)
+                    video_thread = Thread(target=copy_context().run, args=(run_parallel,))
                     video_thread.start()
 
         if audio_thread:
@@ -971,6 +1429,25 @@ def download(
         if video_thread:
             video_thread.join()
 
+        # the temporary directory is removed while the exception propagates,
+        # the work folder is kept, so the job can be resumed
+        resp.raise_if_cancelled()
+
+        if manifest and is_video_already_downloaded(media_id, width, height):
+            manifest.remove()
+
+        # the owner node keeps what this node converted, so the others don't convert it again
+        converted = []
+        if not audio_downloaded and is_audio_already_downloaded(media_id):
+            converted.append(get_audio_name(media_id))
+        if (
+            is_video
+            and not video_downloaded
+            and is_video_already_downloaded(media_id, width, height)
+        ):
+            converted.append(get_video_name(media_id, width, height))
+        push_to_owner(media_id, converted)
+
     out = {
         "action": "media",
         "id": media_id,
@@ -995,5 +1472,68 @@ def download(
     files.append(get_audio_name(media_id))
     if is_video:
         files.append(get_video_name(media_id, width, height))
+    if PREVIEWS:
+        files += preview_files(
+            media_id, width if is_video else None, height if is_video else None
+        )
 
     return out, files
+
+
+def resume_jobs(conversion_slots=None, conversion_running=None) -> None:
+    """
+    Resumes all unfinished video conversions as background jobs.
+    Meant to run in its own process, right after the server started.
+    """
+    if conversion_slots is not None:
+        conversion_pool.attach_shared(conversion_slots, conversion_running)
+
+    # pylint: disable-next=import-outside-toplevel
+    from yt_dlp.utils import DownloadError
+
+    for manifest in list(iter_manifests()):
+        url = manifest.get("url")
+        if not url or is_video_already_downloaded(
+            manifest.get("media_id"), manifest.get("width"), manifest.get("height")
+        ):
+            continue
+        if manifest.get("resume_failed"):
+            # a broken checkpoint, a client request still tries it, the cleaner removes it
+            logger.debug("Not resuming failed job %s", manifest.work_dir)
+            continue
+        logger.info("Resuming unfinished job %s", manifest.work_dir)
+        job = Job(manifest.work_dir)
+        job.demote()
+        try:
+            download(
+                url,
+                job,
+                manifest.get("width"),
+                manifest.get("height"),
+                manifest.get("fps"),
+                None,
+            )
+        except (JobCancelled, DownloadError) as exc:
+            # the server stopped or the source is unavailable, tried again on the next start
+            logger.warning("Resuming %s failed: %s", manifest.work_dir, exc)
+        # one broken checkpoint must not stop the others from resuming
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            logger.exception("Resuming %s failed", manifest.work_dir)
+            try:
+                manifest.set(resume_failed=str(exc) or type(exc).__name__)
+            except OSError as save_exc:
+                logger.warning("Could not mark %s as failed: %s", manifest.work_dir, save_exc)
+
+
+def warm_up() -> None:
+    """
+    Imports yt-dlp and loads its extractors,
+    so the first download of a worker does not have to wait for it
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from yt_dlp import YoutubeDL
+
+    with YoutubeDL({"logger": YTDLPLogger()}) as yt_dl:
+        yt_dl.get_info_extractor("Youtube")
+    logger.debug("Warm-up done")
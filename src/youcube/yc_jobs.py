@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Jobs tie downloads / conversions to the web-sockets waiting for them
+"""
+
+# Built-in modules
+from asyncio import Future, ensure_future, shield
+from os import getenv
+from subprocess import Popen
+from threading import Event, Lock
+from typing import Any, Coroutine, Hashable
+
+# Local modules
+from yc_channel import OutboundChannel
+from yc_logging import logger
+from yc_magic import terminate_process
+from yc_pool import conversion_pool
+
+DEMOTE_ORPHANED_JOBS = getenv("DEMOTE_ORPHANED_JOBS", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job, after the last interested client is gone"""
+
+
+class Job:
+    """
+    A download / conversion and the clients that are waiting for it.
+    Has the same "post" method as an OutboundChannel, so it can be used as status sink:
+    every message is posted to the channels of all attached clients.
+    """
+
+    def __init__(self, key: Hashable) -> None:
+        self.key = key
+        self.channels: set[OutboundChannel] = set()
+        self.cancelled = Event()
+        self.background = False
+        self.lock = Lock()
+        self.processes: set[Popen] = set()
+        self.pool_jobs: set[str] = set()
+        self.result: Future | None = None
+
+    def post(self, message: dict) -> None:
+        """
+        Thread-safe, posts a message to all attached clients.
+        Status messages are coalesced, others may block while a client is too slow.
+        """
+        for channel in list(self.channels):
+            channel.post(message)
+
+    def attach(self, channel: OutboundChannel) -> None:
+        """Adds an interested client"""
+        self.channels.add(channel)
+        if self.background:
+            self.background = False
+            for pool_job in list(self.pool_jobs):
+                conversion_pool.set_background(pool_job, False)
+
+    def detach(self, channel: OutboundChannel) -> bool:
+        """Removes a client, returns True if nobody is interested anymore"""
+        self.channels.discard(channel)
+        return not self.channels
+
+    def track_process(self, process: Popen) -> None:
+        """Registers a child process, so it can be terminated on cancel"""
+        with self.lock:
+            self.processes.add(process)
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            terminate_process(process)
+
+    def untrack_process(self, process: Popen) -> None:
+        """Removes a finished child process"""
+        with self.lock:
+            self.processes.discard(process)
+
+    def track_pool_job(self, pool_job: str) -> None:
+        """Registers a job of the conversion pool"""
+        self.pool_jobs.add(pool_job)
+        if self.background:
+            conversion_pool.set_background(pool_job, True)
+
+    def is_cancelled(self) -> bool:
+        """Returns True if the job got cancelled"""
+        return self.cancelled.is_set()
+
+    def raise_if_cancelled(self) -> None:
+        """Raises JobCancelled if the job got cancelled"""
+        if self.cancelled.is_set():
+            raise JobCancelled(str(self.key))
+
+    def cancel(self) -> None:
+        """Stops the job: drops queued conversions and terminates all child processes"""
+        logger.info("Cancelling job %s", self.key)
+        with self.lock:
+            self.cancelled.set()
+            processes = list(self.processes)
+        for pool_job in list(self.pool_jobs):
+            conversion_pool.unregister_job(pool_job)
+        for process in processes:
+            terminate_process(process)
+
+    def demote(self) -> None:
+        """Lets the job finish as low priority background job"""
+        logger.info("Demoting job %s to background", self.key)
+        self.background = True
+        for pool_job in list(self.pool_jobs):
+            conversion_pool.set_background(pool_job, True)
+
+
+class JobRegistry:
+    """All running jobs of this process"""
+
+    def __init__(self) -> None:
+        self.jobs: dict[Hashable, Job] = {}
+
+    def get_or_create(
+        self, key: Hashable, channel: OutboundChannel
+    ) -> tuple[Job, bool]:
+        """
+        Returns the running job for key or a new one,
+        the second value is True if the job is new
+        """
+        job = self.jobs.get(key)
+        created = job is None or job.is_cancelled()
+        if created:
+            job = Job(key)
+            self.jobs[key] = job
+        job.attach(channel)
+        return job, created
+
+    def running(self, key: Hashable) -> bool:
+        """Returns True if a job for key runs, clients can join it"""
+        job = self.jobs.get(key)
+        return job is not None and not job.is_cancelled()
+
+    def start(self, job: Job, coroutine: Coroutine) -> None:
+        """Runs the coroutine of a new job"""
+        job.result = ensure_future(coroutine)
+
+        def done(result: Future):
+            self.finish(job)
+            # also retrieves the exception, if every waiting client is gone
+            if not result.cancelled() and result.exception() is not None:
+                logger.debug("Job %s ended with %r", job.key, result.exception())
+
+        job.result.add_done_callback(done)
+
+    async def wait(self, job: Job) -> Any:
+        """Waits for the result of a job, without cancelling it for other clients"""
+        return await shield(job.result)
+
+    def finish(self, job: Job) -> None:
+        """Removes a finished job"""
+        if self.jobs.get(job.key) is job:
+            del self.jobs[job.key]
+
+    def release(self, channel: OutboundChannel, keep: Job | None = None) -> None:
+        """
+        The client is no longer interested in its jobs (disconnect or skip).
+        Jobs that nobody waits for anymore are cancelled or demoted.
+        """
+        for job in list(self.jobs.values()):
+            if job is keep or channel not in job.channels:
+                continue
+            if job.detach(channel):
+                if DEMOTE_ORPHANED_JOBS:
+                    job.demote()
+                else:
+                    job.cancel()
+                    self.finish(job)
+
+
+jobs = JobRegistry()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Rate limits (token buckets per connection and per IP) and admission control.
+Playback requests (chunks, frames) and new media jobs have their own buckets,
+so a client that is throttled for starting downloads can still play.
+A rate of 0 disables a limit.
+All limits are kept per sanic worker, so the limit of an IP is its rate times the workers.
+"""
+
+# Built-in modules
+from os import getenv
+from time import monotonic
+from typing import Any
+
+# Local modules
+from yc_pool import conversion_pool
+
+# requests per second and burst size, per connection
+PLAYBACK_RATE = float(getenv("PLAYBACK_RATE", "20"))
+PLAYBACK_BURST = float(getenv("PLAYBACK_BURST", "40"))
+MEDIA_RATE = float(getenv("MEDIA_RATE", "0.2"))
+MEDIA_BURST = float(getenv("MEDIA_BURST", "5"))
+# per IP, for all connections of an IP to one worker together
+# (all computers of a Minecraft server share its IP)
+IP_PLAYBACK_RATE = float(getenv("IP_PLAYBACK_RATE", "200"))
+IP_PLAYBACK_BURST = float(getenv("IP_PLAYBACK_BURST", "400"))
+IP_MEDIA_RATE = float(getenv("IP_MEDIA_RATE", "1"))
+IP_MEDIA_BURST = float(getenv("IP_MEDIA_BURST", "20"))
+# new jobs are refused above this load of the conversion pool (running and queued tasks
+# per converter) or with this many jobs in the worker, 0 disables the check
+MAX_POOL_LOAD = float(getenv("MAX_POOL_LOAD", "4"))
+MAX_JOBS = int(getenv("MAX_JOBS", "0"))
+# seconds a refused client should wait
+ADMISSION_RETRY_AFTER = float(getenv("ADMISSION_RETRY_AFTER", "10"))
+
+PLAYBACK_ACTIONS = frozenset({"get_chunk", "get_vid", "get_av", "seek", "get_preview"})
+MEDIA_ACTIONS = frozenset({"request_media"})
+# buckets of IPs without requests for this many seconds are forgotten
+IP_IDLE_SECONDS = 600.0
+
+
+class TokenBucket:
+    """Allows rate requests per second on average and bursts of burst requests"""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = monotonic()
+
+    def wait(self) -> float:
+        """Returns 0 if a token is available, else the seconds until one is"""
+        if self.rate <= 0:
+            return 0.0
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self) -> float:
+        """Takes a token, returns 0 or the seconds until one is available"""
+        wait = self.wait()
+        if not wait and self.rate > 0:
+            self.tokens -= 1
+        return wait
+
+
+class Buckets:
+    """The playback and the media bucket of a connection or an IP"""
+
+    def __init__(
+        self,
+        playback_rate: float,
+        playback_burst: float,
+        media_rate: float,
+        media_burst: float,
+    ) -> None:
+        self.playback = TokenBucket(playback_rate, playback_burst)
+        self.media = TokenBucket(media_rate, media_burst)
+
+    def get(self, action: str) -> TokenBucket | None:
+        """The bucket of the action, None for actions without limit"""
+        if action in PLAYBACK_ACTIONS:
+            return self.playback
+        if action in MEDIA_ACTIONS:
+            return self.media
+        return None
+
+
+# IP -> buckets of all its connections
+ip_buckets: dict[str, Buckets] = {}
+# pylint: disable-next=invalid-name
+ip_buckets_pruned = monotonic()
+
+
+def get_ip_buckets(ip: str) -> Buckets:
+    """Returns the buckets of an IP, forgets idle IPs now and then"""
+    # pylint: disable-next=global-statement
+    global ip_buckets_pruned
+    now = monotonic()
+    if now - ip_buckets_pruned > IP_IDLE_SECONDS:
+        ip_buckets_pruned = now
+        for idle in [
+            key
+            for key, buckets in ip_buckets.items()
+            if now - max(buckets.playback.updated, buckets.media.updated)
+            > IP_IDLE_SECONDS
+        ]:
+            del ip_buckets[idle]
+    buckets = ip_buckets.get(ip)
+    if buckets is None:
+        buckets = Buckets(
+            IP_PLAYBACK_RATE, IP_PLAYBACK_BURST, IP_MEDIA_RATE, IP_MEDIA_BURST
+        )
+        ip_buckets[ip] = buckets
+    return buckets
+
+
+class ConnectionLimits:
+    """Rate limits of one web-socket, together with the limits of its IP"""
+
+    def __init__(self, ip: str) -> None:
+        self.ip = ip
+        self.buckets = Buckets(PLAYBACK_RATE, PLAYBACK_BURST, MEDIA_RATE, MEDIA_BURST)
+
+    def check(self, action: str) -> dict[str, Any] | None:
+        """Returns None if the action may run, else the error for the client"""
+        own = self.buckets.get(action)
+        if own is None:
+            return None
+        shared = get_ip_buckets(self.ip).get(action)
+        # a refused request takes no token from either bucket
+        if wait := max(own.wait(), shared.wait()):
+            return too_many_requests(wait)
+        own.take()
+        shared.take()
+        return None
+
+
+def too_many_requests(
+    wait: float, message: str = "Too many requests"
+) -> dict[str, Any]:
+    """Error response of a refused request"""
+    return {
+        "action": "error",
+        "message": f"{message}, retry in {wait:.1f}s",
+        "retry_after": round(wait, 3),
+    }
+
+
+def admit_job(running_jobs: int) -> dict[str, Any] | None:
+    """
+    Admission control of new jobs: returns None if one can start,
+    else the error for the client. Playback and jobs that already run are not affected.
+    """
+    if MAX_JOBS > 0 and running_jobs >= MAX_JOBS:
+        return too_many_requests(ADMISSION_RETRY_AFTER, "The server is busy")
+    if MAX_POOL_LOAD > 0 and conversion_pool.load() >= MAX_POOL_LOAD:
+        return too_many_requests(ADMISSION_RETRY_AFTER, "The server is busy")
+    return None
@@ -44,10 +44,15 @@ class ColordFormatter(Formatter):
             ERROR: f"{Foreground.BRIGHT_RED}{self.fmt}{RESET}",
             CRITICAL: f"{Foreground.RED}{self.fmt}{RESET}",
         }
+        # build the formatters once, not for every record
+        self.formatters = {
+            level: Formatter(log_fmt, datefmt=self.datefmt)
+            for level, log_fmt in self.formats.items()
+        }
+        self.default_formatter = Formatter(None, datefmt=self.datefmt)
 
     def format(self, record: LogRecord) -> str:
-        log_fmt = self.formats.get(record.levelno)
-        formatter = Formatter(log_fmt, datefmt=self.datefmt)
+        formatter = self.formatters.get(record.levelno, self.default_formatter)
         return formatter.format(record)
 
 
@@ -6,8 +6,8 @@ Black Magic with threads, asyncio and subprocesses
 """
 
 # Built-in modules
-from asyncio import Event
-from subprocess import PIPE, Popen
+from asyncio import Event, get_running_loop
+from subprocess import PIPE, Popen, TimeoutExpired
 from sys import settrace
 from threading import Thread
 from types import FrameType
@@ -22,14 +22,15 @@ class ThreadSaveAsyncioEventWithReturnValue(Event):
     def __init__(self) -> None:
         super().__init__()
         self.result = None
+        self.exception = None
+        # must be created inside the loop, the thread may finish before anyone waits
+        self.loop = get_running_loop()
 
     # pylint: disable-next=fixme
     # TODO: clear() method
 
     def set(self):
-        # pylint: disable-next=fixme
-        # FIXME: The _loop attribute is not documented as public api!
-        self._loop.call_soon_threadsafe(super().set)
+        self.loop.call_soon_threadsafe(super().set)
 
 
 def run_with_thread_save_asyncio_event_with_return_value(
@@ -39,8 +40,11 @@ def run_with_thread_save_asyncio_event_with_return_value(
     Runs a function and calls a ThreadSaveAsyncioEventWithReturnValue
     This function is meant to run in a thread
     """
-    result = func(*args)
-    event.result = result
+    try:
+        event.result = func(*args)
+    # pylint: disable-next=broad-exception-caught
+    except BaseException as exc:
+        event.exception = exc
     event.set()
 
 
@@ -49,6 +53,7 @@ async def run_function_in_thread_from_async_function(
 ) -> object:
     """
     Runs a function in a thread from an async function
+    Exceptions of the function are raised in the calling coroutine
     """
     event = ThreadSaveAsyncioEventWithReturnValue()
     Thread(
@@ -56,6 +61,8 @@ async def run_function_in_thread_from_async_function(
         args=(event, func, *args),
     ).start()
     await event.wait()
+    if event.exception is not None:
+        raise event.exception
     return event.result
 
 
@@ -103,11 +110,32 @@ class KillableThread(Thread):
         self.killed = True
 
 
-def run_with_live_output(cmd: list, handler: Callable[[str], None]) -> int:
+def terminate_process(process: Popen, timeout: float = 5) -> None:
+    """
+    Terminates a subprocess and kills it, if it does not exit within timeout seconds
+    Does not block the caller
+    """
+    if process.poll() is not None:
+        return
+    process.terminate()
+
+    def kill_if_alive():
+        try:
+            process.wait(timeout)
+        except TimeoutExpired:
+            process.kill()
+
+    Thread(target=kill_if_alive, daemon=True).start()
+
+
+def run_with_live_output(cmd: list, handler: Callable[[str], None], job=None) -> int:
     """
     Runs a subprocess and allows handling output live
+    If a job is given, the process is terminated when the job is cancelled
     """
     with Popen(cmd, stdout=PIPE, stderr=PIPE) as process:
+        if job is not None:
+            job.track_process(process)
 
         def live_output():
             line = []
@@ -125,6 +153,8 @@ def run_with_live_output(cmd: list, handler: Callable[[str], None]) -> int:
 
         process.wait()
         thread.kill()
+        if job is not None:
+            job.untrack_process(process)
 
         return process.returncode
 
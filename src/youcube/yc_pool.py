@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Process-wide pool for sanjuuni conversions
+"""
+
+# Built-in modules
+from concurrent.futures import Future
+from contextvars import copy_context
+from itertools import count
+from math import ceil
+from os import cpu_count, getenv
+from threading import BoundedSemaphore, Condition, Thread
+from time import time_ns
+from typing import Any, Callable
+
+# Local modules
+from yc_logging import logger
+from yc_tracing import record_span
+
+# pylint: disable=too-few-public-methods
+
+SANJUUNI_POOL_SIZE = int(
+    getenv("SANJUUNI_POOL_SIZE", str(max(1, (cpu_count() or 2) - 1)))
+)
+
+
+class PoolTask:
+    """A single conversion waiting for a worker"""
+
+    def __init__(
+        self, index: int, sequence: int, func: Callable[..., Any], args: tuple
+    ) -> None:
+        self.index = index
+        self.sequence = sequence
+        self.func = func
+        self.args = args
+        self.future = Future()
+        # keeps the trace span of the submitter
+        self.context = copy_context()
+        self.submitted = time_ns()
+
+
+class PoolJob:
+    """Book-keeping of all tasks of one job"""
+
+    def __init__(self, job_id: str, max_workers: int) -> None:
+        self.job_id = job_id
+        self.max_workers = max(1, max_workers)
+        self.pending: list[PoolTask] = []
+        self.running = 0
+        # index of the chunk the client is waiting on (the next one to merge)
+        self.head = 1
+        # background jobs have no client waiting and only get idle workers
+        self.background = False
+
+    def next_task(self) -> PoolTask | None:
+        """Returns the task of this job that should run next"""
+        if not self.pending or self.running >= self.max_workers:
+            return None
+        for task in self.pending:
+            if task.index == self.head:
+                return task
+        return min(self.pending, key=lambda task: (task.index, task.sequence))
+
+
+class ConversionPool:
+    """
+    One pool of sanjuuni workers shared by all jobs.
+    Free workers pick the task with the following priority:
+     0. jobs with a waiting client before background jobs
+     1. the chunk a job's merge (and so the client) is waiting on
+     2. the job that has the fewest running tasks (fair share)
+     3. the task that was submitted first
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = max(1, size)
+        self.condition = Condition()
+        self.jobs: dict[str, PoolJob] = {}
+        self.sequence = count()
+        self.threads: list[Thread] = []
+        self.running = 0
+        # replaced by attach_shared, to limit conversions across all sanic workers
+        self.slots = BoundedSemaphore(self.size)
+        self.shared_running = None
+
+    def attach_shared(self, slots, running) -> None:
+        """
+        Use a multiprocessing Semaphore and Value,
+        so the pool size is enforced for the whole machine and not only for this process
+        """
+        self.slots = slots
+        self.shared_running = running
+
+    def resize(self, size: int) -> None:
+        """Changes the number of workers, only before the first conversion"""
+        self.size = max(1, size)
+        self.slots = BoundedSemaphore(self.size)
+
+    def register_job(self, job_id: str, max_workers: int) -> None:
+        """Registers a job, it will never use more than max_workers at once"""
+        with self.condition:
+            self.jobs[job_id] = PoolJob(job_id, max_workers)
+
+    def unregister_job(self, job_id: str) -> None:
+        """Removes a job and cancels all of its tasks that did not start yet"""
+        with self.condition:
+            job = self.jobs.pop(job_id, None)
+            if job is None:
+                return
+            for task in job.pending:
+                task.future.cancel()
+            job.pending.clear()
+
+    def set_head(self, job_id: str, index: int) -> None:
+        """Sets the chunk the job is currently waiting on"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job:
+                job.head = index
+                self.condition.notify_all()
+
+    def set_background(self, job_id: str, background: bool) -> None:
+        """Demotes a job to background priority or promotes it back"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job:
+                job.background = background
+                self.condition.notify_all()
+
+    def submit(
+        self, job_id: str, index: int, func: Callable[..., Any], *args
+    ) -> Future:
+        """Queues func(*args) as task with the given (1-based) index of the job"""
+        task = PoolTask(index, next(self.sequence), func, args)
+        with self.condition:
+            if job_id not in self.jobs:
+                self.jobs[job_id] = PoolJob(job_id, self.size)
+            self.jobs[job_id].pending.append(task)
+            self.start_threads()
+            self.condition.notify()
+        return task.future
+
+    def start_threads(self) -> None:
+        """Starts the worker threads on first use"""
+        if self.threads:
+            return
+        for number in range(self.size):
+            thread = Thread(
+                target=self.worker, name=f"sanjuuni-worker-{number}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def busy(self) -> int:
+        """Number of conversions that are currently running"""
+        if self.shared_running is not None:
+            return self.shared_running.value
+        return self.running
+
+    def queued(self) -> int:
+        """Number of tasks waiting for a worker"""
+        with self.condition:
+            return sum(len(job.pending) for job in self.jobs.values())
+
+    def load(self) -> float:
+        """Running and queued tasks per worker"""
+        return (self.busy() + self.queued()) / self.size
+
+    def active_jobs(self) -> int:
+        """Number of jobs that are registered"""
+        with self.condition:
+            return len(self.jobs)
+
+    def fair_share(self) -> int:
+        """How many workers a new job can expect, given the current load"""
+        with self.condition:
+            jobs = len(self.jobs)
+        free = self.size - self.busy()
+        return max(1, min(ceil(self.size / (jobs + 1)), max(free, 1)))
+
+    def has_runnable(self) -> bool:
+        """Returns True if any job has a task that can be started"""
+        return any(job.next_task() for job in self.jobs.values())
+
+    def pop_next(self) -> tuple[PoolJob, PoolTask] | None:
+        """Picks the next task, see class docstring"""
+        best = None
+        best_key = None
+        for job in self.jobs.values():
+            task = job.next_task()
+            if task is None:
+                continue
+            key = (job.background, task.index != job.head, job.running, task.sequence)
+            if best_key is None or key < best_key:
+                best = (job, task)
+                best_key = key
+        if best:
+            best[0].pending.remove(best[1])
+            best[0].running += 1
+        return best
+
+    def add_running(self, value: int) -> None:
+        """Updates the running counters"""
+        self.running += value
+        if self.shared_running is not None:
+            with self.shared_running.get_lock():
+                self.shared_running.value += value
+
+    def worker(self) -> None:
+        """Runs tasks forever"""
+        while True:
+            with self.condition:
+                while not self.has_runnable():
+                    self.condition.wait()
+            self.slots.acquire()
+            with self.condition:
+                picked = self.pop_next()
+                if picked is None:
+                    self.slots.release()
+                    continue
+                job, task = picked
+                self.add_running(1)
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    task.context.run(
+                        record_span,
+                        "pool.wait",
+                        task.submitted,
+                        time_ns(),
+                        index=task.index,
+                        pool_job=job.job_id,
+                    )
+                    try:
+                        task.future.set_result(task.context.run(task.func, *task.args))
+                    # pylint: disable-next=broad-exception-caught
+                    except BaseException as exc:
+                        task.future.set_exception(exc)
+            finally:
+                self.slots.release()
+                with self.condition:
+                    job.running -= 1
+                    self.add_running(-1)
+                    self.condition.notify_all()
+            logger.debug(
+                "Pool task %s of %s finished (load=%.2f)", task.index, job.job_id, self.load()
+            )
+
+
+conversion_pool = ConversionPool(SANJUUNI_POOL_SIZE)
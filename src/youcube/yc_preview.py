@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Previews (thumbnails) of media, shown while the conversion runs.
+An NFP image (one CC palette colour per character, readable with
+paintutils.parseImage) and, for videos, one 32vid frame.
+Both are cached next to the media files.
+https://tweaked.cc/library/cc.image.nft.html
+"""
+
+# Built-in modules
+from os import getenv
+from os.path import exists, join
+
+# Local modules
+from yc_utils import DATA_FOLDER
+
+PREVIEWS = getenv("PREVIEWS", "true").lower() in ("1", "true", "yes", "on")
+# NFP size of audio only requests, in characters (a computer screen)
+PREVIEW_WIDTH = int(getenv("PREVIEW_WIDTH", "51"))
+PREVIEW_HEIGHT = int(getenv("PREVIEW_HEIGHT", "19"))
+NFP_SUFFIX = ".nfp"
+
+# default colours of CC, by their paint character
+PALETTE = {
+    "0": (0xF0, 0xF0, 0xF0),  # white
+    "1": (0xF2, 0xB2, 0x33),  # orange
+    "2": (0xE5, 0x7F, 0xD8),  # magenta
+    "3": (0x99, 0xB2, 0xF2),  # lightBlue
+    "4": (0xDE, 0xDE, 0x6C),  # yellow
+    "5": (0x7F, 0xCC, 0x19),  # lime
+    "6": (0xF2, 0xB2, 0xCC),  # pink
+    "7": (0x4C, 0x4C, 0x4C),  # gray
+    "8": (0x99, 0x99, 0x99),  # lightGray
+    "9": (0x4C, 0x99, 0xB2),  # cyan
+    "a": (0xB2, 0x66, 0xE5),  # purple
+    "b": (0x33, 0x66, 0xCC),  # blue
+    "c": (0x7F, 0x66, 0x4C),  # brown
+    "d": (0x57, 0xA6, 0x4E),  # green
+    "e": (0xCC, 0x4C, 0x4C),  # red
+    "f": (0x11, 0x11, 0x11),  # black
+}
+
+
+def nfp_size(width: int | None, height: int | None) -> tuple[int, int]:
+    """
+    NFP size in characters, a character of a 32vid is 2x3 pixels,
+    so the NFP covers the same screen as the video
+    """
+    if width is None or height is None:
+        return PREVIEW_WIDTH, PREVIEW_HEIGHT
+    return max(1, width // 2), max(1, height // 3)
+
+
+def get_nfp_name(media_id: str, width: int, height: int) -> str:
+    """Returns the file name of an NFP preview (size in characters)"""
+    return f"{media_id}({width}x{height}){NFP_SUFFIX}"
+
+
+def get_frame_name(media_id: str, width: int, height: int) -> str:
+    """Returns the file name of a 32vid preview frame (size in pixels)"""
+    return f"{media_id}({width}x{height}).preview.32vid"
+
+
+def closest_colour(pixel: tuple[int, int, int], cache: dict) -> str:
+    """Paint character of the palette colour closest to an RGB pixel"""
+    if pixel not in cache:
+        red, green, blue = pixel
+        cache[pixel] = min(
+            PALETTE,
+            key=lambda char: (
+                # weighted like the eye, green matters most
+                2 * (PALETTE[char][0] - red) ** 2
+                + 4 * (PALETTE[char][1] - green) ** 2
+                + 3 * (PALETTE[char][2] - blue) ** 2
+            ),
+        )
+    return cache[pixel]
+
+
+def rgb_to_nfp(data: bytes, width: int, height: int) -> str:
+    """Quantizes rgb24 pixels to the CC palette, one line per row"""
+    cache: dict = {}
+    rows = []
+    for row in range(height):
+        start = row * width * 3
+        rows.append(
+            "".join(
+                closest_colour(tuple(data[i : i + 3]), cache)
+                for i in range(start, start + width * 3, 3)
+            )
+        )
+    return "\n".join(rows)
+
+
+def read_frames(path: str) -> list[str]:
+    """Frame lines of a raw 32vid (without the format and frame rate lines)"""
+    with open(path, "r", encoding="utf-8") as file:
+        return [line.rstrip("\n") for line in file][2:]
+
+
+def load_preview(
+    media_id: str, width: int | None, height: int | None
+) -> dict[str, object] | None:
+    """Returns the preview message of a media, None if it is not rendered"""
+    nfp_width, nfp_height = nfp_size(width, height)
+    nfp_file = join(DATA_FOLDER, get_nfp_name(media_id, nfp_width, nfp_height))
+    if not exists(nfp_file):
+        return None
+    with open(nfp_file, "r", encoding="utf-8") as file:
+        preview = {
+            "action": "preview",
+            "id": media_id,
+            "width": nfp_width,
+            "height": nfp_height,
+            "nfp": file.read(),
+        }
+    if width is not None and height is not None:
+        frame_file = join(DATA_FOLDER, get_frame_name(media_id, width, height))
+        if exists(frame_file):
+            preview["lines"] = read_frames(frame_file)
+    return preview
+
+
+def preview_files(media_id: str, width: int | None, height: int | None) -> list[str]:
+    """Names of the preview files of a request, for the cache cleaner"""
+    files = [get_nfp_name(media_id, *nfp_size(width, height))]
+    if width is not None and height is not None:
+        files.append(get_frame_name(media_id, width, height))
+    return files
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Fills the media cache before it is needed, e.g. with the playlists of an event.
+Runs the normal download pipeline without clients, from the command line
+or in-process (prewarm()).
+The command line is a process of its own next to the server, it doesn't share the sanjuuni pool
+and the priorities of the server, so it converts with fewer processes at a lower CPU priority.
+"""
+
+# Built-in modules
+from argparse import ArgumentParser, ArgumentTypeError
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from os import getenv, nice
+from time import monotonic
+from typing import Callable, Iterable
+from urllib.parse import parse_qs, urlsplit
+
+# Local modules
+from yc_download import download
+from yc_jobs import Job, JobCancelled
+from yc_logging import logger, setup_logging
+from yc_pool import SANJUUNI_POOL_SIZE, conversion_pool
+from yc_spotify import get_spotify_url_processor
+from yc_utils import (
+    cap_width_and_height,
+    is_audio_already_downloaded,
+    is_save,
+    is_video_already_downloaded,
+)
+
+PREWARM_JOBS = int(getenv("PREWARM_JOBS", "2"))
+# sanjuuni processes of the command line, the server keeps the rest of the CPUs
+PREWARM_POOL_SIZE = int(
+    getenv("PREWARM_POOL_SIZE", str(max(1, SANJUUNI_POOL_SIZE // 2)))
+)
+# niceness of the command line and its ffmpeg / sanjuuni processes
+PREWARM_NICE = int(getenv("PREWARM_NICE", "10"))
+
+
+@dataclass(frozen=True)
+class Variant:
+    """One version of a media, width and height are None for audio only"""
+
+    width: int | None = None
+    height: int | None = None
+    fps: int | None = None
+
+    def __str__(self) -> str:
+        if self.width is None or self.height is None:
+            return "audio"
+        size = f"{self.width}x{self.height}"
+        return f"{size}@{self.fps}" if self.fps else size
+
+
+@dataclass
+class PrewarmResult:
+    """What happened to one URL / media"""
+
+    url: str
+    state: str  # "done", "cached" or "failed"
+    title: str | None = None
+    error: str | None = None
+    seconds: float = 0.0
+    playlist_videos: list[str] = field(default_factory=list)
+
+
+class PrewarmJob(Job):
+    """A job without clients, only remembers the last error"""
+
+    def __init__(self, key: str) -> None:
+        super().__init__(key)
+        self.error: str | None = None
+
+    def post(self, message: dict) -> None:
+        """Nobody is waiting for status messages"""
+        if message.get("action") == "error":
+            self.error = message.get("message")
+
+
+def parse_variant(value: str) -> Variant:
+    """Parses "audio", "WIDTHxHEIGHT" or "WIDTHxHEIGHT@FPS" """
+    if value == "audio":
+        return Variant()
+    size, _, fps = value.partition("@")
+    width, _, height = size.partition("x")
+    try:
+        return Variant(int(width), int(height), int(fps) if fps else None)
+    except ValueError as exc:
+        raise ArgumentTypeError(
+            f'invalid variant "{value}", use audio, WIDTHxHEIGHT or WIDTHxHEIGHT@FPS'
+        ) from exc
+
+
+def get_media_id(url: str) -> str | None:
+    """
+    The media id of a URL without asking yt-dlp:
+    media ids (playlist entries) and YouTube links, None for everything else
+    """
+    if is_save(url):
+        return url
+    parts = urlsplit(url)
+    host = (parts.hostname or "").removeprefix("www.").removeprefix("m.")
+    path = [part for part in parts.path.split("/") if part]
+    media_id = None
+    if host == "youtu.be" and path:
+        media_id = path[0]
+    elif host in ("youtube.com", "music.youtube.com"):
+        if path == ["watch"]:
+            media_id = parse_qs(parts.query).get("v", [None])[0]
+        elif len(path) > 1 and path[0] in ("shorts", "embed", "live", "v"):
+            media_id = path[1]
+    return media_id if media_id and is_save(media_id) else None
+
+
+def is_cached(url: str, variants: Iterable[Variant]) -> bool:
+    """Returns True if every variant of the media is already converted"""
+    media_id = get_media_id(url)
+    if media_id is None or not is_audio_already_downloaded(media_id):
+        return False
+    return all(
+        variant.width is None
+        or is_video_already_downloaded(
+            media_id, *cap_width_and_height(variant.width, variant.height)
+        )
+        for variant in variants
+    )
+
+
+def prewarm_one(url: str, variants: list[Variant], running: list[Job]) -> PrewarmResult:
+    """
+    Converts all variants of one URL, one after another,
+    so they don't convert the shared audio at the same time
+    """
+    started = monotonic()
+    # media ids and YouTube links are checked without asking yt-dlp
+    if is_cached(url, variants):
+        return PrewarmResult(url, "cached")
+    result = PrewarmResult(url, "done")
+    for variant in variants:
+        job = PrewarmJob(f"prewarm {url} {variant}")
+        # clients of the server always come first
+        job.demote()
+        running.append(job)
+        try:
+            out, _ = download(
+                url,
+                job,
+                variant.width,
+                variant.height,
+                variant.fps,
+                get_spotify_url_processor(),
+            )
+        except JobCancelled:
+            result.state, result.error = "failed", "cancelled"
+            break
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            result.state, result.error = "failed", job.error or str(exc)
+            break
+        finally:
+            running.remove(job)
+        if out.get("action") == "error" or job.error:
+            result.state, result.error = "failed", job.error or out.get("message")
+            break
+        result.title = out.get("title")
+        # the first media of a playlist is converted, the rest is returned
+        result.playlist_videos = result.playlist_videos or out.get(
+            "playlist_videos", []
+        )
+    result.seconds = monotonic() - started
+    return result
+
+
+def prewarm(
+    urls: Iterable[str],
+    variants: Iterable[Variant] = (Variant(),),
+    jobs: int = PREWARM_JOBS,
+    playlists: bool = True,
+    progress: Callable[[PrewarmResult, int, int], None] | None = None,
+) -> list[PrewarmResult]:
+    """
+    Downloads and converts every URL in every variant, at most `jobs` URLs at once.
+    With playlists, all media of a playlist URL are converted too.
+    progress is called after each URL with the result, the finished and the known count.
+    """
+    variants = list(dict.fromkeys(variants)) or [Variant()]
+    seen = set()
+    results = []
+    running: list[Job] = []
+    futures: dict[Future, str] = {}
+
+    with ThreadPoolExecutor(max(1, jobs), thread_name_prefix="prewarm") as executor:
+
+        def submit(url: str) -> None:
+            if url and url not in seen:
+                seen.add(url)
+                futures[executor.submit(prewarm_one, url, variants, running)] = url
+
+        for url in urls:
+            submit(url)
+        try:
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    futures.pop(future)
+                    result = future.result()
+                    results.append(result)
+                    if playlists:
+                        for url in result.playlist_videos:
+                            submit(url)
+                    if progress:
+                        progress(result, len(results), len(seen))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            for job in list(running):
+                job.cancel()
+            raise
+    return results
+
+
+def log_progress(result: PrewarmResult, finished: int, total: int) -> None:
+    """Default progress report of the command line"""
+    name = result.title or result.url
+    if result.state == "failed":
+        logger.warning("[%s/%s] %s failed: %s", finished, total, name, result.error)
+    else:
+        logger.info(
+            "[%s/%s] %s %s (%.1fs)", finished, total, name, result.state, result.seconds
+        )
+
+
+def main() -> None:
+    """Command line of the pre-warmer"""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("urls", nargs="*", help="media or playlist URLs")
+    parser.add_argument(
+        "-f", "--file", help="file with one URL per line (# starts a comment)"
+    )
+    parser.add_argument(
+        "-v",
+        "--variant",
+        dest="variants",
+        action="append",
+        type=parse_variant,
+        help="audio, WIDTHxHEIGHT or WIDTHxHEIGHT@FPS, can be repeated (default: audio)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=PREWARM_JOBS,
+        help="URLs that are converted at once, conversions share PREWARM_POOL_SIZE",
+    )
+    parser.add_argument(
+        "--no-playlists",
+        dest="playlists",
+        action="store_false",
+        help="only convert the first media of a playlist",
+    )
+    args = parser.parse_intermixed_args()
+
+    urls = list(args.urls)
+    if args.file:
+        with open(args.file, "r", encoding="utf-8") as file:
+            urls += [
+                line.strip()
+                for line in file
+                if line.strip() and not line.lstrip().startswith("#")
+            ]
+    if not urls:
+        parser.error("no URLs given")
+
+    setup_logging()
+    # children (ffmpeg, sanjuuni) inherit the niceness
+    if PREWARM_NICE:
+        nice(PREWARM_NICE)
+    conversion_pool.resize(PREWARM_POOL_SIZE)
+    started = monotonic()
+    try:
+        results = prewarm(
+            urls, args.variants or [Variant()], args.jobs, args.playlists, log_progress
+        )
+    except KeyboardInterrupt:
+        logger.warning("Pre-warming cancelled")
+        return
+
+    states = [result.state for result in results]
+    logger.info(
+        "Pre-warmed %s media in %.1fs: %s done, %s cached, %s failed",
+        len(results),
+        monotonic() - started,
+        states.count("done"),
+        states.count("cached"),
+        states.count("failed"),
+    )
+    if "failed" in states:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SQLite job queue between the web-socket front-end and the conversion workers.
+Workers on the host of the front-end open the database,
+workers on other hosts use its HTTP API (/queue/...).
+"""
+
+# Built-in modules
+from asyncio import Event, Task, ensure_future, get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from json import dumps, loads
+from os import getenv
+from os.path import join
+from sqlite3 import Connection, connect
+from threading import local
+from time import time
+from typing import Any, Callable, Iterator
+from urllib.request import Request as URLRequest
+from urllib.request import urlopen
+
+# Local modules
+from yc_cluster import CLUSTER_FETCH_TIMEOUT, CLUSTER_TOKEN, check_token
+from yc_jobs import Job, JobCancelled
+from yc_logging import logger
+from yc_utils import DATA_FOLDER, create_data_folder_if_not_present
+
+# pip modules
+from sanic import Blueprint, Request
+from sanic.exceptions import BadRequest, NotFound
+from sanic.response import empty
+from sanic.response import json as json_response
+
+# "local" converts inside the sanic workers, "queue" leaves it to yc_worker.py
+WORKER_MODE = getenv("WORKER_MODE", "local").lower()
+# local storage of the host that runs the server and the workers,
+# SQLite's WAL mode needs shared memory and doesn't work on network file systems (NFS, SMB)
+QUEUE_DATABASE = getenv("QUEUE_DATABASE") or join(DATA_FOLDER, "queue.sqlite3")
+QUEUE_POLL_INTERVAL = float(getenv("QUEUE_POLL_INTERVAL", "0.25"))
+QUEUE_HEARTBEAT_INTERVAL = float(getenv("QUEUE_HEARTBEAT_INTERVAL", "5"))
+# running jobs without heartbeat for this long belong to a dead worker and are queued again
+QUEUE_STALE_AFTER = float(getenv("QUEUE_STALE_AFTER", "60"))
+# base URL of the front-end, for workers on another host than the queue database
+QUEUE_URL = getenv("QUEUE_URL", "").strip().rstrip("/")
+
+queue_api = Blueprint("queue")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    fps INTEGER,
+    state TEXT NOT NULL,
+    worker TEXT,
+    cancel INTEGER NOT NULL DEFAULT 0,
+    waiters INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    heartbeat REAL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_key ON messages (key, id);
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# sqlite connections can not be shared between threads, every thread keeps its own
+connections = local()
+
+
+@contextmanager
+def database(write: bool = True) -> Iterator[Connection]:
+    """
+    The queue database connection of this thread.
+    Every "with database() as db" block is one transaction.
+    """
+    # pylint: disable-next=invalid-name
+    db = getattr(connections, "db", None)
+    if db is None:
+        # pylint: disable-next=invalid-name
+        db = connections.db = connect(QUEUE_DATABASE, timeout=30, isolation_level=None)
+    db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def setup_queue() -> None:
+    """Creates the queue database"""
+    create_data_folder_if_not_present()
+    # pylint: disable-next=invalid-name
+    db = connect(QUEUE_DATABASE, timeout=30, isolation_level=None)
+    try:
+        # readers (the front-ends) don't block the writers (the workers)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+    finally:
+        db.close()
+
+
+def get_queue_key(url: str, width: int | None, height: int | None, fps: Any) -> str:
+    """Returns the key of a job, requests for the same media share one job"""
+    return dumps([url, width, height, fps])
+
+
+def enqueue(
+    url: str, width: int | None, height: int | None, fps: Any
+) -> tuple[str, int]:
+    """
+    Queues a job, or joins the queued / running job for the same media.
+    Every call counts as one waiter until request_cancel.
+    Returns the key and the id of the last message that is already there.
+    """
+    key = get_queue_key(url, width, height, fps)
+    # pylint: disable-next=invalid-name
+    with database() as db:
+        row = db.execute("SELECT state FROM jobs WHERE key = ?", (key,)).fetchone()
+        if row and row[0] in (QUEUED, RUNNING):
+            # someone wants it again
+            db.execute(
+                "UPDATE jobs SET cancel = 0, waiters = waiters + 1 WHERE key = ?",
+                (key,),
+            )
+        else:
+            db.execute("DELETE FROM messages WHERE key = ?", (key,))
+            db.execute(
+                "INSERT OR REPLACE INTO jobs "
+                "(key, url, width, height, fps, state, created, waiters) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 1)",
+                (key, url, width, height, fps, QUEUED, time()),
+            )
+        last = db.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM messages WHERE key = ?", (key,)
+        ).fetchone()[0]
+    return key, last
+
+
+def claim(worker: str) -> dict[str, Any] | None:
+    """Takes the oldest queued job for the worker"""
+    now = time()
+    # pylint: disable-next=invalid-name
+    with database() as db:
+        db.execute(
+            "UPDATE jobs SET state = ?, worker = NULL WHERE state = ? AND heartbeat < ?",
+            (QUEUED, RUNNING, now - QUEUE_STALE_AFTER),
+        )
+        db.execute(
+            "UPDATE jobs SET state = ?, error = 'cancelled' WHERE state = ? AND cancel = 1",
+            (FAILED, QUEUED),
+        )
+        row = db.execute(
+            "SELECT key, url, width, height, fps FROM jobs "
+            "WHERE state = ? ORDER BY created LIMIT 1",
+            (QUEUED,),
+        ).fetchone()
+        if row is None:
+            return None
+        db.execute(
+            "UPDATE jobs SET state = ?, worker = ?, heartbeat = ? WHERE key = ?",
+            (RUNNING, worker, now, row[0]),
+        )
+    return dict(zip(("key", "url", "width", "height", "fps"), row))
+
+
+def heartbeat(key: str, worker: str) -> bool:
+    """Tells the front-end that the worker is alive, returns True if the job got cancelled"""
+    # pylint: disable-next=invalid-name
+    with database() as db:
+        db.execute(
+            "UPDATE jobs SET heartbeat = ? WHERE key = ? AND worker = ?",
+            (time(), key, worker),
+        )
+        row = db.execute(
+            "SELECT cancel, worker FROM jobs WHERE key = ?", (key,)
+        ).fetchone()
+    # the job is gone or was given to another worker
+    return row is None or bool(row[0]) or row[1] != worker
+
+
+def add_messages(key: str, messages: list[dict]) -> None:
+    """Adds messages for the clients of a job"""
+    # pylint: disable-next=invalid-name
+    with database() as db:
+        db.executemany(
+            "INSERT INTO messages (key, message) VALUES (?, ?)",
+            [(key, dumps(message)) for message in messages],
+        )
+
+
+def finish(key: str, worker: str, result: Any = None, error: str | None = None) -> None:
+    """Stores the result of a job"""
+    # pylint: disable-next=invalid-name
+    with database() as db:
+        db.execute(
+            "UPDATE jobs SET state = ?, result = ?, error = ?, heartbeat = ? "
+            "WHERE key = ? AND worker = ?",
+            (
+                FAILED if error else DONE,
+                None if error else dumps(result),
+                error,
+                time(),
+                key,
+                worker,
+            ),
+        )
+
+
+def request_cancel(key: str) -> None:
+    """
+    Removes a waiter of the job,
+    the worker is asked to stop it once no front-end is waiting anymore
+    """
+    # pylint: disable-next=invalid-name
+    with database() as db:
+        db.execute(
+            "UPDATE jobs SET waiters = waiters - 1 WHERE key = ? AND state IN (?, ?)",
+            (key, QUEUED, RUNNING),
+        )
+        db.execute(
+            "UPDATE jobs SET cancel = 1 WHERE key = ? AND state IN (?, ?) AND waiters <= 0",
+            (key, QUEUED, RUNNING),
+        )
+
+
+def poll(
+    positions: dict[str, int],
+) -> dict[str, tuple[list[tuple[int, dict]], str | None, Any, str | None]]:
+    """
+    Returns the new messages (after the given message id),
+    the state, the result and the error of every given job
+    """
+    updates = {}
+    # pylint: disable-next=invalid-name
+    with database(write=False) as db:
+        for key, after in positions.items():
+            messages = db.execute(
+                "SELECT id, message FROM messages WHERE key = ? AND id > ? ORDER BY id",
+                (key, after),
+            ).fetchall()
+            row = db.execute(
+                "SELECT state, result, error FROM jobs WHERE key = ?", (key,)
+            ).fetchone()
+            state, result, error = row if row else (None, None, "job disappeared")
+            updates[key] = (
+                [(message_id, loads(message)) for message_id, message in messages],
+                state,
+                loads(result) if result else None,
+                error,
+            )
+    return updates
+
+
+def remove_finished_jobs(max_age: float) -> None:
+    """Removes finished jobs and their messages after max_age seconds"""
+    # pylint: disable-next=invalid-name
+    with database() as db:
+        db.execute(
+            "DELETE FROM messages WHERE key IN "
+            "(SELECT key FROM jobs WHERE state IN (?, ?) AND heartbeat < ?)",
+            (DONE, FAILED, time() - max_age),
+        )
+        db.execute(
+            "DELETE FROM jobs WHERE state IN (?, ?) AND heartbeat < ?",
+            (DONE, FAILED, time() - max_age),
+        )
+
+
+class QueueWaiter:
+    """A queued job the front-end waits for"""
+
+    def __init__(self, job: Job, key: str, after: int) -> None:
+        self.job = job
+        self.key = key
+        # id of the last message that was posted to the job
+        self.after = after
+        self.messages: list[tuple[int, dict]] = []
+        self.state: str | None = QUEUED
+        self.result: Any = None
+        self.error: str | None = None
+        self.changed = Event()
+
+    def update(
+        self,
+        messages: list[tuple[int, dict]],
+        state: str | None,
+        result: Any,
+        error: str | None,
+    ) -> None:
+        """Takes the news of a poll, wakes up run_queued if there are any"""
+        messages = [message for message in messages if message[0] > self.after]
+        if messages:
+            self.after = messages[-1][0]
+            self.messages.extend(messages)
+        if messages or state != self.state or self.job.is_cancelled():
+            self.state, self.result, self.error = state, result, error
+            self.changed.set()
+
+
+class QueueWatcher:
+    """
+    Polls the queue for all waiting jobs of this sanic worker,
+    one task reads the news of all of them in one thread that keeps its connection
+    """
+
+    def __init__(self) -> None:
+        self.waiters: set[QueueWaiter] = set()
+        self.task: Task | None = None
+        # the database may wait for the lock of a worker, so it isn't used in the event loop
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="queue")
+
+    async def call(self, func: Callable[..., Any], *args) -> Any:
+        """Runs a queue function in the queue thread"""
+        return await get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def watch(self, job: Job, key: str, after: int) -> QueueWaiter:
+        """Starts delivering the news of a job"""
+        waiter = QueueWaiter(job, key, after)
+        self.waiters.add(waiter)
+        if self.task is None or self.task.done():
+            self.task = ensure_future(self.run())
+        return waiter
+
+    def unwatch(self, waiter: QueueWaiter) -> None:
+        """Stops delivering the news of a job"""
+        self.waiters.discard(waiter)
+
+    async def run(self) -> None:
+        """Polls every QUEUE_POLL_INTERVAL seconds while anyone waits"""
+        while self.waiters:
+            await sleep(QUEUE_POLL_INTERVAL)
+            waiters = list(self.waiters)
+            positions: dict[str, int] = {}
+            for waiter in waiters:
+                positions[waiter.key] = min(
+                    positions.get(waiter.key, waiter.after), waiter.after
+                )
+            try:
+                updates = await self.call(poll, positions)
+            # pylint: disable-next=broad-exception-caught
+            except Exception as exc:
+                logger.warning("Could not read the queue: %s", exc)
+                continue
+            for waiter in waiters:
+                waiter.update(*updates[waiter.key])
+
+
+queue_watcher = QueueWatcher()
+
+
+async def run_queued(
+    job: Job, url: str, width: int | None, height: int | None, fps: Any
+) -> tuple[dict, list]:
+    """
+    Front-end side of a queued job:
+    queues it, streams the messages of the worker to the clients and returns the result
+    """
+    key, after = await queue_watcher.call(enqueue, url, width, height, fps)
+    waiter = queue_watcher.watch(job, key, after)
+    try:
+        while True:
+            await waiter.changed.wait()
+            waiter.changed.clear()
+            if job.is_cancelled():
+                await queue_watcher.call(request_cancel, key)
+                raise JobCancelled(key)
+            messages, waiter.messages = waiter.messages, []
+            for _message_id, message in messages:
+                job.post(message)
+            if waiter.state == DONE:
+                out, files = waiter.result
+                return out, files
+            if waiter.state == FAILED or waiter.state is None:
+                if waiter.error == "cancelled":
+                    # the worker stopped it for the waiters that left before we joined,
+                    # this waiter still wants it
+                    return {
+                        "action": "error",
+                        "message": "The conversion was cancelled, request the media again",
+                    }, []
+                raise RuntimeError(f"Worker failed: {waiter.error}")
+    finally:
+        queue_watcher.unwatch(waiter)
+
+
+class RemoteQueue:
+    """
+    The queue functions of the workers, over the HTTP API of the front-end.
+    For workers on other hosts, they can't open the SQLite database of the front-end.
+    """
+
+    def __init__(self, url: str) -> None:
+        self.url = url
+
+    def request(self, action: str, **payload: Any) -> Any:
+        """Calls an action of the queue API"""
+        request = URLRequest(
+            f"{self.url}/queue/{action}",
+            data=dumps(payload).encode(),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        if CLUSTER_TOKEN:
+            request.add_header("Authorization", f"Bearer {CLUSTER_TOKEN}")
+        with urlopen(request, timeout=CLUSTER_FETCH_TIMEOUT) as response:
+            body = response.read()
+        return loads(body) if body else None
+
+    def claim(self, worker: str) -> dict[str, Any] | None:
+        """See claim"""
+        return self.request("claim", worker=worker)
+
+    def heartbeat(self, key: str, worker: str) -> bool:
+        """See heartbeat"""
+        return self.request("heartbeat", key=key, worker=worker)["cancel"]
+
+    def add_messages(self, key: str, messages: list[dict]) -> None:
+        """See add_messages"""
+        self.request("messages", key=key, messages=messages)
+
+    def finish(
+        self, key: str, worker: str, result: Any = None, error: str | None = None
+    ) -> None:
+        """See finish"""
+        self.request("finish", key=key, worker=worker, result=result, error=error)
+
+
+def read_worker_request(request: Request, *fields: str) -> dict[str, Any]:
+    """Returns the body of a request of a remote worker"""
+    if WORKER_MODE != "queue":
+        raise NotFound("Queue mode is disabled")
+    check_token(request)
+    body = request.json
+    if not isinstance(body, dict) or any(field not in body for field in fields):
+        raise BadRequest(f"Expected a JSON object with {', '.join(fields)}")
+    return body
+
+
+@queue_api.post("/queue/claim")
+async def remote_claim(request: Request):
+    """Gives a remote worker the oldest queued job, null if there is none"""
+    body = read_worker_request(request, "worker")
+    return json_response(await queue_watcher.call(claim, body["worker"]))
+
+
+@queue_api.post("/queue/heartbeat")
+async def remote_heartbeat(request: Request):
+    """Heartbeat of a remote worker, tells it if the job got cancelled"""
+    body = read_worker_request(request, "key", "worker")
+    cancel = await queue_watcher.call(heartbeat, body["key"], body["worker"])
+    return json_response({"cancel": cancel})
+
+
+@queue_api.post("/queue/messages")
+async def remote_messages(request: Request):
+    """Messages of a remote worker for the clients of a job"""
+    body = read_worker_request(request, "key", "messages")
+    await queue_watcher.call(add_messages, body["key"], body["messages"])
+    return empty()
+
+
+@queue_api.post("/queue/finish")
+async def remote_finish(request: Request):
+    """Result of a remote worker, its files were pushed to /cache before"""
+    body = read_worker_request(request, "key", "worker")
+    await queue_watcher.call(
+        finish, body["key"], body["worker"], body.get("result"), body.get("error")
+    )
+    return empty()
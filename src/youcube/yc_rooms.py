@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Broadcast rooms: many clients play the same audio in sync.
+The playback of a room (media, wall clock time of chunk 0) is shared between the workers,
+every worker reads and encodes each chunk once and pushes the same serialized message
+to its listeners of the room, paced to playback speed.
+"""
+
+# Built-in modules
+from asyncio import Task, ensure_future, sleep
+from base64 import b64encode
+from math import ceil
+from os import getenv, getpid
+from os.path import getsize
+from time import time
+from typing import Any, MutableMapping
+from uuid import uuid4
+
+# Local modules
+from yc_channel import OutboundChannel, dumps
+from yc_logging import logger
+
+# pip modules
+from sanic.compat import open_async
+
+# dfpwm is 1 bit per sample at 48 kHz
+AUDIO_BYTES_PER_SECOND = 48000 // 8
+# seconds a chunk is sent before it has to play
+ROOM_LEAD_SECONDS = float(getenv("ROOM_LEAD_SECONDS", "2"))
+# room messages that may wait for a listener, it misses newer ones until it catches up
+ROOM_MAX_BEHIND = int(getenv("ROOM_MAX_BEHIND", "4"))
+# seconds until a worker follows a play_room or stop_room of another worker
+ROOM_SYNC_INTERVAL = float(getenv("ROOM_SYNC_INTERVAL", "0.25"))
+# seconds until the listeners of a worker that stopped refreshing them are dropped
+ROOM_LISTENER_TIMEOUT = float(getenv("ROOM_LISTENER_TIMEOUT", "15"))
+
+
+def chunk_seconds(playback: dict[str, Any]) -> float:
+    """Playback time of one chunk"""
+    return playback["chunk_size"] / AUDIO_BYTES_PER_SECOND
+
+
+def next_chunk(playback: dict[str, Any]) -> int:
+    """The first chunk that has not started playing yet"""
+    elapsed = (time() - playback["started"]) / chunk_seconds(playback)
+    return max(playback["chunkindex"], ceil(elapsed))
+
+
+def is_playing(playback: dict[str, Any] | None) -> bool:
+    """True until the last chunk played or the room got stopped"""
+    return (
+        playback is not None
+        and not playback["stopped"]
+        and next_chunk(playback) < playback["chunks"]
+    )
+
+
+class Room:
+    """The listeners of a room in this worker"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # channel -> messages it missed because it was too slow
+        self.listeners: dict[OutboundChannel, int] = {}
+        self.playback: dict[str, Any] | None = None
+        self.task: Task | None = None
+
+    def play(self, playback: dict[str, Any] | None) -> None:
+        """Follows the shared playback, replaces the current track"""
+        self.stop()
+        self.playback = playback
+        if is_playing(playback):
+            self.task = ensure_future(self.run(playback))
+
+    def stop(self) -> None:
+        """Stops sending"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def broadcast(self, message: bytes | str) -> None:
+        """Queues one serialized message for every listener that keeps up"""
+        for channel in list(self.listeners):
+            if not channel.offer(message, ROOM_MAX_BEHIND):
+                self.listeners[channel] += 1
+
+    async def run(self, playback: dict[str, Any]) -> None:
+        """Sends the chunks of the track, each ROOM_LEAD_SECONDS before it plays"""
+        seconds = chunk_seconds(playback)
+        chunk_size = playback["chunk_size"]
+        # wall clock time of chunk 0, the same in all workers
+        started = playback["started"]
+        chunkindex = next_chunk(playback)
+        try:
+            # the open file survives the cache cleaner
+            async with await open_async(file=playback["path"], mode="rb") as file:
+                await file.seek(chunkindex * chunk_size)
+                while True:
+                    due = started + chunkindex * seconds - ROOM_LEAD_SECONDS
+                    await sleep(max(0.0, due - time()))
+                    chunk = await file.read(chunk_size)
+                    self.broadcast(
+                        dumps(
+                            {
+                                "action": "room_chunk",
+                                "room": self.name,
+                                "id": playback["id"],
+                                "chunkindex": chunkindex,
+                                # epoch milliseconds, like os.epoch("utc")
+                                "at": round((started + chunkindex * seconds) * 1000),
+                                "chunk": b64encode(chunk).decode("ascii"),
+                            }
+                        )
+                    )
+                    if not chunk:
+                        # an empty chunk ends the track, like get_chunk
+                        break
+                    chunkindex += 1
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            logger.warning("Room %s stopped: %s", self.name, exc)
+
+
+class RoomRegistry:
+    """
+    The rooms of this worker.
+    Playbacks and listener counts are shared between the workers once attach_shared was called.
+    """
+
+    def __init__(self) -> None:
+        self.rooms: dict[str, Room] = {}
+        # room name -> playback
+        self.playbacks: MutableMapping[str, dict[str, Any]] = {}
+        # (room name, worker pid) -> (listeners, time of the last refresh)
+        self.listeners: MutableMapping[tuple[str, int], tuple[int, float]] = {}
+        self.last_heartbeat = 0.0
+
+    def attach_shared(
+        self,
+        playbacks: MutableMapping[str, dict[str, Any]],
+        listeners: MutableMapping[tuple[str, int], tuple[int, float]],
+    ) -> None:
+        """Uses the dicts of the main process, so all workers see the same rooms"""
+        self.playbacks = playbacks
+        self.listeners = listeners
+
+    def listener_count(self, name: str) -> int:
+        """Listeners of a room in all workers, without the ones of dead workers"""
+        oldest = time() - ROOM_LISTENER_TIMEOUT
+        return sum(
+            count
+            for (room_name, _pid), (count, refreshed) in self.listeners.items()
+            if room_name == name and refreshed >= oldest
+        )
+
+    def exists(self, name: str) -> bool:
+        """A room exists while it has listeners in any worker"""
+        return name in self.rooms or self.listener_count(name) > 0
+
+    def state(
+        self, name: str, channel: OutboundChannel | None = None
+    ) -> dict[str, Any]:
+        """The room message, for the actions"""
+        playback = self.playbacks.get(name)
+        room = self.rooms.get(name)
+        return {
+            "action": "room",
+            "room": name,
+            "id": playback and playback["id"],
+            "playing": is_playing(playback),
+            "chunkindex": (
+                min(next_chunk(playback), playback["chunks"])
+                if is_playing(playback)
+                else playback and playback["chunkindex"] or 0
+            ),
+            "chunk_size": playback["chunk_size"] if playback else 0,
+            "listeners": self.listener_count(name),
+            "joined": room is not None and channel in room.listeners,
+        }
+
+    def count(self, room: Room) -> None:
+        """Shares how many listeners the room has in this worker"""
+        key = (room.name, getpid())
+        if room.listeners:
+            self.listeners[key] = (len(room.listeners), time())
+        else:
+            self.listeners.pop(key, None)
+
+    def join(self, name: str, channel: OutboundChannel) -> None:
+        """Adds a listener"""
+        room = self.rooms.get(name)
+        if room is None:
+            room = Room(name)
+            self.rooms[name] = room
+            # the room may already play in another worker
+            room.play(self.playbacks.get(name))
+        room.listeners.setdefault(channel, 0)
+        self.count(room)
+
+    def leave(self, name: str, channel: OutboundChannel) -> bool:
+        """Removes a listener, an empty room is closed. False if there is no such room"""
+        room = self.rooms.get(name)
+        if room is None:
+            return self.exists(name)
+        missed = room.listeners.pop(channel, 0)
+        if missed:
+            logger.debug("Listener of room %s missed %s chunks", name, missed)
+        self.count(room)
+        if not room.listeners:
+            room.stop()
+            del self.rooms[name]
+            if not self.listener_count(name):
+                self.playbacks.pop(name, None)
+        return True
+
+    def release(self, channel: OutboundChannel) -> None:
+        """The client is gone, it leaves all rooms"""
+        for name, room in list(self.rooms.items()):
+            if channel in room.listeners:
+                self.leave(name, channel)
+
+    def play(
+        self, name: str, media_id: str, path: str, chunk_size: int, chunkindex: int
+    ) -> None:
+        """Plays a dfpwm file from chunkindex on in all workers, replaces the current track"""
+        seconds = chunk_size / AUDIO_BYTES_PER_SECOND
+        playback = {
+            "generation": uuid4().hex,
+            "id": media_id,
+            "path": path,
+            "chunk_size": chunk_size,
+            "chunkindex": chunkindex,
+            # the empty chunk at the end included
+            "chunks": getsize(path) // chunk_size + 1,
+            # wall clock time of chunk 0, so listeners can start chunks at the same time
+            "started": time() + ROOM_LEAD_SECONDS - chunkindex * seconds,
+            "stopped": False,
+        }
+        self.playbacks[name] = playback
+        if name in self.rooms:
+            self.rooms[name].play(playback)
+
+    def stop(self, name: str) -> None:
+        """Stops sending in all workers"""
+        playback = self.playbacks.get(name)
+        if playback is not None and not playback["stopped"]:
+            playback = {
+                **playback,
+                "generation": uuid4().hex,
+                "chunkindex": min(next_chunk(playback), playback["chunks"]),
+                "stopped": True,
+            }
+            self.playbacks[name] = playback
+        if name in self.rooms:
+            self.rooms[name].play(playback)
+
+    def sync(self) -> None:
+        """Follows the play_room and stop_room of the other workers"""
+        for name, room in list(self.rooms.items()):
+            playback = self.playbacks.get(name)
+            generation = playback and playback["generation"]
+            if generation != (room.playback and room.playback["generation"]):
+                room.play(playback)
+
+    def heartbeat(self) -> None:
+        """
+        Refreshes the listener counts of this worker
+        and drops the ones of workers that died without leaving their rooms
+        """
+        now = time()
+        if now - self.last_heartbeat < ROOM_LISTENER_TIMEOUT / 3:
+            return
+        self.last_heartbeat = now
+        for room in self.rooms.values():
+            self.count(room)
+        oldest = now - ROOM_LISTENER_TIMEOUT
+        for key, (_count, refreshed) in list(self.listeners.items()):
+            if refreshed < oldest:
+                self.listeners.pop(key, None)
+                logger.debug("Dropped the listeners of room %s in dead worker %s", *key)
+                if not self.exists(key[0]):
+                    self.playbacks.pop(key[0], None)
+
+    async def run_sync(self) -> None:
+        """Syncs the rooms every ROOM_SYNC_INTERVAL seconds"""
+        while True:
+            await sleep(ROOM_SYNC_INTERVAL)
+            try:
+                self.sync()
+                self.heartbeat()
+            # pylint: disable-next=broad-exception-caught
+            except Exception as exc:
+                logger.warning("Syncing the rooms failed: %s", exc)
+
+    def report(self) -> dict[str, Any]:
+        """Rooms and how many chunks their listeners in this worker missed, for the admin API"""
+        return {
+            name: {**self.state(name), "missed": sum(room.listeners.values())}
+            for name, room in self.rooms.items()
+        }
+
+
+rooms = RoomRegistry()
@@ -11,16 +11,20 @@ from enum import Enum
 from logging import getLogger
 from os import getenv
 from re import match as re_match
-from typing import Union
+from typing import TYPE_CHECKING, Union
 
-# pip modules
-from spotipy import MemoryCacheHandler, SpotifyClientCredentials
-from spotipy.client import Spotify
+# pip modules (spotipy is imported on first use, it is slow to import)
+if TYPE_CHECKING:
+    from spotipy.client import Spotify
 
 
 # pylint: disable=missing-function-docstring
 # pylint: disable=missing-class-docstring
 
+SPOTIPY_CLIENT_ID = getenv("SPOTIPY_CLIENT_ID")
+SPOTIPY_CLIENT_SECRET = getenv("SPOTIPY_CLIENT_SECRET")
+SPOTIFY_ENABLED = bool(SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET)
+
 
 class SpotifyTypes(Enum):
     TRACK = "track"
@@ -33,7 +37,7 @@ class SpotifyTypes(Enum):
 
 
 class SpotifyURLProcessor:
-    def __init__(self, spotify: Spotify = None, spotify_market: str = "US") -> None:
+    def __init__(self, spotify: "Spotify" = None, spotify_market: str = "US") -> None:
         self.spotify = spotify
         self.spotify_market = spotify_market
 
@@ -100,6 +104,9 @@ class SpotifyURLProcessor:
 
     # pylint: disable-next=inconsistent-return-statements
     def auto(self, url: str) -> Union[str, list]:
+        # pylint: disable-next=import-outside-toplevel,redefined-outer-name
+        from spotipy.client import Spotify
+
         type_function_map = {
             SpotifyTypes.ALBUM: self.spotify_album_tracks,
             SpotifyTypes.TRACK: self.spotify_track,
@@ -127,26 +134,37 @@ class SpotifyURLProcessor:
                         return func(match_id)
 
 
-def main() -> None:
-    logger = getLogger(__name__)
+# pylint: disable-next=invalid-name
+spotify_url_processor = None
 
-    # Spotify
-    spotify_client_id = getenv("SPOTIPY_CLIENT_ID")
-    spotify_client_secret = getenv("SPOTIPY_CLIENT_SECRET")
-    spotipy = None
 
-    if spotify_client_id and spotify_client_secret:
-        logger.info("Spotipy Enabled")
-        spotipy = Spotify(
-            auth_manager=SpotifyClientCredentials(
-                client_id=spotify_client_id,
-                client_secret=spotify_client_secret,
-                cache_handler=MemoryCacheHandler(),
+def get_spotify_url_processor() -> Union["SpotifyURLProcessor", None]:
+    """Creates the Spotify client on first use, spotipy is slow to import"""
+    global spotify_url_processor  # pylint: disable=global-statement
+    if spotify_url_processor is None and SPOTIFY_ENABLED:
+        # pylint: disable-next=import-outside-toplevel
+        from spotipy import MemoryCacheHandler, Spotify, SpotifyClientCredentials
+
+        spotify_url_processor = SpotifyURLProcessor(
+            Spotify(
+                auth_manager=SpotifyClientCredentials(
+                    client_id=SPOTIPY_CLIENT_ID,
+                    client_secret=SPOTIPY_CLIENT_SECRET,
+                    cache_handler=MemoryCacheHandler(),
+                )
             )
         )
+    return spotify_url_processor
+
+
+def main() -> None:
+    logger = getLogger(__name__)
+
+    if SPOTIFY_ENABLED:
+        logger.info("Spotipy Enabled")
     else:
         logger.info("Spotipy Disabled")
-    spotify_url_processor = SpotifyURLProcessor(spotipy)
+    processor = get_spotify_url_processor() or SpotifyURLProcessor()
 
     test_urls = [
         "https://open.spotify.com/album/2Kh43m04B1UkVcpcRa1Zug",
@@ -163,7 +181,7 @@ def main() -> None:
     from yc_colours import Foreground
 
     for url in test_urls:
-        print(Foreground.BLUE + url + Foreground.WHITE, spotify_url_processor.auto(url))
+        print(Foreground.BLUE + url + Foreground.WHITE, processor.auto(url))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,554 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Compressed 32vid storage (VIDEO_STORAGE=blocks).
+The frames are stored in zlib blocks that can be decompressed on their own,
+an index maps offsets of the raw 32vid to the blocks.
+So the trackers of the clients stay offsets into the raw 32vid
+and a request only decompresses the block it reads.
+Identical consecutive frames (still scenes, padded chunks) are stored once with a count.
+
+Layout: MAGIC, blocks, index (raw offset, file offset, length per block), footer
+Block: runs of (count, length, line), a line is stored with its newline
+
+Every 32vid gets a frame index next to it (FRAME_INDEX_SUFFIX), so seeking
+by time doesn't have to scan the video.
+Layout: FRAME_INDEX_MAGIC, header, raw offset of every frame (little endian)
+"""
+
+# Built-in modules
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from dataclasses import dataclass
+from math import ceil
+from os import getenv, remove, replace, stat
+from os.path import exists
+from struct import Struct
+from sys import byteorder
+from threading import Lock
+from time import thread_time_ns
+from typing import Any, BinaryIO, Iterable, Iterator
+from zlib import compress, decompress
+
+# Local modules
+from yc_logging import logger, setup_logging
+from yc_tracing import set_span_attributes, trace_span
+
+# "raw" keeps 32vid as sanjuuni writes it, "blocks" compresses it
+VIDEO_STORAGE = getenv("VIDEO_STORAGE", "raw").lower()
+# distinct frames per block, a cache miss decompresses one block
+VIDEO_BLOCK_FRAMES = int(getenv("VIDEO_BLOCK_FRAMES", "20"))
+VIDEO_COMPRESSION_LEVEL = int(getenv("VIDEO_COMPRESSION_LEVEL", "6"))
+# decompressed blocks kept per worker
+VIDEO_BLOCK_CACHE_MB = int(getenv("VIDEO_BLOCK_CACHE_MB", "64"))
+
+MAGIC = b"YC32VZ2\n"
+# raw offset, file offset, compressed length
+INDEX_ENTRY = Struct("<QQI")
+# index offset, block count, raw size, magic
+FOOTER = Struct("<QIQ8s")
+# repeat count, line length
+RUN = Struct("<II")
+
+FRAME_INDEX_SUFFIX = ".frames"
+FRAME_INDEX_MAGIC = b"YCFIDX1\n"
+# fps, raw size, mtime of the video, frame count
+FRAME_INDEX_HEADER = Struct("<dQQQ")
+
+
+@dataclass
+class BlockIndex:
+    """Index of a compressed 32vid file"""
+
+    raw_offsets: list[int]
+    entries: list[tuple[int, int, int]]
+    raw_size: int
+    stored_size: int
+
+    def find(self, offset: int) -> int | None:
+        """Returns the block that contains the raw offset"""
+        if offset < 0 or offset >= self.raw_size:
+            return None
+        return bisect_right(self.raw_offsets, offset) - 1
+
+
+@dataclass
+class Block:
+    """A decompressed block, starts are raw offsets relative to the block"""
+
+    starts: list[int]
+    lines: list[bytes]
+    counts: list[int]
+    size: int
+    raw_size: int
+
+
+@dataclass
+class StorageStats:
+    """Serve-side numbers of this worker"""
+
+    batches: int = 0
+    batch_cpu_ns: int = 0
+    block_hits: int = 0
+    block_misses: int = 0
+    decompress_cpu_ns: int = 0
+
+    def report(self) -> dict[str, Any]:
+        """Returns the stats, CPU times in microseconds"""
+        return {
+            "batches": self.batches,
+            "cpu_us_per_batch": round(self.batch_cpu_ns / max(1, self.batches) / 1000),
+            "block_hits": self.block_hits,
+            "block_misses": self.block_misses,
+            "cpu_us_per_decompress": round(
+                self.decompress_cpu_ns / max(1, self.block_misses) / 1000
+            ),
+        }
+
+
+stats = StorageStats()
+# path -> (mtime, index or None for raw files)
+indexes: dict[str, tuple[int, BlockIndex | None]] = {}
+# (path, mtime, block) -> decompressed block
+blocks: OrderedDict[tuple[str, int, int], Block] = OrderedDict()
+# pylint: disable-next=invalid-name
+blocks_size = 0
+blocks_lock = Lock()
+
+
+def remove_if_exists(path: str) -> None:
+    """Removes a file, if it exists"""
+    if exists(path):
+        remove(path)
+
+
+def iter_runs(file: BinaryIO) -> Iterator[tuple[bytes, int]]:
+    """Yields every line of a raw 32vid and how often it is repeated"""
+    last = None
+    count = 0
+    for line in file:
+        if line == last:
+            count += 1
+            continue
+        if last is not None:
+            yield last, count
+        last, count = line, 1
+    if last is not None:
+        yield last, count
+
+
+def iter_blocks(file: BinaryIO, frames: int) -> Iterator[tuple[bytes, int]]:
+    """Encodes a raw 32vid into blocks, yields them with their raw size"""
+    block = []
+    raw_size = 0
+    for line, count in iter_runs(file):
+        block += [RUN.pack(count, len(line)), line]
+        raw_size += len(line) * count
+        if len(block) >= frames * 2:
+            yield b"".join(block), raw_size
+            block = []
+            raw_size = 0
+    if block:
+        yield b"".join(block), raw_size
+
+
+@trace_span("store.compress")
+def compress_video(source: str, destination: str) -> None:
+    """Compresses a raw 32vid file into the block format"""
+    part = destination + ".blocks"
+    entries = []
+    raw_size = 0
+    try:
+        with open(source, "rb") as file, open(part, "wb") as out:
+            out.write(MAGIC)
+            for block, size in iter_blocks(file, max(1, VIDEO_BLOCK_FRAMES)):
+                data = compress(block, VIDEO_COMPRESSION_LEVEL)
+                entries.append((raw_size, out.tell(), len(data)))
+                out.write(data)
+                raw_size += size
+            index_offset = out.tell()
+            for entry in entries:
+                out.write(INDEX_ENTRY.pack(*entry))
+            out.write(FOOTER.pack(index_offset, len(entries), raw_size, MAGIC))
+            stored_size = out.tell()
+        replace(part, destination)
+    finally:
+        remove_if_exists(part)
+
+    set_span_attributes(raw_size=raw_size, stored_size=stored_size, blocks=len(entries))
+    logger.info(
+        "Compressed %s: %.1f MiB -> %.1f MiB (%.1fx, %s blocks)",
+        destination,
+        raw_size / 1024 / 1024,
+        stored_size / 1024 / 1024,
+        raw_size / max(1, stored_size),
+        len(entries),
+    )
+
+
+def store_video(part_file: str, out_file: str) -> None:
+    """
+    Moves a finished 32vid to its final location, compressed if enabled,
+    and saves its frame index
+    """
+    # the raw file is scanned faster than the compressed one
+    with trace_span("frame_index", path=out_file), open(part_file, "rb") as file:
+        frame_index = index_frames(iter_runs(file))
+    if VIDEO_STORAGE == "blocks":
+        compress_video(part_file, out_file)
+        remove_if_exists(part_file)
+    else:
+        replace(part_file, out_file)
+    save_frame_index(out_file, frame_index)
+
+
+def load_index(path: str) -> BlockIndex | None:
+    """Reads the index of a compressed 32vid, None for raw files"""
+    with open(path, "rb") as file:
+        magic = file.read(len(MAGIC))
+        if magic != MAGIC:
+            return None
+        file.seek(-FOOTER.size, 2)
+        stored_size = file.tell() + FOOTER.size
+        index_offset, count, raw_size, footer_magic = FOOTER.unpack(
+            file.read(FOOTER.size)
+        )
+        if footer_magic != MAGIC:
+            raise ValueError(f"{path} is truncated")
+        file.seek(index_offset)
+        data = file.read(count * INDEX_ENTRY.size)
+    entries = list(INDEX_ENTRY.iter_unpack(data))
+    return BlockIndex([entry[0] for entry in entries], entries, raw_size, stored_size)
+
+
+def get_index(path: str) -> tuple[int, BlockIndex | None]:
+    """Returns the cached index of a file and its mtime"""
+    mtime = stat(path).st_mtime_ns
+    cached = indexes.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, load_index(path))
+        indexes[path] = cached
+    return cached
+
+
+def decode_block(data: bytes) -> Block:
+    """Splits a decompressed block into its runs"""
+    block = Block([], [], [], len(data), 0)
+    raw_offset = 0
+    position = 0
+    while position < len(data):
+        count, length = RUN.unpack_from(data, position)
+        position += RUN.size
+        block.starts.append(raw_offset)
+        block.lines.append(data[position : position + length])
+        block.counts.append(count)
+        position += length
+        raw_offset += length * count
+    block.raw_size = raw_offset
+    return block
+
+
+def get_block(path: str, mtime: int, index: BlockIndex, number: int) -> Block:
+    """Returns a decompressed block, from the cache if possible"""
+    global blocks_size  # pylint: disable=global-statement
+    key = (path, mtime, number)
+    with blocks_lock:
+        block = blocks.get(key)
+        if block is not None:
+            blocks.move_to_end(key)
+            stats.block_hits += 1
+            return block
+
+    started = thread_time_ns()
+    _raw_offset, offset, length = index.entries[number]
+    with open(path, "rb") as file:
+        file.seek(offset)
+        block = decode_block(decompress(file.read(length)))
+
+    with blocks_lock:
+        stats.block_misses += 1
+        stats.decompress_cpu_ns += thread_time_ns() - started
+        if key not in blocks:
+            blocks[key] = block
+            blocks_size += block.size
+        while blocks and blocks_size > VIDEO_BLOCK_CACHE_MB * 1024 * 1024:
+            _key, dropped = blocks.popitem(last=False)
+            blocks_size -= dropped.size
+    return block
+
+
+def strip_newline(line: bytes) -> str:
+    """Decodes a stored line without its newline"""
+    return line[:-1].decode("utf-8") if line.endswith(b"\n") else line.decode("utf-8")
+
+
+def read_runs(
+    path: str, index: BlockIndex, mtime: int, tracker: int, count: int
+) -> list[tuple[str, int]]:
+    """
+    Returns count lines starting at the raw offset tracker,
+    as (line, repeats) runs of identical lines.
+    Lines behind the end are empty like in the raw file.
+    """
+    started = thread_time_ns()
+    runs = []
+    frames = 0
+    offset = tracker
+    while frames < count:
+        number = index.find(offset)
+        if number is None:
+            runs.append(("", count - frames))
+            break
+        block = get_block(path, mtime, index, number)
+        relative = offset - index.raw_offsets[number]
+        run = bisect_right(block.starts, relative) - 1
+        while frames < count and run < len(block.lines):
+            line = block.lines[run]
+            copy, skip = divmod(relative - block.starts[run], len(line))
+            if skip:
+                # the tracker points into a line, like a seek into the raw file
+                runs.append((strip_newline(line[skip:]), 1))
+                frames += 1
+                copy += 1
+            take = min(block.counts[run] - copy, count - frames)
+            if take > 0:
+                runs.append((strip_newline(line), take))
+                frames += take
+            run += 1
+            if run < len(block.starts):
+                relative = block.starts[run]
+        offset = index.raw_offsets[number] + block.raw_size
+    stats.batches += 1
+    stats.batch_cpu_ns += thread_time_ns() - started
+    return runs
+
+
+def lines_to_runs(lines: list[str]) -> list[tuple[str, int]]:
+    """Groups identical consecutive lines (of a raw 32vid) into runs"""
+    runs = []
+    for line in lines:
+        if runs and runs[-1][0] == line:
+            runs[-1] = (line, runs[-1][1] + 1)
+        else:
+            runs.append((line, 1))
+    return runs
+
+
+def expand_runs(runs: list[tuple[str, int]]) -> list[str]:
+    """Returns every line of the runs"""
+    return [line for line, repeats in runs for _ in range(repeats)]
+
+
+def compact_runs(runs: list[tuple[str, int]]) -> list[str | int]:
+    """
+    Wire format of clients with "repeat_frames":
+    an integer after a line repeats that line as often
+    """
+    lines = []
+    for line, repeats in runs:
+        if line:
+            lines.append(line)
+            if repeats > 1:
+                lines.append(repeats - 1)
+        else:
+            # the end of the video stays recognizable
+            lines += [line] * repeats
+    return lines
+
+
+@dataclass
+class FrameIndex:
+    """Frame rate, raw offset of every frame and raw size of a 32vid"""
+
+    fps: float
+    offsets: array
+    size: int = 0
+
+    def frame_at(self, seconds: float) -> int:
+        """Number of the first frame that starts at or after seconds"""
+        # the epsilon keeps 0.1 * 30 on frame 3
+        return max(0, ceil(seconds * self.fps - 1e-6)) if self.fps > 0 else 0
+
+    def tracker_at(self, frame: int) -> int:
+        """Raw offset of a frame, the end of the video past the last frame"""
+        return self.offsets[frame] if frame < len(self.offsets) else self.size
+
+
+# path -> (mtime, frame index)
+frame_indexes: dict[str, tuple[int, FrameIndex]] = {}
+
+
+def iter_stored_runs(path: str) -> Iterator[tuple[bytes, int]]:
+    """Yields the runs of lines of a 32vid file in either format"""
+    _mtime, index = get_index(path)
+    if index is None:
+        with open(path, "rb") as file:
+            yield from iter_runs(file)
+        return
+    with open(path, "rb") as file:
+        for _raw_offset, offset, length in index.entries:
+            file.seek(offset)
+            block = decode_block(decompress(file.read(length)))
+            yield from zip(block.lines, block.counts)
+
+
+def index_frames(runs: Iterable[tuple[bytes, int]]) -> FrameIndex:
+    """Reads the frame rate and the offset of every frame (one line per frame)"""
+    offsets = array("Q")
+    fps = 0.0
+    line_number = 0
+    raw_offset = 0
+    for line, count in runs:
+        for _copy in range(count):
+            # line 1 is the format, line 2 the frame rate, frames follow
+            if line_number == 1:
+                try:
+                    fps = float(line)
+                except ValueError:
+                    logger.warning("32vid without a frame rate line")
+            elif line_number > 1:
+                offsets.append(raw_offset)
+            line_number += 1
+            raw_offset += len(line)
+    return FrameIndex(fps, offsets, raw_offset)
+
+
+def build_frame_index(path: str) -> FrameIndex:
+    """Scans a 32vid file in either format for its frame index"""
+    return index_frames(iter_stored_runs(path))
+
+
+def frame_index_path(path: str) -> str:
+    """Path of the frame index of a 32vid"""
+    return path + FRAME_INDEX_SUFFIX
+
+
+def save_frame_index(path: str, frame_index: FrameIndex) -> None:
+    """Writes the frame index next to the 32vid, for its current mtime"""
+    offsets = array("Q", frame_index.offsets)
+    if byteorder != "little":
+        offsets.byteswap()
+    index_path = frame_index_path(path)
+    part = index_path + ".part"
+    try:
+        with open(part, "wb") as file:
+            file.write(FRAME_INDEX_MAGIC)
+            file.write(
+                FRAME_INDEX_HEADER.pack(
+                    frame_index.fps,
+                    frame_index.size,
+                    stat(path).st_mtime_ns,
+                    len(offsets),
+                )
+            )
+            file.write(offsets.tobytes())
+        replace(part, index_path)
+    except OSError as exc:
+        # only costs a scan of the video later
+        logger.warning("Could not save the frame index of %s: %s", path, exc)
+    finally:
+        remove_if_exists(part)
+
+
+def load_frame_index(path: str, mtime: int) -> FrameIndex | None:
+    """Reads the saved frame index, None if there is none or it is outdated"""
+    try:
+        with open(frame_index_path(path), "rb") as file:
+            if file.read(len(FRAME_INDEX_MAGIC)) != FRAME_INDEX_MAGIC:
+                return None
+            fps, size, video_mtime, count = FRAME_INDEX_HEADER.unpack(
+                file.read(FRAME_INDEX_HEADER.size)
+            )
+            if video_mtime != mtime:
+                return None
+            offsets = array("Q")
+            offsets.frombytes(file.read(count * offsets.itemsize))
+    except (OSError, ValueError) as exc:
+        # struct.error is a ValueError, a truncated file
+        logger.debug("No frame index for %s: %s", path, exc)
+        return None
+    if len(offsets) != count:
+        return None
+    if byteorder != "little":
+        offsets.byteswap()
+    return FrameIndex(fps, offsets, size)
+
+
+def get_frame_index(path: str) -> FrameIndex:
+    """
+    Returns the frame index of a file, from memory, from the saved index
+    or, if neither is current, by scanning the file once (slow)
+    """
+    mtime = stat(path).st_mtime_ns
+    cached = frame_indexes.get(path)
+    if cached is None or cached[0] != mtime:
+        frame_index = load_frame_index(path, mtime)
+        if frame_index is None:
+            with trace_span("frame_index", path=path):
+                frame_index = build_frame_index(path)
+            save_frame_index(path, frame_index)
+        cached = (mtime, frame_index)
+        frame_indexes[path] = cached
+    return cached[1]
+
+
+def cached_frame_index(path: str) -> FrameIndex | None:
+    """Returns the frame index if it is cached and current, never reads the file"""
+    cached = frame_indexes.get(path)
+    if cached is None or cached[0] != stat(path).st_mtime_ns:
+        return None
+    return cached[1]
+
+
+def cache_size() -> int:
+    """Number of cached blocks, for the memory report"""
+    return len(blocks)
+
+
+def storage_report() -> dict[str, Any]:
+    """Serve-side numbers and the compression of the cached files"""
+    files = {}
+    for path, (_mtime, index) in list(indexes.items()):
+        if index is not None and exists(path):
+            files[path] = {
+                "raw_size": index.raw_size,
+                "stored_size": index.stored_size,
+                "ratio": round(index.raw_size / max(1, index.stored_size), 2),
+                "blocks": len(index.entries),
+            }
+    return {
+        "storage": VIDEO_STORAGE,
+        **stats.report(),
+        "cached_blocks": len(blocks),
+        "cached_bytes": blocks_size,
+        "files": files,
+    }
+
+
+def main() -> None:
+    """Compresses existing 32vid files or shows their compression"""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("command", choices=("compress", "info"))
+    parser.add_argument("files", nargs="+", help="32vid files")
+    args = parser.parse_args()
+    setup_logging()
+
+    for path in args.files:
+        index = load_index(path)
+        if args.command == "compress" and index is None:
+            compress_video(path, path)
+        elif args.command == "info" and index is None:
+            print(f"{path}: raw")
+        elif args.command == "info":
+            print(
+                f"{path}: {index.raw_size} -> {index.stored_size} bytes "
+                f"({index.raw_size / max(1, index.stored_size):.1f}x, "
+                f"{len(index.entries)} blocks)"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Per-request pipeline tracing
+
+Spans are written as JSON-lines to TRACE_FILE, in the field layout of
+OpenTelemetry spans (trace_id, span_id, parent_span_id, *_unix_nano, attributes, status).
+Run "python yc_tracing.py TRACE_FILE" for a summary with the critical path of every trace.
+"""
+
+# Built-in modules
+from argparse import ArgumentParser
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from json import dumps, loads
+from os import getenv, urandom
+from threading import Lock
+from time import time_ns
+from typing import Any, Iterator
+
+TRACE_FILE = getenv("TRACE_FILE")
+
+current_span: ContextVar["Span | None"] = ContextVar("current_span", default=None)
+write_lock = Lock()
+
+
+class Span:
+    """A timed stage of the pipeline"""
+
+    def __init__(
+        self, name: str, parent: "Span | None", attributes: dict[str, Any]
+    ) -> None:
+        self.name = name
+        self.trace_id = parent.trace_id if parent else urandom(16).hex()
+        self.span_id = urandom(8).hex()
+        self.parent_span_id = parent.span_id if parent else None
+        self.attributes = {key: value for key, value in attributes.items() if value is not None}
+        self.start = time_ns()
+        self.end = None
+        self.status = {"code": "OK"}
+
+    def set_attributes(self, **attributes: Any) -> None:
+        """Adds attributes to the span"""
+        self.attributes.update(
+            {key: value for key, value in attributes.items() if value is not None}
+        )
+
+    def set_error(self, message: str) -> None:
+        """Marks the span as failed"""
+        self.status = {"code": "ERROR", "message": message}
+
+    def to_dict(self) -> dict[str, Any]:
+        """Returns the span in OpenTelemetry field layout"""
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "name": self.name,
+            "start_time_unix_nano": self.start,
+            "end_time_unix_nano": self.end,
+            "attributes": self.attributes,
+            "status": self.status,
+        }
+
+
+class NullSpan:
+    """Span that records nothing, used while tracing is disabled"""
+
+    def set_attributes(self, **_attributes: Any) -> None:
+        """Does nothing"""
+
+    def set_error(self, _message: str) -> None:
+        """Does nothing"""
+
+
+def write_span(span: Span) -> None:
+    """Appends a finished span to the trace file"""
+    line = dumps(span.to_dict(), default=str) + "\n"
+    with write_lock:
+        with open(TRACE_FILE, "a", encoding="utf-8") as file:
+            file.write(line)
+
+
+@contextmanager
+def trace_span(name: str, **attributes: Any) -> Iterator[Span | NullSpan]:
+    """
+    Records a span around the with block.
+    The span is the child of the current span of this context,
+    use contextvars.copy_context().run to keep the parent in other threads.
+    """
+    if not TRACE_FILE:
+        yield NullSpan()
+        return
+
+    span = Span(name, current_span.get(), attributes)
+    token = current_span.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        span.set_error(f"{type(exc).__name__}: {exc}")
+        raise
+    finally:
+        current_span.reset(token)
+        span.end = time_ns()
+        write_span(span)
+
+
+def set_span_attributes(**attributes: Any) -> None:
+    """Adds attributes to the current span"""
+    span = current_span.get()
+    if span is not None:
+        span.set_attributes(**attributes)
+
+
+def record_span(name: str, start: int, end: int, **attributes: Any) -> None:
+    """Records a span that already happened, as child of the current span"""
+    if not TRACE_FILE:
+        return
+    span = Span(name, current_span.get(), attributes)
+    span.start = start
+    span.end = end
+    write_span(span)
+
+
+def load_traces(path: str) -> dict[str, list[dict[str, Any]]]:
+    """Reads a trace file and groups the spans by trace"""
+    traces = defaultdict(list)
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if line.strip():
+                span = loads(line)
+                traces[span["trace_id"]].append(span)
+    return traces
+
+
+def critical_path(
+    span: dict[str, Any], children: dict[str, list[dict[str, Any]]]
+) -> list[dict[str, Any]]:
+    """
+    Returns the chain of spans that determined the end time of span.
+    Walks back from the end of the span and always takes the child that finished last.
+    """
+    path = [span]
+    cursor = span["end_time_unix_nano"]
+    chain = []
+    for child in sorted(
+        children.get(span["span_id"], []),
+        key=lambda child: child["end_time_unix_nano"],
+        reverse=True,
+    ):
+        if child["end_time_unix_nano"] <= cursor:
+            chain.append(child)
+            cursor = child["start_time_unix_nano"]
+    for child in reversed(chain):
+        path.extend(critical_path(child, children))
+    return path
+
+
+def duration_ms(span: dict[str, Any]) -> float:
+    """Returns the duration of a span in milliseconds"""
+    return (span["end_time_unix_nano"] - span["start_time_unix_nano"]) / 1e6
+
+
+def summarize(path: str, last: int) -> None:
+    """Prints the critical path of the last traces and the time per stage over all traces"""
+    traces = load_traces(path)
+    stage_totals = defaultdict(float)
+    roots = []
+    for spans in traces.values():
+        children = defaultdict(list)
+        for span in spans:
+            if span["parent_span_id"]:
+                children[span["parent_span_id"]].append(span)
+        for root in spans:
+            if not root["parent_span_id"]:
+                chain = critical_path(root, children)
+                roots.append((root, chain))
+                for span in chain[1:]:
+                    own = duration_ms(span) - sum(
+                        duration_ms(child)
+                        for child in chain
+                        if child["parent_span_id"] == span["span_id"]
+                    )
+                    stage_totals[span["name"]] += max(own, 0)
+
+    roots.sort(key=lambda item: item[0]["start_time_unix_nano"])
+    for root, chain in roots[-last:]:
+        total = duration_ms(root)
+        print(f"{root['name']} {total:.0f} ms {root['attributes']} [{root['status']['code']}]")
+        for span in chain[1:]:
+            print(
+                f"  {span['name']:<24} {duration_ms(span):>10.0f} ms "
+                f"{duration_ms(span) / total * 100 if total else 0:>5.1f}%  "
+                f"{span['attributes']}"
+            )
+        print()
+
+    print(f"Critical path time per stage over {len(roots)} traces (excluding child stages)")
+    for name, total in sorted(stage_totals.items(), key=lambda item: -item[1]):
+        print(f"  {name:<24} {total:>12.0f} ms")
+
+
+def main() -> None:
+    """Summary CLI"""
+    parser = ArgumentParser(description="Summarize YouCube pipeline traces")
+    parser.add_argument("trace_file", nargs="?", default=TRACE_FILE)
+    parser.add_argument("--last", type=int, default=10, help="number of traces to show")
+    args = parser.parse_args()
+    if not args.trace_file:
+        parser.error("no trace file given and TRACE_FILE is not set")
+    summarize(args.trace_file, args.last)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,7 @@ Utils for string manipulation, data management etc.
 """
 
 # Built-in modules
-from os import mkdir
+from os import getenv, makedirs
 from os.path import abspath, dirname, exists, join
 from re import RegexFlag
 from re import compile as re_compile
@@ -62,7 +62,10 @@ def cap_width_and_height(width: int, height: int) -> Tuple[int, int]:
 
 VIDEO_FORMAT = "32vid"
 AUDIO_FORMAT = "dfpwm"
-DATA_FOLDER = join(dirname(abspath(__file__)), "data")
+# e.g. for shared storage or several instances on one machine
+DATA_FOLDER = abspath(
+    getenv("DATA_FOLDER") or join(dirname(abspath(__file__)), "data")
+)
 
 
 def get_video_name(media_id: str, width: int, height: int) -> str:
@@ -88,7 +91,7 @@ def get_audio_path(media_id: str) -> str:
 def create_data_folder_if_not_present():
     """Creates the data folder if it does not exist"""
     if not exists(DATA_FOLDER):
-        mkdir(DATA_FOLDER)
+        makedirs(DATA_FOLDER, exist_ok=True)
 
 
 def is_audio_already_downloaded(media_id: str) -> bool:
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Standalone conversion worker, takes jobs from the queue (WORKER_MODE=queue).
+Run as many as needed on the host of the server, they share its DATA_FOLDER and QUEUE_DATABASE.
+With QUEUE_URL they run on other hosts, use the queue API of the server
+and push the finished files to it.
+"""
+
+# Built-in modules
+from argparse import ArgumentParser
+from os import getenv, getpid, remove
+from os.path import exists, join
+from socket import gethostname
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import Any
+
+# Local modules
+import yc_queue
+from yc_cluster import push_files
+from yc_download import download
+from yc_jobs import Job, JobCancelled
+from yc_logging import logger, setup_logging
+from yc_queue import (
+    QUEUE_DATABASE,
+    QUEUE_HEARTBEAT_INTERVAL,
+    QUEUE_POLL_INTERVAL,
+    QUEUE_URL,
+    RemoteQueue,
+    setup_queue,
+)
+from yc_spotify import get_spotify_url_processor
+from yc_storage import frame_index_path
+from yc_utils import DATA_FOLDER
+
+WORKER_JOBS = int(getenv("WORKER_JOBS", "1"))
+
+
+class QueuedJob(Job):
+    """
+    A job of a worker, its messages are written to the queue in batches.
+    Waiting status messages are coalesced like in the OutboundChannel.
+    """
+
+    def __init__(self, key: str, queue: Any) -> None:
+        super().__init__(key)
+        self.queue = queue
+        self.messages: list[dict] = []
+        self.messages_lock = Lock()
+
+    def post(self, message: dict) -> None:
+        """Thread-safe, queues a message for the front-ends"""
+        with self.messages_lock:
+            if (
+                message.get("action") == "status"
+                and self.messages
+                and self.messages[-1].get("action") == "status"
+            ):
+                self.messages[-1] = message
+            else:
+                self.messages.append(message)
+
+    def flush(self) -> None:
+        """Writes the waiting messages to the queue"""
+        with self.messages_lock:
+            messages, self.messages = self.messages, []
+        if messages:
+            self.queue.add_messages(self.key, messages)
+
+
+def hand_over(file_names: list[str]) -> bool:
+    """
+    Pushes the finished files of a remote job to the server and removes them here,
+    the server's cache cleaner takes care of them from now on
+    """
+    present = [name for name in file_names if exists(join(DATA_FOLDER, name))]
+    if not push_files(QUEUE_URL, present):
+        return False
+    for name in present:
+        for path in (
+            join(DATA_FOLDER, name),
+            join(DATA_FOLDER, frame_index_path(name)),
+        ):
+            try:
+                remove(path)
+            except FileNotFoundError:
+                pass
+    return True
+
+
+def keep_alive(job: QueuedJob, worker: str, done: Event) -> None:
+    """Flushes the messages of the job and sends heartbeats until it is done"""
+    last_heartbeat = monotonic()
+    while not done.wait(QUEUE_POLL_INTERVAL):
+        try:
+            job.flush()
+            if monotonic() - last_heartbeat >= QUEUE_HEARTBEAT_INTERVAL:
+                last_heartbeat = monotonic()
+                if job.queue.heartbeat(job.key, worker) and not job.is_cancelled():
+                    job.cancel()
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            logger.warning("Queue update of %s failed: %s", job.key, exc)
+
+
+def run_job(task: dict[str, Any], worker: str, queue: Any) -> None:
+    """Runs one job of the queue"""
+    logger.info("Worker %s took %s", worker, task["key"])
+    job = QueuedJob(task["key"], queue)
+    # only the front-ends know about clients, nobody to prioritize here
+    job.demote()
+    done = Event()
+    alive = Thread(target=keep_alive, args=(job, worker, done), daemon=True)
+    alive.start()
+    result = None
+    error = None
+    try:
+        result = download(
+            task["url"],
+            job,
+            task["width"],
+            task["height"],
+            task["fps"],
+            get_spotify_url_processor(),
+        )
+    except JobCancelled:
+        error = "cancelled"
+    # pylint: disable-next=broad-exception-caught
+    except Exception as exc:
+        logger.exception("Job %s failed", task["key"])
+        error = str(exc) or type(exc).__name__
+    finally:
+        done.set()
+        alive.join()
+    job.flush()
+    # the clients are told about the files once the server has them
+    if QUEUE_URL and error is None and not hand_over(result[1]):
+        error = "the files could not be pushed to the server"
+    queue.finish(task["key"], worker, result, error)
+    logger.info("Worker %s finished %s (%s)", worker, task["key"], error or "done")
+
+
+def work(worker: str, queue: Any) -> None:
+    """Takes jobs forever"""
+    while True:
+        try:
+            task = queue.claim(worker)
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            logger.warning("Could not read the queue: %s", exc)
+            task = None
+        if task is None:
+            sleep(QUEUE_POLL_INTERVAL)
+            continue
+        try:
+            run_job(task, worker, queue)
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            # the job is queued again once its heartbeat is stale
+            logger.warning("Could not finish %s: %s", task["key"], exc)
+
+
+def main() -> None:
+    """Starts the worker threads"""
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=WORKER_JOBS,
+        help="jobs that run at once, conversions share SANJUUNI_POOL_SIZE",
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    name = f"{gethostname()}:{getpid()}"
+    if QUEUE_URL:
+        queue = RemoteQueue(QUEUE_URL)
+        logger.info("Worker %s uses the queue of %s", name, QUEUE_URL)
+    else:
+        setup_queue()
+        queue = yc_queue
+        logger.info("Worker %s uses the queue %s", name, QUEUE_DATABASE)
+
+    threads = [
+        Thread(target=work, args=(f"{name}:{number}", queue), daemon=True)
+        for number in range(max(1, args.jobs))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -6,22 +6,22 @@ YouCube Server
 """
 
 # built-in modules
-from asyncio import get_event_loop
+from asyncio import Task, ensure_future
 from base64 import b64encode
 from datetime import datetime
-from multiprocessing import Manager
+from multiprocessing import Manager, Semaphore, Value
 from os import getenv, remove
 from os.path import exists, join
 from shutil import which
+from threading import Thread
 from time import sleep
 from typing import Any, List, Tuple, Type, Union
 
 # optional pip module
 try:
-    from orjson import JSONDecodeError, dumps
+    from orjson import JSONDecodeError
     from orjson import loads as load_json
 except ModuleNotFoundError:
-    from json import dumps
     from json import loads as load_json
     from json.decoder import JSONDecodeError
 
@@ -37,16 +37,72 @@ from sanic.compat import open_async
 from sanic.exceptions import SanicException
 from sanic.handlers import ErrorHandler
 from sanic.response import raw, text
-from spotipy import MemoryCacheHandler, SpotifyClientCredentials
-from spotipy.client import Spotify
 
 # local modules
+from yc_admin import (
+    MEMORY_LOG_INTERVAL,
+    TRACEMALLOC_FRAMES,
+    admin,
+    label_frames,
+    memory_logger,
+    register_cache,
+    start_tracemalloc,
+)
+from yc_batching import VID_BATCH_BYTES, ClientBatching, limit_runs
+from yc_channel import ChannelClosed, OutboundChannel
+from yc_cluster import (
+    CLUSTER_NODES,
+    CLUSTER_SELF,
+    CLUSTER_TOKEN,
+    cluster,
+    cluster_enabled,
+)
 from yc_colours import RESET, Foreground
-from yc_download import DATA_FOLDER, FFMPEG_PATH, SANJUUNI_PATH, download
+from yc_checkpoint import iter_manifests, remove_stale_jobs
+from yc_download import (
+    DATA_FOLDER,
+    FFMPEG_PATH,
+    SANJUUNI_PATH,
+    download,
+    resume_jobs,
+    warm_up,
+)
+from yc_jobs import JobCancelled, jobs
+from yc_limits import ConnectionLimits, admit_job
 from yc_logging import NO_COLOR, setup_logging
 from yc_magic import run_function_in_thread_from_async_function
-from yc_spotify import SpotifyURLProcessor
-from yc_utils import cap_width_and_height, get_audio_name, get_video_name, is_save
+from yc_pool import SANJUUNI_POOL_SIZE, conversion_pool
+from yc_queue import (
+    QUEUE_DATABASE,
+    WORKER_MODE,
+    queue_api,
+    remove_finished_jobs,
+    run_queued,
+    setup_queue,
+)
+from yc_preview import load_preview, preview_files
+from yc_rooms import rooms
+from yc_spotify import SPOTIFY_ENABLED, get_spotify_url_processor
+from yc_storage import (
+    VIDEO_STORAGE,
+    cache_size,
+    cached_frame_index,
+    compact_runs,
+    expand_runs,
+    frame_index_path,
+    get_frame_index,
+    get_index,
+    lines_to_runs,
+    read_runs,
+)
+from yc_utils import (
+    AUDIO_FORMAT,
+    VIDEO_FORMAT,
+    cap_width_and_height,
+    get_audio_name,
+    get_video_name,
+    is_save,
+)
 
 VERSION = "0.0.0-poc.1.0.2"
 API_VERSION = "0.0.0-poc.1.0.0"  # https://commandcracker.github.io/YouCube/
@@ -66,6 +122,19 @@ CHUNKS_AT_ONCE = CHUNK_SIZE * 256
 
 FRAMES_AT_ONCE = 10
 
+# dfpwm is 1 bit per sample at 48 kHz
+AUDIO_BYTES_PER_SECOND = 48000 // 8
+# default and longest slice of a get_av response
+AV_SECONDS = CHUNKS_AT_ONCE / AUDIO_BYTES_PER_SECOND
+AV_MAX_SECONDS = float(getenv("AV_MAX_SECONDS", "5"))
+
+# clients with adaptive batches get audio in multiples of this
+CHUNK_UNIT = CHUNK_SIZE * 16
+
+# protocol extensions a client can enable in its handshake
+# repeat_frames: an integer in the "lines" of "vid" repeats the line before it as often
+FEATURES = frozenset({"repeat_frames"})
+
 # pylint settings
 # pylint: disable=pointless-string-statement
 # pylint: disable=fixme
@@ -122,32 +191,48 @@ Audio Formats:
  - XM   https://github.com/MCJack123/tracc
 
 Audio u. Video preview / thumbnail:
- - NFP  https://tweaked.cc/library/cc.image.nft.html
  - bimg https://github.com/SkyTheCodeMaster/bimg
  - as 1 qtv frame
- - as 1 32vid frame
 """
 
 logger = setup_logging()
 # TODO: change sanic logging format
 
 
-async def get_vid(vid_file: str, tracker: int) -> List[str]:
-    """Returns given line of 32vid file"""
+async def get_vid_runs(
+    vid_file: str, tracker: int, frames: int = FRAMES_AT_ONCE
+) -> List[Tuple[str, int]]:
+    """Returns the lines of a 32vid file from tracker on, as runs of identical lines"""
+    mtime, index = get_index(vid_file)
+    if index is not None:
+        # compressed (VIDEO_STORAGE=blocks), decompressing must not block the loop
+        return await run_function_in_thread_from_async_function(
+            read_runs, vid_file, index, mtime, tracker, frames
+        )
     async with await open_async(file=vid_file, mode="r", encoding="utf-8") as file:
         await file.seek(tracker)
         lines = []
-        for _unused in range(FRAMES_AT_ONCE):
+        for _unused in range(frames):
             lines.append((await file.readline())[:-1])  # remove \n
 
-    return lines
+    return lines_to_runs(lines)
+
+
+async def get_vid(vid_file: str, tracker: int) -> List[str]:
+    """Returns given line of 32vid file"""
+    return expand_runs(await get_vid_runs(vid_file, tracker))
 
 
-async def getchunk(media_file: str, chunkindex: int) -> bytes:
-    """Returns a chunk of the given media file"""
+async def getchunk(
+    media_file: str,
+    chunkindex: int,
+    chunk_size: int = CHUNKS_AT_ONCE,
+    chunks: int = 1,
+) -> bytes:
+    """Returns a chunk (or several) of the given media file"""
     async with await open_async(file=media_file, mode="rb") as file:
-        await file.seek(chunkindex * CHUNKS_AT_ONCE)
-        return await file.read(CHUNKS_AT_ONCE)
+        await file.seek(chunkindex * chunk_size)
+        return await file.read(chunk_size * chunks)
 
 
 # pylint: enable=redefined-outer-name
@@ -171,29 +256,6 @@ def assert_resp(
     return None
 
 
-# pylint: disable=duplicate-code
-spotify_client_id = getenv("SPOTIPY_CLIENT_ID")
-spotify_client_secret = getenv("SPOTIPY_CLIENT_SECRET")
-# pylint: disable-next=invalid-name
-spotipy = None
-
-if spotify_client_id and spotify_client_secret:
-    spotipy = Spotify(
-        auth_manager=SpotifyClientCredentials(
-            client_id=spotify_client_id,
-            client_secret=spotify_client_secret,
-            cache_handler=MemoryCacheHandler(),
-        )
-    )
-
-# pylint: disable-next=invalid-name
-spotify_url_processor = None
-if spotipy:
-    spotify_url_processor = SpotifyURLProcessor(spotipy)
-
-# pylint: enable=duplicate-code
-
-
 class Actions:
     """
     Default set of actions
@@ -203,25 +265,64 @@ class Actions:
     # pylint: disable=missing-function-docstring
 
     @staticmethod
-    async def request_media(message: dict, resp: Websocket, request: Request):
-        loop = get_event_loop()
+    async def request_media(message: dict, resp: OutboundChannel, request: Request):
         # get "url"
         url = message.get("url")
         if error := assert_resp("url", url, str):
             return error
         # TODO: assert_resp width and height
-        out, files = await run_function_in_thread_from_async_function(
-            download,
-            url,
-            resp,
-            loop,
-            message.get("width"),
-            message.get("height"),
-            message.get("fps"),
-            spotify_url_processor,
+        width = message.get("width")
+        height = message.get("height")
+        fps = message.get("fps")
+
+        # clients that request the same media share one job
+        key = (url, width, height, fps)
+        # converted media only needs its metadata, like playback it is never shed
+        converted_files = request.app.shared_ctx.converted.get(key)
+        converted = bool(converted_files) and all(
+            exists(join(DATA_FOLDER, file)) for file in converted_files
         )
+        if (
+            not converted
+            and not jobs.running(key)
+            and (error := admit_job(len(jobs.jobs)))
+        ):
+            # joining running jobs and playback go on, new work is shed
+            return error
+        job, created = jobs.get_or_create(key, resp)
+        # a client only plays one media at once, so it skipped everything else
+        jobs.release(resp, keep=job)
+        if created and WORKER_MODE == "queue":
+            # a worker converts it, we only pass its messages on
+            jobs.start(job, run_queued(job, url, width, height, fps))
+        elif created:
+            jobs.start(
+                job,
+                run_function_in_thread_from_async_function(
+                    download,
+                    url,
+                    job,
+                    width,
+                    height,
+                    fps,
+                    get_spotify_url_processor(),
+                ),
+            )
+
+        try:
+            out, files = await jobs.wait(job)
+        except JobCancelled:
+            return None
         for file in files:
             request.app.shared_ctx.data[file] = datetime.now()
+        # previews are optional, the media files make a request "converted"
+        media_files = [
+            file
+            for file in files
+            if file.endswith((f".{AUDIO_FORMAT}", f".{VIDEO_FORMAT}"))
+        ]
+        if media_files:
+            request.app.shared_ctx.converted[key] = media_files
         return out
 
     @staticmethod
@@ -241,9 +342,21 @@ class Actions:
             file = join(DATA_FOLDER, file_name)
 
             request.app.shared_ctx.data[file_name] = datetime.now()
-            chunk = await getchunk(file, chunkindex)
-
-            return {"action": "chunk", "chunk": b64encode(chunk).decode("ascii")}
+            batching: ClientBatching = request.ctx.batching
+            if batching.chunks is None:
+                chunk = await getchunk(file, chunkindex)
+                return {"action": "chunk", "chunk": b64encode(chunk).decode("ascii")}
+
+            # the client declared limits, chunkindex counts chunk units
+            units = batching.next_chunks()
+            chunk = await getchunk(file, chunkindex, batching.chunk_unit, units)
+            units = -(-len(chunk) // batching.chunk_unit)
+            batching.chunks.sent(units)
+            return {
+                "action": "chunk",
+                "chunk": b64encode(chunk).decode("ascii"),
+                "chunks": units,
+            }
         logger.warning("User tried to use special Characters")
         return {"action": "error", "message": "You dare not use special Characters"}
 
@@ -278,18 +391,256 @@ class Actions:
 
             request.app.shared_ctx.data[file_name] = datetime.now()
 
-            return {"action": "vid", "lines": await get_vid(file, tracker)}
+            batching: ClientBatching = request.ctx.batching
+            frames = batching.next_frames()
+            compact = "repeat_frames" in request.ctx.features
+            runs = limit_runs(
+                await get_vid_runs(file, tracker, frames), batching.vid_bytes, compact
+            )
+            if batching.frames:
+                batching.frames.sent(sum(repeats for _line, repeats in runs))
+            if compact:
+                return {"action": "vid", "lines": compact_runs(runs)}
+            return {"action": "vid", "lines": expand_runs(runs)}
 
         return {"action": "error", "message": "You dare not use special Characters"}
 
     @staticmethod
-    async def handshake(*_unused):
-        return {
+    async def get_av(message: dict, _unused, request: Request):
+        # get "position", the playback position in seconds
+        position = message.get("position")
+        if (
+            not isinstance(position, (int, float))
+            or isinstance(position, bool)
+            or position < 0
+        ):
+            return {"action": "error", "message": "position must be a number >= 0"}
+
+        # get "seconds", the length of the slice
+        seconds = message.get("seconds", AV_SECONDS)
+        if not isinstance(seconds, (int, float)) or isinstance(seconds, bool):
+            return {"action": "error", "message": "seconds must be a number"}
+        seconds = min(AV_MAX_SECONDS, max(1 / AUDIO_BYTES_PER_SECOND, seconds))
+
+        media_id = message.get("id")
+        if error := assert_resp("id", media_id, str):
+            return error
+        width = message.get("width")
+        if error := assert_resp("width", width, int):
+            return error
+        height = message.get("height")
+        if error := assert_resp("height", height, int):
+            return error
+        width, height = cap_width_and_height(width, height)
+
+        if not is_save(media_id):
+            return {"action": "error", "message": "You dare not use special Characters"}
+
+        audio_name = get_audio_name(media_id)
+        video_name = get_video_name(media_id, width, height)
+        audio_file = join(DATA_FOLDER, audio_name)
+        video_file = join(DATA_FOLDER, video_name)
+        if not exists(audio_file):
+            return {"action": "error", "message": "The audio is not converted yet"}
+        if not exists(video_file):
+            return {"action": "error", "message": "The video is not converted yet"}
+        request.app.shared_ctx.data[audio_name] = datetime.now()
+        request.app.shared_ctx.data[video_name] = datetime.now()
+
+        # both streams are cut at the same points in time, so they can't drift apart
+        end = position + seconds
+        audio_start = round(position * AUDIO_BYTES_PER_SECOND)
+        audio_end = round(end * AUDIO_BYTES_PER_SECOND)
+        chunk = await getchunk(audio_file, audio_start, 1, audio_end - audio_start)
+
+        frame_index = cached_frame_index(video_file)
+        if frame_index is None:
+            frame_index = await run_function_in_thread_from_async_function(
+                get_frame_index, video_file
+            )
+        first = frame_index.frame_at(position)
+        last = min(frame_index.frame_at(end), len(frame_index.offsets))
+        runs = []
+        if first < last:
+            runs = await get_vid_runs(
+                video_file, frame_index.offsets[first], last - first
+            )
+
+        response = {
+            "action": "av",
+            "position": position,
+            "next": end,
+            "chunk": b64encode(chunk).decode("ascii"),
+            "fps": frame_index.fps,
+            "frame": first,
+        }
+        if "repeat_frames" in request.ctx.features:
+            response["lines"] = compact_runs(runs)
+        else:
+            response["lines"] = expand_runs(runs)
+        return response
+
+    @staticmethod
+    async def seek(message: dict, _unused, request: Request):
+        # get "position", the playback position in seconds
+        position = message.get("position")
+        if (
+            not isinstance(position, (int, float))
+            or isinstance(position, bool)
+            or position < 0
+        ):
+            return {"action": "error", "message": "position must be a number >= 0"}
+
+        media_id = message.get("id")
+        if error := assert_resp("id", media_id, str):
+            return error
+        if not is_save(media_id):
+            return {"action": "error", "message": "You dare not use special Characters"}
+
+        # the audio chunk that contains position, in the units of get_chunk
+        batching: ClientBatching = request.ctx.batching
+        chunk_size = batching.chunk_unit if batching.chunks else CHUNKS_AT_ONCE
+        chunkindex = int(position * AUDIO_BYTES_PER_SECOND) // chunk_size
+        # the video starts where the chunk starts, so both play in sync
+        start = chunkindex * chunk_size / AUDIO_BYTES_PER_SECOND
+        response = {"action": "seek", "position": start, "chunkindex": chunkindex}
+
+        width = message.get("width")
+        height = message.get("height")
+        if width is None and height is None:
+            return response
+        if error := assert_resp("width", width, int):
+            return error
+        if error := assert_resp("height", height, int):
+            return error
+        width, height = cap_width_and_height(width, height)
+
+        video_name = get_video_name(media_id, width, height)
+        video_file = join(DATA_FOLDER, video_name)
+        if not exists(video_file):
+            return {"action": "error", "message": "The video is not converted yet"}
+        request.app.shared_ctx.data[video_name] = datetime.now()
+
+        frame_index = cached_frame_index(video_file)
+        if frame_index is None:
+            # saved next to the video when it was converted
+            frame_index = await run_function_in_thread_from_async_function(
+                get_frame_index, video_file
+            )
+        frame = min(frame_index.frame_at(start), len(frame_index.offsets))
+        response["frame"] = frame
+        response["tracker"] = frame_index.tracker_at(frame)
+        response["fps"] = frame_index.fps
+        return response
+
+    @staticmethod
+    async def get_preview(message: dict, _unused, request: Request):
+        media_id = message.get("id")
+        if error := assert_resp("id", media_id, str):
+            return error
+        if not is_save(media_id):
+            return {"action": "error", "message": "You dare not use special Characters"}
+
+        # without width and height the NFP has the size of a computer screen
+        width = message.get("width")
+        height = message.get("height")
+        if width is not None or height is not None:
+            if error := assert_resp("width", width, int):
+                return error
+            if error := assert_resp("height", height, int):
+                return error
+            width, height = cap_width_and_height(width, height)
+
+        preview = await run_function_in_thread_from_async_function(
+            load_preview, media_id, width, height
+        )
+        if preview is None:
+            return {"action": "error", "message": "There is no preview yet"}
+        for file_name in preview_files(media_id, width, height):
+            request.app.shared_ctx.data[file_name] = datetime.now()
+        return preview
+
+    @staticmethod
+    async def join_room(message: dict, channel: OutboundChannel, _request: Request):
+        room_name = message.get("room")
+        if error := assert_resp("room", room_name, str):
+            return error
+        if not is_save(room_name):
+            return {"action": "error", "message": "You dare not use special Characters"}
+        # room_chunk messages follow while the room plays
+        rooms.join(room_name, channel)
+        return rooms.state(room_name, channel)
+
+    @staticmethod
+    async def leave_room(message: dict, channel: OutboundChannel, _request: Request):
+        room_name = message.get("room")
+        if error := assert_resp("room", room_name, str):
+            return error
+        if not rooms.leave(room_name, channel):
+            return {"action": "error", "message": "There is no such room"}
+        return rooms.state(room_name, channel)
+
+    @staticmethod
+    async def play_room(message: dict, channel: OutboundChannel, request: Request):
+        room_name = message.get("room")
+        if error := assert_resp("room", room_name, str):
+            return error
+        if not rooms.exists(room_name):
+            return {"action": "error", "message": "There is no such room"}
+
+        media_id = message.get("id")
+        if error := assert_resp("id", media_id, str):
+            return error
+        if not is_save(media_id):
+            return {"action": "error", "message": "You dare not use special Characters"}
+        chunkindex = message.get("chunkindex", 0)
+        if error := assert_resp("chunkindex", chunkindex, int):
+            return error
+
+        # the media is requested with request_media first
+        file_name = get_audio_name(media_id)
+        file = join(DATA_FOLDER, file_name)
+        if not exists(file):
+            return {"action": "error", "message": "The audio is not converted yet"}
+        request.app.shared_ctx.data[file_name] = datetime.now()
+        rooms.play(room_name, media_id, file, CHUNKS_AT_ONCE, max(0, chunkindex))
+        return rooms.state(room_name, channel)
+
+    @staticmethod
+    async def stop_room(message: dict, channel: OutboundChannel, _request: Request):
+        room_name = message.get("room")
+        if error := assert_resp("room", room_name, str):
+            return error
+        if not rooms.exists(room_name):
+            return {"action": "error", "message": "There is no such room"}
+        rooms.stop(room_name)
+        return rooms.state(room_name, channel)
+
+    @staticmethod
+    async def handshake(message: dict, channel: OutboundChannel, request: Request):
+        # optional protocol extensions, only used for clients that ask for them
+        features = message.get("features")
+        if isinstance(features, list):
+            request.ctx.features = FEATURES.intersection(
+                feature for feature in features if isinstance(feature, str)
+            )
+        response = {
             "action": "handshake",
             "server": {"version": VERSION},
             "api": {"version": API_VERSION},
-            "capabilities": {"video": ["32vid"], "audio": ["dfpwm"]},
+            "capabilities": {
+                "video": ["32vid"],
+                "audio": ["dfpwm"],
+                "features": sorted(FEATURES),
+            },
+            "features": sorted(request.ctx.features),
         }
+        # clients that declare limits get adaptive batch sizes within them
+        limits = message.get("limits")
+        if isinstance(limits, dict):
+            response["batching"] = request.ctx.batching.configure(limits)
+            request.ctx.batching.start(channel.websocket)
+        return response
 
     # pylint: enable=missing-function-docstring
 
@@ -319,6 +670,10 @@ app.config.WEBSOCKET_PING_INTERVAL = 0
 if getenv("SANIC_NO_UVLOOP"):
     app.config.USE_UVLOOP = False
 
+app.blueprint(admin)
+app.blueprint(cluster)
+app.blueprint(queue_api)
+
 actions = {}
 
 # add all actions from default action set
@@ -327,11 +682,31 @@ for method in dir(Actions):
         actions[method] = getattr(Actions, method)
 
 
+@label_frames("action")
+async def run_action(
+    action: str, message: dict, channel: OutboundChannel, request: Request
+):
+    """Runs an action, profiles group their samples by the action name"""
+    return await actions[action](message, channel, request)
+
+
+# actions that can take long and must not block the message loop of the client
+background_actions = {"request_media"}
+
+
 DATA_CACHE_CLEANUP_INTERVAL = int(getenv("DATA_CACHE_CLEANUP_INTERVAL", "300"))
 DATA_CACHE_CLEANUP_AFTER = int(getenv("DATA_CACHE_CLEANUP_AFTER", "3600"))
+RESUME_JOBS_ON_STARTUP = getenv("RESUME_JOBS_ON_STARTUP", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+# load yt-dlp and spotipy right after start instead of on the first request
+WARM_UP = getenv("WARM_UP", "false").lower() in ("1", "true", "yes", "on")
 
 
-def data_cache_cleaner(data: dict):
+def data_cache_cleaner(data: dict, converted: dict):
     """
     Checks for outdated cache entries every DATA_CACHE_CLEANUP_INTERVAL (default 300) Seconds and
     deletes them if they have not been used for DATA_CACHE_CLEANUP_AFTER (default 3600) Seconds.
@@ -347,7 +722,17 @@ def data_cache_cleaner(data: dict):
                     if exists(file_path):
                         remove(file_path)
                         logger.debug('Deleted "%s"', file_name)
+                    if exists(frame_index_path(file_path)):
+                        remove(frame_index_path(file_path))
                     data.pop(file_name)
+            # requests whose files are gone need a conversion again
+            for key, files in converted.items():
+                if not all(file in data for file in files):
+                    converted.pop(key, None)
+            # work folders of conversions that never finished
+            remove_stale_jobs(DATA_CACHE_CLEANUP_AFTER)
+            if WORKER_MODE == "queue":
+                remove_finished_jobs(DATA_CACHE_CLEANUP_AFTER)
 
     except KeyboardInterrupt:
         pass
@@ -359,14 +744,35 @@ async def ready(app: Sanic, _):
     """See https://sanic.dev/en/guide/basics/listeners.html"""
     if DATA_CACHE_CLEANUP_INTERVAL > 0 and DATA_CACHE_CLEANUP_AFTER > 0:
         app.manager.manage(
-            "Data-Cache-Cleaner", data_cache_cleaner, {"data": app.shared_ctx.data}
+            "Data-Cache-Cleaner",
+            data_cache_cleaner,
+            {"data": app.shared_ctx.data, "converted": app.shared_ctx.converted},
+        )
+    # in queue mode the workers resume jobs, once their heartbeat got stale
+    if RESUME_JOBS_ON_STARTUP and WORKER_MODE != "queue" and any(iter_manifests()):
+        app.manager.manage(
+            "Job-Resumer",
+            resume_jobs,
+            {
+                "conversion_slots": app.shared_ctx.conversion_slots,
+                "conversion_running": app.shared_ctx.conversion_running,
+            },
         )
 
 
 @app.main_process_start
 async def main_start(app: Sanic):
     """See https://sanic.dev/en/guide/basics/listeners.html"""
-    app.shared_ctx.data = Manager().dict()
+    manager = Manager()
+    app.shared_ctx.data = manager.dict()
+    # request_media key -> files of the converted media
+    app.shared_ctx.converted = manager.dict()
+    # broadcast rooms, their listeners may be connected to different workers
+    app.shared_ctx.room_playbacks = manager.dict()
+    app.shared_ctx.room_listeners = manager.dict()
+    # one sanjuuni pool size for all sanic workers
+    app.shared_ctx.conversion_slots = Semaphore(SANJUUNI_POOL_SIZE)
+    app.shared_ctx.conversion_running = Value("i", 0)
 
     if which(FFMPEG_PATH) is None:
         logger.warning("FFmpeg not found.")
@@ -374,11 +780,77 @@ async def main_start(app: Sanic):
     if which(SANJUUNI_PATH) is None:
         logger.warning("Sanjuuni not found.")
 
-    if spotipy:
+    if SPOTIFY_ENABLED:
         logger.info("Spotipy Enabled")
     else:
         logger.info("Spotipy Disabled")
 
+    if cluster_enabled():
+        logger.info("Cluster mode, this node is %s", CLUSTER_SELF)
+
+    if VIDEO_STORAGE == "blocks":
+        logger.info("Videos are stored compressed")
+
+    if WORKER_MODE == "queue":
+        setup_queue()
+        logger.info("Conversions are left to the workers (queue %s)", QUEUE_DATABASE)
+
+
+@app.before_server_start
+async def attach_conversion_pool(app: Sanic):
+    """See https://sanic.dev/en/guide/basics/listeners.html"""
+    conversion_pool.attach_shared(
+        app.shared_ctx.conversion_slots, app.shared_ctx.conversion_running
+    )
+
+
+@app.before_server_start
+async def attach_rooms(app: Sanic):
+    """See https://sanic.dev/en/guide/basics/listeners.html"""
+    rooms.attach_shared(app.shared_ctx.room_playbacks, app.shared_ctx.room_listeners)
+    app.add_task(rooms.run_sync())
+
+
+@app.after_server_start
+async def start_warm_up(_app: Sanic):
+    """See https://sanic.dev/en/guide/basics/listeners.html"""
+    if WARM_UP:
+
+        def run_warm_up():
+            warm_up()
+            get_spotify_url_processor()
+
+        # the worker already accepts connections while warming up
+        Thread(target=run_warm_up, name="warm-up", daemon=True).start()
+
+
+@app.after_server_start
+async def start_memory_diagnostics(app: Sanic):
+    """See https://sanic.dev/en/guide/basics/listeners.html"""
+    if TRACEMALLOC_FRAMES > 0:
+        start_tracemalloc(TRACEMALLOC_FRAMES)
+    data = app.shared_ctx.data
+    register_cache("shared_data", lambda: len(data))
+    # entries of files that were deleted without going through the cleaner
+    register_cache(
+        "shared_data_missing",
+        lambda: sum(
+            1 for file_name in data.keys() if not exists(join(DATA_FOLDER, file_name))
+        ),
+    )
+    register_cache("jobs", lambda: len(jobs.jobs))
+    register_cache(
+        "job_channels", lambda: sum(len(job.channels) for job in jobs.jobs.values())
+    )
+    register_cache(
+        "job_processes", lambda: sum(len(job.processes) for job in jobs.jobs.values())
+    )
+    register_cache("pool_jobs", conversion_pool.active_jobs)
+    register_cache("pool_queued", conversion_pool.queued)
+    register_cache("video_blocks", cache_size)
+    if MEMORY_LOG_INTERVAL > 0:
+        app.add_task(memory_logger(MEMORY_LOG_INTERVAL), name="memory-logger")
+
 
 @app.route("/dfpwm/<media_id:str>/<chunkindex:int>")
 async def stream_dfpwm(_request: Request, media_id: str, chunkindex: int):
@@ -447,19 +919,65 @@ async def wshandler(request: Request, ws: Websocket):
 
     logger.debug("%sMy headers are: %s", prefix, request.headers)
 
-    while True:
-        message = await ws.recv()
-        logger.debug("%sMessage: %s", prefix, message)
+    tasks: set[Task] = set()
+    # protocol extensions the client enabled in its handshake
+    request.ctx.features = set()
+    request.ctx.batching = ClientBatching(
+        FRAMES_AT_ONCE, CHUNKS_AT_ONCE, CHUNK_UNIT, VID_BATCH_BYTES
+    )
+    request.ctx.limits = ConnectionLimits(request.client_ip)
+    # every message to the client goes through the channel, in order
+    channel = OutboundChannel(ws)
+    writer = ensure_future(channel.run())
 
+    async def handle(message: dict):
         try:
-            message: dict = load_json(message)
-        except JSONDecodeError:
-            logger.debug("%sFaild to parse Json", prefix)
-            await ws.send(dumps({"action": "error", "message": "Faild to parse Json"}))
+            response = await run_action(message.get("action"), message, channel, request)
+        # pylint: disable-next=broad-exception-caught
+        except Exception as exc:
+            logger.warning("%sAction %s failed: %s", prefix, message.get("action"), exc)
+            response = {"action": "error", "message": "Request failed"}
+        if response is not None:
+            try:
+                await channel.send(response)
+            except ChannelClosed:
+                pass
 
-        if message.get("action") in actions:
-            response = await actions[message.get("action")](message, ws, request)
-            await ws.send(dumps(response))
+    try:
+        while True:
+            message = await ws.recv()
+            if message is None:
+                break
+            logger.debug("%sMessage: %s", prefix, message)
+
+            try:
+                message: dict = load_json(message)
+            except JSONDecodeError:
+                logger.debug("%sFaild to parse Json", prefix)
+                await channel.send({"action": "error", "message": "Faild to parse Json"})
+                continue
+
+            if error := request.ctx.limits.check(message.get("action")):
+                logger.debug("%sRate limited: %s", prefix, message.get("action"))
+                await channel.send(error)
+                continue
+
+            if message.get("action") in background_actions:
+                task = ensure_future(handle(message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif message.get("action") in actions:
+                await handle(message)
+    finally:
+        logger.info("%sDisconnected!", prefix)
+        # cancels (or demotes) every job nobody else is waiting for
+        jobs.release(channel)
+        rooms.release(channel)
+        request.ctx.batching.close()
+        for task in tasks:
+            task.cancel()
+        channel.close()
+        writer.cancel()
 
 
 def main() -> None:
@@ -470,6 +988,11 @@ def main() -> None:
     host = getenv("HOST", "127.0.0.1")
     fast = not getenv("NO_FAST")
 
+    if CLUSTER_NODES and not CLUSTER_TOKEN:
+        # the peer routes refuse every request without it
+        logger.error("CLUSTER_NODES is set, but there is no CLUSTER_TOKEN")
+        raise SystemExit(1)
+
     app.run(host=host, port=port, fast=fast, access_log=True)
 
 